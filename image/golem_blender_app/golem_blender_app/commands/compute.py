@@ -1,10 +1,12 @@
-import os
-import zipfile
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from golem_task_api.dirutils import ProviderTaskDir
 
-from golem_blender_app.render_tools import blender_render
+from golem_blender_app.commands.extraction_cache import ExtractionCache
+from golem_blender_app.commands.result_archive import ResultArchive
+from golem_blender_app.render_tools import blender_render, blender_worker
 
 
 async def compute(
@@ -14,32 +16,64 @@ async def compute(
 ) -> Path:
     params = subtask_params
     subtask_work_dir = work_dir.subtask_dir(subtask_id)
-    resources_dir = work_dir / 'extracted_subtask_inputs'
     result_dir = subtask_work_dir / 'result'
     result_dir.mkdir(parents=True, exist_ok=True)
-    for rid in params['resources']:
-        with zipfile.ZipFile(work_dir.subtask_inputs_dir / rid, 'r') as zipf:
-            zipf.extractall(resources_dir)
-
-    params['scene_file'] = resources_dir / params['scene_file']
-    params['crops'] = [{
-        'outfilebasename': 'result',
-        'borders_x': [params['borders'][0], params['borders'][2]],
-        'borders_y': [params['borders'][1], params['borders'][3]],
-    }]
-    params.pop('borders')
-    await blender_render.render(
-        params,
-        {
-            "WORK_DIR": str(subtask_work_dir),
-            "OUTPUT_DIR": str(result_dir),
-        },
+    loop = asyncio.get_event_loop()
+    # Subtasks of a task share resources, which are extracted once and kept
+    # until subtasks using them are rendered
+    extraction_cache = ExtractionCache(work_dir / 'extracted_subtask_inputs')
+    resources_dir = await loop.run_in_executor(
+        None,
+        extraction_cache.extract,
+        [work_dir.subtask_inputs_dir / rid for rid in params['resources']],
     )
+    try:
+        params['scene_file'] = resources_dir / params['scene_file']
+        params['crops'] = [{
+            'outfilebasename': 'result',
+            'borders_x': [params['borders'][0], params['borders'][2]],
+            'borders_y': [params['borders'][1], params['borders'][3]],
+        }]
+        params.pop('borders')
+        use_blender_worker = params.pop('use_blender_worker', False)
 
-    output_filepath = f'{subtask_id}.zip'
-    with zipfile.ZipFile(work_dir / output_filepath, 'w') as zipf:
-        for filename in os.listdir(result_dir):
-            zipf.write(result_dir / filename, filename)
-            # FIXME delete raw files ?  # pylint: disable=fixme
+        output_filepath = f'{subtask_id}.zip'
+        archived = []
+        # Frames are archived one after another, as soon as Blender saves
+        # them, while later frames are rendered
+        with ResultArchive(work_dir / output_filepath) as archive, \
+                ThreadPoolExecutor(max_workers=1) as executor:
+
+            def on_frame_rendered(crop_info, frame_index):
+                archived.append(loop.run_in_executor(
+                    executor,
+                    archive.add,
+                    result_dir / crop_info['results'][frame_index],
+                ))
+
+            try:
+                await blender_render.render(
+                    params,
+                    {
+                        "WORK_DIR": str(subtask_work_dir),
+                        "OUTPUT_DIR": str(result_dir),
+                    },
+                    worker_pool=blender_worker.get_default_pool()
+                    if use_blender_worker else None,
+                    on_frame_rendered=on_frame_rendered,
+                )
+            finally:
+                # Frames are archived until then, also if rendering failed
+                results = await asyncio.gather(
+                    *archived, return_exceptions=True)
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+            # Files saved under other names than expected, if any
+            await loop.run_in_executor(
+                executor, archive.add_directory, result_dir)
+    finally:
+        extraction_cache.release(resources_dir)
+    print(f"Result archive {output_filepath} digest: {archive.digest}")
 
     return Path(output_filepath)
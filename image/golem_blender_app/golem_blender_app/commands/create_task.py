@@ -8,7 +8,7 @@ from golem_task_api.structs import Infrastructure
 
 from golem_blender_app import constants
 from golem_blender_app.commands import utils
-from golem_blender_app.render_tools import blender_render
+from golem_blender_app.render_tools import blender_render, blender_worker
 
 
 async def test_task(
@@ -44,6 +44,9 @@ async def test_task(
             "OUTPUT_DIR": str(result_dir),
         },
         monitor_usage=True,
+        # Verifications of the task render the same scene file
+        worker_pool=blender_worker.get_default_pool()
+        if params.get('use_blender_worker') else None,
     )
 
     result = max(results, key=lambda r: r["usage"].mem_peak)
@@ -0,0 +1,293 @@
+import fcntl
+import functools
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024 * 1024
+# Archives with more uncompressed bytes are extracted by several threads,
+# decompression releases the GIL.
+PARALLEL_EXTRACTION_MIN_BYTES = 64 * 1024 * 1024
+MANIFEST_FILENAME = '.extraction_manifest.json'
+LOCKS_DIRECTORY = '.locks'
+ARCHIVE_DIGESTS_CACHE_SIZE = 256
+_CHUNK_SIZE = 1 << 20
+
+# Descriptors of lock files of entries returned by extract() and not
+# released yet, in all caches of the process
+_entries_in_use: Dict[Path, List[int]] = {}
+_entries_lock = threading.Lock()
+
+
+def file_digest(path) -> str:
+    digest = hashlib.sha256()
+    with open(str(path), 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=ARCHIVE_DIGESTS_CACHE_SIZE)
+def _versioned_file_digest(path: str, size: int, mtime_ns: int) -> str:
+    return file_digest(path)
+
+
+def archive_digest(path) -> str:
+    """
+    Digest of the archive, computed once per its path, size and modification
+    time, as subtasks of a task share resource archives.
+    """
+    stat = os.stat(str(path))
+    return _versioned_file_digest(str(path), stat.st_size, stat.st_mtime_ns)
+
+
+class ExtractionCache:
+    """
+    ExtractionCache keeps contents of resource archives extracted in
+    a directory, one entry per digest of the archives, so archives
+    of subtasks of the same task are extracted once. Archives of an entry
+    are extracted to the same directory, in order, the same as extractall()
+    of each of them would.
+    An entry is reused only if its files still have sizes and CRCs they
+    have in the archives, otherwise it is extracted again. Reusing an entry
+    marks it as recently used, and least recently used entries are removed
+    once they take more than max_bytes. Entries in use, from extract() until
+    release(), are never removed. They are shared-locked by flock() of their
+    lock files, so entries in use by other processes are kept as well.
+    """
+
+    def __init__(
+            self,
+            directory,
+            max_bytes: int = DEFAULT_MAX_BYTES,
+            max_workers: Optional[int] = None,
+    ) -> None:
+        if max_bytes < 0:
+            raise ValueError(f"max_bytes must not be negative: {max_bytes}")
+        self._directory = Path(directory)
+        self._max_bytes = max_bytes
+        self._max_workers = max_workers or os.cpu_count() or 1
+        (self._directory / LOCKS_DIRECTORY).mkdir(parents=True, exist_ok=True)
+
+    def extract(self, archive_paths: Iterable) -> Path:
+        """
+        Extracts the archives, unless they are already, and marks their entry
+        as in use until it is released.
+        :return: directory with contents of the archives
+        """
+        archive_paths = [Path(path) for path in archive_paths]
+        key = hashlib.sha256(json.dumps(
+            [archive_digest(path) for path in archive_paths]
+        ).encode('utf-8')).hexdigest()
+        entry = self._directory / key
+        fd = _lock(self._lock_path(entry), fcntl.LOCK_SH)
+        with _entries_lock:
+            _entries_in_use.setdefault(entry, []).append(fd)
+        try:
+            self._extract_entry(entry, archive_paths)
+        except BaseException:
+            self.release(entry)
+            raise
+        return entry
+
+    @staticmethod
+    def release(entry: Path) -> None:
+        """
+        Marks the entry returned by extract() as no longer in use.
+        """
+        with _entries_lock:
+            fds = _entries_in_use[entry]
+            fd = fds.pop()
+            if not fds:
+                del _entries_in_use[entry]
+        os.close(fd)
+
+    def _lock_path(self, entry: Path) -> Path:
+        return self._directory / LOCKS_DIRECTORY / entry.name
+
+    def _extract_entry(self, entry: Path, archive_paths: List[Path]) -> None:
+        if self._verify(entry):
+            os.utime(str(entry / MANIFEST_FILENAME))
+            return
+        self._remove(entry)
+
+        # Entries are extracted aside and moved into place when complete,
+        # as other subtasks may extract the same archives concurrently.
+        tmp_dir = Path(tempfile.mkdtemp(
+            dir=str(self._directory), prefix=f'.{entry.name}.'))
+        try:
+            for path in archive_paths:
+                self._extract_archive(path, tmp_dir)
+            _write_manifest(tmp_dir, archive_paths)
+            try:
+                os.rename(str(tmp_dir), str(entry))
+            except OSError:
+                # Extracted by another subtask in the meantime
+                if not self._verify(entry):
+                    raise
+        finally:
+            shutil.rmtree(str(tmp_dir), ignore_errors=True)
+        self._evict()
+
+    def _extract_archive(self, path: Path, target: Path) -> None:
+        with zipfile.ZipFile(str(path), 'r') as zipf:
+            members = [info for info in zipf.infolist() if not info.is_dir()]
+            size = sum(info.file_size for info in members)
+            workers = min(self._max_workers, len(members))
+            if size < PARALLEL_EXTRACTION_MIN_BYTES or workers <= 1:
+                zipf.extractall(str(target))
+                return
+            zipf.extractall(
+                str(target),
+                [info for info in zipf.infolist() if info.is_dir()])
+
+        # Each thread reads the archive by its own handle, members are split
+        # between threads by their sizes.
+        parts: List[List[zipfile.ZipInfo]] = [[] for _ in range(workers)]
+        sizes = [0] * workers
+        for info in sorted(members, key=lambda i: i.file_size, reverse=True):
+            part = sizes.index(min(sizes))
+            parts[part].append(info)
+            sizes[part] += info.file_size
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for future in [
+                    executor.submit(_extract_members, path, target, part)
+                    for part in parts
+            ]:
+                future.result()
+
+    @staticmethod
+    def _verify(entry: Path) -> bool:
+        try:
+            with open(str(entry / MANIFEST_FILENAME), 'r') as f:
+                manifest = json.load(f)
+            for name, file in manifest['files'].items():
+                if (entry / name).stat().st_size != file['size'] or \
+                        file_crc(entry / name) != file['crc']:
+                    return False
+            return True
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+
+    def _remove(self, entry: Path) -> None:
+        if not entry.exists():
+            return
+        shutil.rmtree(self._move_aside(entry), ignore_errors=True)
+
+    def _move_aside(self, entry: Path) -> str:
+        # Moved aside first, so the entry never looks complete while removed
+        tmp_dir = tempfile.mkdtemp(
+            dir=str(self._directory), prefix=f'.{entry.name}.')
+        try:
+            os.rename(str(entry), os.path.join(tmp_dir, 'entry'))
+        except FileNotFoundError:
+            pass
+        return tmp_dir
+
+    def _evict(self) -> None:
+        entries = []
+        for entry in self._directory.iterdir():
+            if entry.name.startswith('.'):
+                continue
+            try:
+                with open(str(entry / MANIFEST_FILENAME), 'r') as f:
+                    manifest = json.load(f)
+                mtime = (entry / MANIFEST_FILENAME).stat().st_mtime
+            except (OSError, ValueError):
+                continue
+            entries.append((mtime, manifest.get('size', 0), entry))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self._max_bytes:
+                break
+            lock_path = self._lock_path(entry)
+            try:
+                fd = _lock(lock_path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # In use by this or another process
+                continue
+            try:
+                tmp_dir = self._move_aside(entry)
+                os.unlink(str(lock_path))
+            finally:
+                os.close(fd)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            total -= size
+
+
+def _extract_members(
+        path: Path,
+        target: Path,
+        members: List[zipfile.ZipInfo]
+) -> None:
+    with zipfile.ZipFile(str(path), 'r') as zipf:
+        for info in members:
+            try:
+                zipf.extract(info, str(target))
+            except FileExistsError:
+                # Its directory was created by another thread meanwhile
+                zipf.extract(info, str(target))
+
+
+def file_crc(path) -> int:
+    crc = 0
+    with open(str(path), 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def _lock(path: Path, operation: int) -> int:
+    """
+    Opens the lock file and locks it by flock() with the operation.
+    Lock files are removed along with their entries, so a lock of
+    the file removed meanwhile is taken again on a new one.
+    :return: descriptor of the lock file, closing it releases the lock
+    """
+    while True:
+        fd = os.open(str(path), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, operation)
+            if os.fstat(fd).st_ino == os.stat(str(path)).st_ino:
+                return fd
+        except FileNotFoundError:
+            pass
+        except BaseException:
+            os.close(fd)
+            raise
+        os.close(fd)
+
+
+def _extracted_name(info: zipfile.ZipInfo) -> str:
+    # Path of the member relative to the target, as of ZipFile.extract()
+    return os.path.join(*[
+        part for part in info.filename.split('/')
+        if part not in ('', '.', '..')
+    ])
+
+
+def _write_manifest(directory: Path, archive_paths: List[Path]) -> None:
+    # Sizes and CRCs of files extracted last, from infolists of archives
+    files = {}
+    for path in archive_paths:
+        with zipfile.ZipFile(str(path), 'r') as zipf:
+            for info in zipf.infolist():
+                if not info.is_dir():
+                    files[_extracted_name(info)] = {
+                        'size': info.file_size,
+                        'crc': info.CRC,
+                    }
+    with open(str(directory / MANIFEST_FILENAME), 'w') as f:
+        json.dump({
+            'files': files,
+            'size': sum(file['size'] for file in files.values()),
+        }, f)
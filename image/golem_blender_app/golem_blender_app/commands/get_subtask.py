@@ -44,6 +44,7 @@ def get_next_subtask(
         "output_format": task_params['format'],
         "borders": borders,
         "resources": resources,
+        "use_blender_worker": task_params.get('use_blender_worker', False),
     }
 
     with open(work_dir / f'subtask{subtask_id}.json', 'w') as f:
@@ -0,0 +1,78 @@
+import hashlib
+import os
+import zipfile
+from pathlib import Path
+from typing import Optional, Set
+
+# Images in these formats are compressed already, they are stored as they
+# are, other files are deflated.
+COMPRESSED_EXTENSIONS = frozenset(('.png', '.jpg', '.jpeg', '.exr'))
+_CHUNK_SIZE = 1 << 20
+
+
+class ResultArchive:
+    """
+    ResultArchive writes files of a subtask's result to a zip archive as soon
+    as they are added, and removes them once archived. The SHA-256 digest
+    of names and contents of archived files, in order, is computed while they
+    are written.
+    If the archive is not closed successfully, it is removed.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = Path(path)
+        self._zipf = zipfile.ZipFile(str(self.path), 'w')
+        self._digest = hashlib.sha256()
+        self._names: Set[str] = set()
+
+    def __enter__(self) -> 'ResultArchive':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self._zipf.close()
+            os.remove(str(self.path))
+
+    def add(self, path, arcname: Optional[str] = None) -> bool:
+        """
+        Archives the file, unless a file of the same name already is.
+        :return: whether the file was archived
+        """
+        path = Path(path)
+        arcname = arcname or path.name
+        if arcname in self._names or not path.is_file():
+            return False
+
+        info = zipfile.ZipInfo.from_file(str(path), arcname)
+        if path.suffix.lower() in COMPRESSED_EXTENSIONS:
+            info.compress_type = zipfile.ZIP_STORED
+        else:
+            info.compress_type = zipfile.ZIP_DEFLATED
+        self._digest.update(arcname.encode('utf-8') + b'\0')
+        with open(str(path), 'rb') as src, self._zipf.open(info, 'w') as dst:
+            for chunk in iter(lambda: src.read(_CHUNK_SIZE), b''):
+                self._digest.update(chunk)
+                dst.write(chunk)
+        self._names.add(arcname)
+        os.remove(str(path))
+        return True
+
+    def add_directory(self, directory) -> None:
+        """
+        Archives files of the directory not archived yet, in order of names.
+        """
+        for filename in sorted(os.listdir(str(directory))):
+            self.add(Path(directory) / filename)
+
+    @property
+    def digest(self) -> str:
+        return self._digest.hexdigest()
+
+    def close(self) -> str:
+        """
+        :return: digest of the archived files
+        """
+        self._zipf.close()
+        return self.digest
@@ -1,6 +1,8 @@
 from pathlib import Path
 
 from typing import Tuple, Optional
+import asyncio
+import functools
 import json
 import shutil
 import zipfile
@@ -13,7 +15,11 @@ from golem_blender_app.commands import utils
 from golem_blender_app.commands.renderingtaskcollector import (
     RenderingTaskCollector
 )
-from golem_blender_app.verifier_tools import verifier
+from golem_blender_app.verifier_tools import (
+    scratch_space,
+    verdict_cache,
+    verifier,
+)
 from golem_blender_app.verifier_tools.file_extension.matcher import \
     get_expected_extension
 
@@ -27,11 +33,11 @@ async def verify(
     with open(work_dir / f'subtask{subtask_id}.json', 'r') as f:
         params = json.load(f)
     subtask_work_dir = work_dir / f'subtask{subtask_id}'
-    subtask_work_dir.mkdir()
+    subtask_work_dir.mkdir(exist_ok=True)
     subtask_results_dir = subtask_work_dir / 'results'
-    subtask_results_dir.mkdir()
+    subtask_results_dir.mkdir(exist_ok=True)
     subtask_output_dir = subtask_work_dir / 'output'
-    subtask_output_dir.mkdir()
+    subtask_output_dir.mkdir(exist_ok=True)
 
     subtask_outputs_dir = work_dir.subtask_outputs_dir(subtask_id)
     zip_file_path = subtask_outputs_dir / f'{subtask_id}.zip'
@@ -41,21 +47,76 @@ async def verify(
     task_manager = DBTaskManager(work_dir)
     part_num = task_manager.get_part_num(subtask_id)
     task_manager.update_subtask_status(subtask_id, SubtaskStatus.VERIFYING)
-    dir_contents = subtask_results_dir.iterdir()
+    subtask_file_paths = [
+        str(entry) for entry in subtask_results_dir.iterdir()
+        if entry.is_file()
+    ]
+    scene_file_path = work_dir.task_inputs_dir / params['scene_file']
 
-    verdict = await verifier.verify(
-        [str(entry) for entry in dir_contents if entry.is_file()],
-        params['borders'],
-        work_dir.task_inputs_dir / params['scene_file'],
-        params['resolution'],
-        params['samples'],
-        params['frames'],
-        params['output_format'],
-        mounted_paths={
-            'OUTPUT_DIR': str(subtask_output_dir),
-            'WORK_DIR': str(subtask_work_dir),
-        }
+    # A subtask may be verified again, e.g. after a restart of the requestor,
+    # so verdicts of identical results are reused.
+    cache = verdict_cache.VerdictCache(
+        work_dir / 'verdict_cache',
+        task_params.get(
+            'verdict_cache_size', verdict_cache.DEFAULT_MAX_ENTRIES),
+    )
+    # Results are hashed aside, not to block other requests meanwhile
+    cache_key = await asyncio.get_event_loop().run_in_executor(
+        None,
+        functools.partial(
+            verdict_cache.get_cache_key,
+            scene_file_path,
+            {
+                name: params[name] for name in (
+                    'borders', 'resolution', 'samples', 'frames',
+                    'output_format'
+                )
+            },
+            subtask_file_paths,
+        ),
     )
+    cached = cache.get(cache_key)
+    if cached is not None:
+        print("Using cached verdict")
+        verdict = cached['verdict']
+        verdict_cache.restore_outputs(
+            subtask_output_dir, verdict, cached.get('outputs', {}))
+    else:
+        verdict = await verifier.verify(
+            subtask_file_paths,
+            params['borders'],
+            scene_file_path,
+            params['resolution'],
+            params['samples'],
+            params['frames'],
+            params['output_format'],
+            mounted_paths={
+                'OUTPUT_DIR': str(subtask_output_dir),
+                'WORK_DIR': str(subtask_work_dir),
+            },
+            monitor_usage=task_params.get(
+                'monitor_verification_usage', False),
+            max_workers=task_params.get('verification_workers'),
+            fail_fast=task_params.get('verification_fail_fast', False),
+            memory_budget=task_params.get('verification_memory_budget'),
+            save_metrics=task_params.get('save_verification_metrics', True),
+            lazy=task_params.get('lazy_verification_metrics', True),
+            scratch_in_memory=task_params.get(
+                'verification_scratch_in_memory', False),
+            scratch_max_bytes=task_params.get(
+                'verification_scratch_max_bytes',
+                scratch_space.DEFAULT_MAX_BYTES),
+            single_render_session=task_params.get(
+                'verification_single_render_session', False),
+            max_concurrent_renders=task_params.get(
+                'verification_max_concurrent_renders'),
+            use_blender_worker=task_params.get('use_blender_worker', False),
+        )
+        cache.put(
+            cache_key,
+            bool(verdict),
+            verdict_cache.collect_outputs(subtask_output_dir),
+        )
     print("Verdict:", verdict)
     if not verdict:
         task_manager.update_subtask_status(
@@ -1,7 +1,11 @@
 import asyncio
+import contextlib
+import sys
 import time
+import tracemalloc
 
 from dataclasses import dataclass
+from typing import Callable, Optional
 from golem_task_api.threading import Executor
 from psutil import Process
 
@@ -13,6 +17,28 @@ class Usage:
     real_time: float = 0.
 
 
+@contextlib.contextmanager
+def measure_usage(usage: Usage, trace_memory: bool = True):
+    """
+    Measures usage of the current process by the code run in the block.
+    mem_peak is the peak size of memory allocated by Python objects and
+    numpy arrays in the block. It is traced by tracemalloc, so blocks
+    with trace_memory enabled can not be nested.
+    """
+    if trace_memory:
+        tracemalloc.start()
+    time_started = time.perf_counter()
+    cpu_time_started = time.process_time()
+    try:
+        yield usage
+    finally:
+        usage.cpu_time = time.process_time() - cpu_time_started
+        usage.real_time = time.perf_counter() - time_started
+        if trace_memory:
+            usage.mem_peak = float(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+
 def _monitor_pid(pid: int, usage: Usage):
     proc = Process(pid)
 
@@ -22,27 +48,71 @@ def _monitor_pid(pid: int, usage: Usage):
         time.sleep(0.5)
 
 
-async def exec_and_monitor_cmd(cmd):
+async def _read_lines(process, on_line: Callable[[str], None]):
+    """
+    Passes lines of the process' output to on_line, and on to stdout.
+    Errors of on_line are reported, the output is read on regardless.
+    """
+    while True:
+        line = await process.stdout.readline()
+        if not line:
+            return
+        line = line.decode('utf-8', 'replace')
+        sys.stdout.write(line)
+        try:
+            on_line(line)
+        except Exception as e:  # pylint: disable=broad-except
+            print("Error while handling output line %r" % e,
+                  file=sys.stderr)
+
+
+async def _start_process(cmd, on_line: Optional[Callable[[str], None]]):
+    return await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE if on_line is not None else None,
+    )
+
+
+async def _wait_for_process(
+        process,
+        on_line: Optional[Callable[[str], None]]
+) -> int:
+    """
+    Waits for the process to exit, reading its output if on_line is given.
+    If waiting is cancelled or fails, e.g. on an output line longer than
+    the limit of the stream, the process is terminated.
+    """
+    try:
+        if on_line is not None:
+            await _read_lines(process, on_line)
+        return await process.wait()
+    except BaseException:
+        if process.returncode is None:
+            try:
+                process.terminate()
+            except ProcessLookupError:
+                pass
+        await process.wait()
+        raise
+
+
+async def exec_and_monitor_cmd(cmd, on_line=None):
     usage = Usage()
     time_started = time.time()
 
-    process = await asyncio.create_subprocess_exec(*cmd)
+    process = await _start_process(cmd, on_line)
     asyncio.ensure_future(Executor.run(_monitor_pid, process.pid, usage))
 
-    try:
-        return_code = await process.wait()
-    except asyncio.CancelledError:
-        process.terminate()
-        raise
+    return_code = await _wait_for_process(process, on_line)
 
     usage.real_time = time.time() - time_started
     return return_code, usage
 
 
-async def exec_cmd(cmd):
-    process = await asyncio.create_subprocess_exec(*cmd)
-    try:
-        return await process.wait()
-    except asyncio.CancelledError:
-        process.terminate()
-        raise
+async def exec_cmd(cmd, on_line=None):
+    """
+    Runs the command and returns its exit code. If on_line is given, it is
+    called with each line of the command's output as soon as it is printed.
+    """
+    process = await _start_process(cmd, on_line)
+    return await _wait_for_process(process, on_line)
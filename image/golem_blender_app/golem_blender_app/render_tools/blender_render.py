@@ -1,9 +1,20 @@
+import asyncio
+import math
 import os
+import re
 import stat
 import sys
 from multiprocessing import cpu_count
 from subprocess import SubprocessError
-from typing import List
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    TYPE_CHECKING,
+)
 
 from golem_blender_app.process_tools import (
     exec_cmd,
@@ -13,8 +24,20 @@ from golem_blender_app.process_tools import (
 
 from . import scenefileeditor
 
+if TYPE_CHECKING:
+    # pylint: disable=cyclic-import
+    from .blender_worker import BlenderWorkerPool
+
 BLENDER_COMMAND = "blender"
 
+# Number of pixels of a crop which keeps one more render thread busy.
+# Threads which a crop can not use are given to crops rendered concurrently.
+PIXELS_PER_THREAD = 64 * 64
+
+# Blender prints e.g. "Saved: '/output/crop0_0001.png'" once it has written
+# a rendered frame.
+SAVED_FILE_PATTERN = re.compile(r"Saved: '(.+)'")
+
 
 # pylint: disable=too-many-arguments
 def format_blender_render_cmd(outfilebasename,
@@ -45,6 +68,27 @@ def format_blender_render_cmd(outfilebasename,
     return cmd
 
 
+def format_blender_session_cmd(scene_file,
+                               script_file,
+                               output_format,
+                               num_threads=cpu_count()) -> List[str]:
+    """
+    Command running a script which renders crops itself. Options are applied
+    in order, so the output format and threads are set before the script
+    is run, and exceptions in the script make Blender exit with an error.
+    """
+    return [
+        "{}".format(BLENDER_COMMAND),
+        "-b", "{}".format(scene_file),
+        "-y",  # enable scripting by default
+        "-noaudio",
+        "-F", "{}".format(output_format.upper()),
+        "-t", "{}".format(num_threads),
+        "--python-exit-code", "1",
+        "-P", "{}".format(script_file),
+    ]
+
+
 # Example parameters:
 # {
 #   "scene_file" : "scene.blend"
@@ -144,50 +188,257 @@ def gen_blender_command(parameters: dict,
     return cmd
 
 
+def get_crop_info(parameters: dict, crop: dict) -> dict:
+    """
+    Information about a rendered crop, with names of its files in OUTPUT_DIR,
+    one for each frame.
+    """
+    output_format = parameters["output_format"].lower()
+
+    results_list = list()
+    for frame in parameters["frames"]:
+        filename = crop["outfilebasename"] \
+            + "{:04d}.".format(frame) \
+            + output_format
+        results_list.append(filename)
+
+    crop_info: Dict[str, Any] = dict()
+    crop_info["crop"] = crop
+    crop_info["results"] = results_list
+    return crop_info
+
+
+class FrameReporter:
+    """
+    FrameReporter reports frames of crops as soon as Blender saves them,
+    by lines of its output passed to on_line(). on_frame_rendered is called
+    with information about a crop and the index of the frame in its results.
+    If on_crop_rendered is given, it is called once all frames of a crop are
+    reported. Each frame is reported once, and frames which Blender did not
+    report are reported by report_crop() when their crop is rendered.
+    """
+
+    def __init__(
+            self,
+            output_info: List[dict],
+            on_frame_rendered: Optional[Callable[[dict, int], None]] = None,
+            on_crop_rendered: Optional[Callable[[dict], None]] = None,
+    ) -> None:
+        self._output_info = output_info
+        self._on_frame_rendered = on_frame_rendered
+        self._on_crop_rendered = on_crop_rendered
+        self._frames = {
+            filename: (crop_index, frame_index)
+            for crop_index, crop_info in enumerate(output_info)
+            for frame_index, filename in enumerate(crop_info["results"])
+        }
+        self._pending = [
+            len(crop_info["results"]) for crop_info in output_info
+        ]
+
+    @property
+    def is_needed(self) -> bool:
+        return self._on_frame_rendered is not None \
+            or self._on_crop_rendered is not None
+
+    def on_line(self, line: str) -> None:
+        match = SAVED_FILE_PATTERN.search(line)
+        if match is not None:
+            self.report_file(os.path.basename(match.group(1)))
+
+    def report_file(self, filename: str) -> None:
+        frame = self._frames.pop(filename, None)
+        if frame is None:
+            return
+        crop_index, frame_index = frame
+        crop_info = self._output_info[crop_index]
+        if self._on_frame_rendered is not None:
+            self._on_frame_rendered(crop_info, frame_index)
+        self._pending[crop_index] -= 1
+        if self._pending[crop_index] == 0 \
+                and self._on_crop_rendered is not None:
+            self._on_crop_rendered(crop_info)
+
+    def report_crop(self, crop_info: dict) -> None:
+        for filename in crop_info["results"]:
+            self.report_file(filename)
+
+
+async def _exec_render_cmd(
+        cmd: List[str],
+        monitor_usage: bool,
+        on_line: Optional[Callable[[str], None]] = None,
+) -> Usage:
+    print(cmd, file=sys.stderr)
+    if monitor_usage:
+        exit_code, usage = await exec_and_monitor_cmd(cmd, on_line)
+    else:
+        exit_code, usage = await exec_cmd(cmd, on_line), Usage()
+
+    if exit_code != 0:
+        raise SubprocessError(
+            f'Render process exited with code {exit_code}')
+    return usage
+
+
+def get_crop_pixels(parameters: dict, crop: dict) -> int:
+    width, height = parameters["resolution"]
+    borders_x = crop["borders_x"]
+    borders_y = crop["borders_y"]
+    crop_width = width * (float(borders_x[1]) - float(borders_x[0]))
+    crop_height = height * (float(borders_y[1]) - float(borders_y[0]))
+    return int(crop_width * crop_height)
+
+
+def partition_threads(parameters: dict,
+                      crops: List[dict],
+                      num_cpus: int = cpu_count(),
+                      max_concurrency: Optional[int] = None
+                      ) -> Tuple[int, int]:
+    """
+    Splits CPUs between Blender processes rendering crops concurrently.
+    The largest crop gets a thread for every PIXELS_PER_THREAD pixels,
+    and as many crops are rendered at the same time as there are CPUs
+    for them, at most max_concurrency.
+    :return: (number of concurrent processes, threads of each process)
+    """
+    if not crops:
+        return 1, num_cpus
+    pixels = max(get_crop_pixels(parameters, crop) for crop in crops)
+    wanted_threads = min(
+        num_cpus,
+        max(1, math.ceil(pixels / PIXELS_PER_THREAD)),
+    )
+    concurrency = min(len(crops), max(1, num_cpus // wanted_threads))
+    if max_concurrency is not None:
+        concurrency = max(1, min(concurrency, max_concurrency))
+    return concurrency, max(1, num_cpus // concurrency)
+
+
 async def render(
         parameters: dict,
         mounted_paths: dict,
         monitor_usage: bool = False,
+        on_crop_rendered: Optional[Callable[[dict], None]] = None,
+        single_session: bool = False,
+        max_concurrency: Optional[int] = None,
+        worker_pool: Optional['BlenderWorkerPool'] = None,
+        on_frame_rendered: Optional[Callable[[dict, int], None]] = None,
 ) -> List[dict]:
+    """
+    Renders crops by Blender processes run concurrently, with CPUs split
+    between them, see partition_threads(). The list is in the order of
+    crops. If on_crop_rendered is given, it is called with information about
+    each crop as soon as it is rendered, the same as returned for it in
+    the list. If on_frame_rendered is given, it is called with information
+    about a crop and the index of a frame in its results as soon as Blender
+    saves the frame, see FrameReporter. Once rendering of any crop fails,
+    the others are cancelled.
+    With single_session, all crops are rendered by a single Blender process,
+    see render_in_single_session().
+    With a worker_pool, crops are rendered one after another by a Blender
+    process which keeps the scene loaded for later calls,
+    see blender_worker.BlenderWorker.
+    """
 
     crops = parameters["crops"]
+    if worker_pool is not None:
+        return await worker_pool.render(
+            parameters,
+            mounted_paths,
+            monitor_usage,
+            on_crop_rendered,
+            on_frame_rendered,
+        )
+    if single_session and len(crops) > 1:
+        return await render_in_single_session(
+            parameters,
+            mounted_paths,
+            monitor_usage,
+            on_crop_rendered,
+            on_frame_rendered,
+        )
+
+    concurrency, num_threads = partition_threads(
+        parameters, crops, max_concurrency=max_concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+    output_info = [get_crop_info(parameters, crop) for crop in crops]
+    reporter = FrameReporter(output_info, on_frame_rendered)
+    on_line = reporter.on_line if reporter.is_needed else None
+
+    async def render_crop(crop_counter: int, crop_info: dict) -> None:
+        async with semaphore:
+            crop = crop_info["crop"]
+            script_file = gen_blender_script_file(parameters,
+                                                  crop, mounted_paths,
+                                                  crop_counter)
+            cmd = gen_blender_command(parameters, crop, mounted_paths,
+                                      script_file, num_threads)
+            crop_info["usage"] = await _exec_render_cmd(
+                cmd, monitor_usage, on_line)
+
+        reporter.report_crop(crop_info)
+        if on_crop_rendered is not None:
+            on_crop_rendered(crop_info)
+
+    renders = [
+        asyncio.ensure_future(render_crop(crop_counter, crop_info))
+        for crop_counter, crop_info in enumerate(output_info)
+    ]
+    try:
+        await asyncio.gather(*renders)
+    finally:
+        # Cancelling a render terminates its Blender process, which is waited
+        # for so that no process outlives the call
+        for crop_render in renders:
+            crop_render.cancel()
+        await asyncio.wait(renders)
 
-    crop_counter = 0
-    output_info = list()
-
-    for crop in crops:
-
-        script_file = gen_blender_script_file(parameters,
-                                              crop, mounted_paths,
-                                              crop_counter)
-        cmd = gen_blender_command(parameters, crop, mounted_paths, script_file)
-
-        output_format = parameters["output_format"].lower()
-
-        results_list = list()
-        for frame in parameters["frames"]:
-            filename = crop["outfilebasename"] \
-                + "{:04d}.".format(frame) \
-                + output_format
-            results_list.append(filename)
-
-        crop_info = dict()
-        crop_info["crop"] = crop
-        crop_info["results"] = results_list
-
-        output_info.append(crop_info)
-
-        print(cmd, file=sys.stderr)
-        if monitor_usage:
-            exit_code, crop_info["usage"] = await exec_and_monitor_cmd(cmd)
-        else:
-            exit_code, crop_info["usage"] = await exec_cmd(cmd), Usage()
+    return output_info
 
-        if exit_code != 0:
-            raise SubprocessError(
-                f'Render process exited with code {exit_code}')
 
-        crop_counter += 1
+async def render_in_single_session(
+        parameters: dict,
+        mounted_paths: dict,
+        monitor_usage: bool = False,
+        on_crop_rendered: Optional[Callable[[dict], None]] = None,
+        on_frame_rendered: Optional[Callable[[dict, int], None]] = None,
+) -> List[dict]:
+    """
+    Renders all crops in a single Blender session, so the scene is loaded
+    and prepared for rendering only once. Returns the same information
+    as render(), except that usage of the whole session is reported only for
+    the first crop, once the session ends.
+    on_crop_rendered is called for each crop as soon as all its frames are
+    saved, which is before usage is known.
+    """
+    crops = parameters["crops"]
+    script_file = scenefileeditor.generate_blender_crops_file(
+        "scriptfile-crops-[count={}].py".format(len(crops)),
+        parameters["resolution"],
+        crops,
+        parameters["frames"],
+        parameters["use_compositing"],
+        parameters["samples"],
+        mounted_paths,
+    )
+    cmd = format_blender_session_cmd(
+        parameters["scene_file"],
+        script_file,
+        parameters["output_format"].lower(),
+    )
+    output_info = [get_crop_info(parameters, crop) for crop in crops]
+    reporter = FrameReporter(output_info, on_frame_rendered, on_crop_rendered)
+
+    usage = await _exec_render_cmd(
+        cmd,
+        monitor_usage,
+        reporter.on_line if reporter.is_needed else None,
+    )
+
+    output_info[0]["usage"] = usage
+    for crop_info in output_info:
+        reporter.report_crop(crop_info)
 
     return output_info
 
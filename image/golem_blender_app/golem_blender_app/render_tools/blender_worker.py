@@ -0,0 +1,302 @@
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+from multiprocessing import cpu_count
+from subprocess import SubprocessError
+from typing import Callable, Dict, List, Optional, Tuple
+
+from psutil import NoSuchProcess, Process
+
+from golem_blender_app.process_tools import Usage
+
+from . import blender_render, scenefileeditor
+
+REPLY_PREFIX = "GOLEM_BLENDER_WORKER_REPLY:"
+DEFAULT_MAX_WORKERS = 2
+MONITOR_INTERVAL = 0.5
+
+
+class BlenderWorker:
+    """
+    BlenderWorker is a Blender process which keeps a scene file loaded and
+    renders crops sent to it one at a time, see blenderworker.py.template.
+    The process is started by the first render() and is closed when any
+    render fails or is cancelled, as its state is unknown then. The next
+    render() starts a new one.
+    """
+
+    def __init__(self,
+                 scene_file,
+                 output_format: str,
+                 num_threads: int = cpu_count()) -> None:
+        self.scene_file = str(scene_file)
+        self.output_format = output_format.lower()
+        self._num_threads = num_threads
+        self._process: Optional[asyncio.subprocess.Process] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._job_id = 0
+
+    @property
+    def is_running(self) -> bool:
+        return self._process is not None \
+            and self._process.returncode is None
+
+    @property
+    def is_busy(self) -> bool:
+        return self._lock is not None and self._lock.locked()
+
+    async def render(
+            self,
+            parameters: dict,
+            mounted_paths: dict,
+            monitor_usage: bool = False,
+            on_crop_rendered: Optional[Callable[[dict], None]] = None,
+            on_frame_rendered: Optional[Callable[[dict, int], None]] = None,
+    ) -> List[dict]:
+        """
+        Renders crops the same as blender_render.render(), into OUTPUT_DIR
+        of the mounted paths. Usage of the process is reported for each crop.
+        """
+        if str(parameters["scene_file"]) != self.scene_file \
+                or parameters["output_format"].lower() != self.output_format:
+            raise ValueError(
+                "Blender worker renders {} to {}, not {} to {}".format(
+                    self.scene_file, self.output_format,
+                    parameters["scene_file"], parameters["output_format"]))
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            try:
+                if not self.is_running:
+                    await self._start(parameters, mounted_paths)
+                output_info = [
+                    blender_render.get_crop_info(parameters, crop)
+                    for crop in parameters["crops"]
+                ]
+                reporter = blender_render.FrameReporter(
+                    output_info, on_frame_rendered)
+                for crop_info in output_info:
+                    crop_info["usage"] = await self._render_crop(
+                        parameters,
+                        crop_info["crop"],
+                        mounted_paths,
+                        monitor_usage,
+                        reporter.on_line,
+                    )
+                    reporter.report_crop(crop_info)
+                    if on_crop_rendered is not None:
+                        on_crop_rendered(crop_info)
+            except BaseException:
+                await self.close()
+                raise
+        return output_info
+
+    async def _start(self, parameters: dict, mounted_paths: dict) -> None:
+        crop = parameters["crops"][0]
+        script_file = scenefileeditor.generate_blender_worker_file(
+            "scriptfile-worker.py",
+            parameters["resolution"],
+            crop["borders_x"],
+            crop["borders_y"],
+            parameters["use_compositing"],
+            mounted_paths,
+            REPLY_PREFIX,
+        )
+        cmd = blender_render.format_blender_session_cmd(
+            self.scene_file,
+            script_file,
+            self.output_format,
+            self._num_threads,
+        )
+        print(cmd, file=sys.stderr)
+        self._process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+        )
+
+    async def _render_crop(self,
+                           parameters: dict,
+                           crop: dict,
+                           mounted_paths: dict,
+                           monitor_usage: bool,
+                           on_line: Callable[[str], None]) -> Usage:
+        process = self._process
+        if process is None or process.stdin is None:
+            raise SubprocessError('Blender worker is not running')
+        self._job_id += 1
+        job = {
+            "id": self._job_id,
+            "resolution_x": int(parameters["resolution"][0]),
+            "resolution_y": int(parameters["resolution"][1]),
+            "border_min_x": float(crop["borders_x"][0]),
+            "border_max_x": float(crop["borders_x"][1]),
+            "border_min_y": float(crop["borders_y"][0]),
+            "border_max_y": float(crop["borders_y"][1]),
+            "use_compositing": bool(parameters["use_compositing"]),
+            "samples": int(parameters["samples"]),
+            "frames": [int(frame) for frame in parameters["frames"]],
+            "output": os.path.join(mounted_paths["OUTPUT_DIR"],
+                                   crop["outfilebasename"]),
+        }
+        usage = Usage()
+        monitor = None
+        if monitor_usage:
+            monitor = asyncio.ensure_future(
+                _monitor_process(process.pid, usage))
+        time_started = time.time()
+        try:
+            process.stdin.write((json.dumps(job) + "\n").encode())
+            await process.stdin.drain()
+            reply = await self._read_reply(process, on_line)
+        finally:
+            if monitor is not None:
+                monitor.cancel()
+        usage.real_time = time.time() - time_started
+
+        if reply.get("id") != job["id"]:
+            raise SubprocessError(
+                f'Blender worker replied to job {reply.get("id")} '
+                f'instead of {job["id"]}')
+        if reply.get("error"):
+            raise SubprocessError(
+                f'Blender worker failed to render: {reply["error"]}')
+        return usage
+
+    @staticmethod
+    async def _read_reply(
+            process: asyncio.subprocess.Process,
+            on_line: Callable[[str], None]
+    ) -> dict:
+        if process.stdout is None:
+            raise SubprocessError('Blender worker is not running')
+        while True:
+            data = await process.stdout.readline()
+            if not data:
+                exit_code = await process.wait()
+                raise SubprocessError(
+                    f'Blender worker exited with code {exit_code}')
+            line = data.decode("utf-8", "replace")
+            if line.startswith(REPLY_PREFIX):
+                return json.loads(line[len(REPLY_PREFIX):])
+            # Other output of Blender is passed on, as for other renders
+            sys.stdout.write(line)
+            on_line(line)
+
+    async def close(self) -> None:
+        process, self._process = self._process, None
+        if process is None:
+            return
+        if process.returncode is None:
+            try:
+                process.terminate()
+            except ProcessLookupError:
+                pass
+        await process.wait()
+
+
+async def _monitor_process(pid: int, usage: Usage) -> None:
+    """
+    Measures usage of the process from now on, until cancelled. mem_peak
+    includes memory taken by the scene loaded before.
+    """
+    try:
+        proc = Process(pid)
+        cpu_time_started = sum(proc.cpu_times())
+        while True:
+            usage.cpu_time = sum(proc.cpu_times()) - cpu_time_started
+            usage.mem_peak = max(usage.mem_peak, proc.memory_info().vms)
+            await asyncio.sleep(MONITOR_INTERVAL)
+    except NoSuchProcess:
+        pass
+
+
+class BlenderWorkerPool:
+    """
+    BlenderWorkerPool keeps Blender workers of the most recently rendered
+    scene files. A worker is reused for the same path, size and modification
+    time of the scene file and the same output format. Least recently used
+    idle workers are closed once there are more than max_workers of them.
+    """
+
+    def __init__(self,
+                 max_workers: int = DEFAULT_MAX_WORKERS,
+                 num_threads: int = cpu_count()) -> None:
+        if max_workers < 1:
+            raise ValueError(f"max_workers must be positive: {max_workers}")
+        self._max_workers = max_workers
+        self._num_threads = num_threads
+        self._workers: Dict[Tuple[str, int, int, str], BlenderWorker] \
+            = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._workers)
+
+    async def render(
+            self,
+            parameters: dict,
+            mounted_paths: dict,
+            monitor_usage: bool = False,
+            on_crop_rendered: Optional[Callable[[dict], None]] = None,
+            on_frame_rendered: Optional[Callable[[dict, int], None]] = None,
+    ) -> List[dict]:
+        """
+        Renders crops by the worker of the scene file, see
+        BlenderWorker.render().
+        """
+        worker = self._get_worker(
+            parameters["scene_file"], parameters["output_format"])
+        await self._evict(keep=worker)
+        return await worker.render(
+            parameters,
+            mounted_paths,
+            monitor_usage,
+            on_crop_rendered,
+            on_frame_rendered,
+        )
+
+    def _get_worker(self, scene_file, output_format: str) -> BlenderWorker:
+        stat = os.stat(str(scene_file))
+        key = (
+            str(scene_file),
+            stat.st_size,
+            stat.st_mtime_ns,
+            output_format.lower(),
+        )
+        worker = self._workers.pop(key, None)
+        if worker is None:
+            worker = BlenderWorker(
+                scene_file, output_format, self._num_threads)
+        self._workers[key] = worker
+        return worker
+
+    async def _evict(self, keep: BlenderWorker) -> None:
+        idle = [
+            key for key, worker in self._workers.items()
+            if worker is not keep and not worker.is_busy
+        ]
+        for key in idle[:max(0, len(self._workers) - self._max_workers)]:
+            await self._workers.pop(key).close()
+
+    async def close(self) -> None:
+        while self._workers:
+            _, worker = self._workers.popitem()
+            await worker.close()
+
+
+_default_pool: Optional[BlenderWorkerPool] = None
+
+
+def get_default_pool() -> BlenderWorkerPool:
+    """
+    Pool of workers of the current process. They exit with it, once their
+    stdin is closed.
+    """
+    global _default_pool  # pylint: disable=global-statement
+    if _default_pool is None:
+        _default_pool = BlenderWorkerPool()
+    return _default_pool
@@ -4,6 +4,14 @@ BLENDER_CROP_TEMPLATE_PATH \
     = os.path.join(os.path.dirname(os.path.realpath(__file__)),
                    "templates",
                    "blendercrop.py.template")
+BLENDER_CROPS_TEMPLATE_PATH \
+    = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                   "templates",
+                   "blendercrops.py.template")
+BLENDER_WORKER_TEMPLATE_PATH \
+    = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                   "templates",
+                   "blenderworker.py.template")
 
 
 def get_generated_files_path(mounted_paths: dict):
@@ -28,6 +36,74 @@ def generate_blender_crop_file(script_file_out,
                                           samples,
                                           override_output)
 
+    return _write_blender_script(script_file_out, content, mounted_paths)
+
+
+# pylint: disable-msg=too-many-arguments
+def generate_blender_crops_file(script_file_out,
+                                resolution,
+                                crops,
+                                frames,
+                                use_compositing,
+                                samples,
+                                mounted_paths):
+    """
+    Generates a script rendering frames of all crops in a single Blender
+    session, into OUTPUT_DIR. Crops are dicts with outfilebasename,
+    borders_x and borders_y.
+    """
+    content = _generate_blender_crop_file(BLENDER_CROP_TEMPLATE_PATH,
+                                          resolution,
+                                          crops[0]["borders_x"],
+                                          crops[0]["borders_y"],
+                                          use_compositing,
+                                          samples)
+
+    with open(BLENDER_CROPS_TEMPLATE_PATH) as f:
+        content += f.read() % {
+            'crops': [
+                {
+                    'outfilebasename': crop["outfilebasename"],
+                    'border_min_x': float(crop["borders_x"][0]),
+                    'border_max_x': float(crop["borders_x"][1]),
+                    'border_min_y': float(crop["borders_y"][0]),
+                    'border_max_y': float(crop["borders_y"][1]),
+                }
+                for crop in crops
+            ],
+            'frames': [int(frame) for frame in frames],
+            'output_dir': mounted_paths["OUTPUT_DIR"],
+        }
+
+    return _write_blender_script(script_file_out, content, mounted_paths)
+
+
+# pylint: disable-msg=too-many-arguments
+def generate_blender_worker_file(script_file_out,
+                                 resolution,
+                                 borders_x,
+                                 borders_y,
+                                 use_compositing,
+                                 mounted_paths,
+                                 reply_prefix):
+    """
+    Generates a script which keeps the scene loaded and renders jobs read
+    from stdin. Samples of the scene are kept, each job sets its own.
+    """
+    content = _generate_blender_crop_file(BLENDER_CROP_TEMPLATE_PATH,
+                                          resolution,
+                                          borders_x,
+                                          borders_y,
+                                          use_compositing,
+                                          0)
+
+    with open(BLENDER_WORKER_TEMPLATE_PATH) as f:
+        content += f.read() % {'reply_prefix': reply_prefix}
+
+    return _write_blender_script(script_file_out, content, mounted_paths)
+
+
+def _write_blender_script(script_file_out, content, mounted_paths):
     scripts_dir = get_generated_files_path(mounted_paths)
     if not os.path.isdir(scripts_dir):
         os.mkdir(scripts_dir)
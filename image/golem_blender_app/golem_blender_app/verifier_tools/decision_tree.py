@@ -1,40 +1,181 @@
+import sys
 import numpy
-from sklearn.externals import joblib
+
+
+TREE_LEAF = -1
 
 
 ## ======================= ##
 ##
 class DecisionTree:
-    
+    """
+    DecisionTree is a compiled, dependency-free form of a scikit-learn
+    DecisionTreeClassifier. Every node is described by its feature index,
+    threshold, left and right child (TREE_LEAF for leaves) and the label
+    predicted when the node is a leaf.
+    """
+
     ## ======================= ##
     ##
-    def __init__(self, classifier):
-        self.classifier = classifier
-        
+    def __init__(
+            self,
+            feature,
+            threshold,
+            children_left,
+            children_right,
+            leaf_class,
+            classes
+    ):
+        self.feature = numpy.asarray(feature, dtype=numpy.intp)
+        self.threshold = numpy.asarray(threshold, dtype=numpy.float64)
+        self.children_left = numpy.asarray(children_left, dtype=numpy.intp)
+        self.children_right = numpy.asarray(children_right, dtype=numpy.intp)
+        self.leaf_class = numpy.asarray(leaf_class, dtype=numpy.intp)
+        self.classes = numpy.asarray(classes, dtype=str)
+
     ## ======================= ##
     ##
     @staticmethod
     def load(file):
-        data = joblib.load(file)
-        tree = DecisionTree(data[0])
+        with numpy.load(str(file), allow_pickle=False) as data:
+            tree = DecisionTree(
+                data['feature'],
+                data['threshold'],
+                data['children_left'],
+                data['children_right'],
+                data['leaf_class'],
+                data['classes'],
+            )
+            labels = data['labels'].tolist()
+
+        return tree, labels
+
+    ## ======================= ##
+    ##
+    def save(self, file, labels):
+        numpy.savez(
+            str(file),
+            feature=self.feature,
+            threshold=self.threshold,
+            children_left=self.children_left,
+            children_right=self.children_right,
+            leaf_class=self.leaf_class,
+            classes=self.classes,
+            labels=numpy.asarray(labels, dtype=str),
+        )
+
+    ## ======================= ##
+    ##
+    @staticmethod
+    def from_classifier(classifier):
+        """
+        Compiles a fitted scikit-learn DecisionTreeClassifier
+        with a single output.
+        """
+        tree = classifier.tree_
+        return DecisionTree(
+            tree.feature,
+            tree.threshold,
+            tree.children_left,
+            tree.children_right,
+            numpy.argmax(tree.value[:, 0], axis=1),
+            [
+                c.decode('utf-8') if isinstance(c, bytes) else str(c)
+                for c in classifier.classes_
+            ],
+        )
+
+    ## ======================= ##
+    ##
+    def classify(self, samples, invalid_label=None):
+        """
+        Classifies a batch of samples.
+        :param samples: (N, F) matrix of features, in order of labels
+        :param invalid_label: label of samples with features which are not
+        finite, e.g. missing features given as NaN. By default, such samples
+        raise ValueError.
+        :return: array of N labels
+        """
+        # Features are compared as float32, the same as in scikit-learn
+        samples = numpy.asarray(samples, dtype=numpy.float32)
+        if samples.ndim != 2:
+            raise ValueError("Expected (samples, features) matrix")
+        valid = numpy.isfinite(samples).all(axis=1)
+        if invalid_label is None and not valid.all():
+            raise ValueError("Features are not finite")
+
+        nodes = numpy.zeros(len(samples), dtype=numpy.intp)
+        # Invalid samples stay at the root and are labeled at the end
+        rows = numpy.flatnonzero(valid)
+        nodes_valid = nodes[rows]
+        while True:
+            inner = self.children_left[nodes_valid] != TREE_LEAF
+            if not inner.any():
+                break
+            rows = rows[inner]
+            nodes_inner = nodes_valid[inner]
+            go_left = samples[rows, self.feature[nodes_inner]] \
+                <= self.threshold[nodes_inner]
+            nodes_valid = numpy.where(
+                go_left,
+                self.children_left[nodes_inner],
+                self.children_right[nodes_inner],
+            )
+            nodes[rows] = nodes_valid
+
+        labels = self.classes[self.leaf_class[nodes]]
+        if invalid_label is not None:
+            labels = numpy.where(valid, labels, invalid_label)
+        return labels
 
-        return tree, data[1]
-    
     ## ======================= ##
-    ##   
+    ##
     def classify_with_feature_vector(self, feature_vector, labels):
+        samples = [[feature_vector[label] for label in labels]]
+        return self.classify(samples)
+
+    ## ======================= ##
+    ##
+    def classify_lazily(self, get_feature, labels):
+        """
+        Classifies a single sample walking the tree from its root, so
+        get_feature(label) is called only for features on the decision path.
+        Features are compared as float32, the same as in classify().
+        """
+        node = 0
+        while self.children_left[node] != TREE_LEAF:
+            label = labels[self.feature[node]]
+            value = numpy.float32(get_feature(label))
+            if not numpy.isfinite(value):
+                raise ValueError(
+                    "Feature {} is not finite: {!r}".format(label, value))
+            if value <= self.threshold[node]:
+                node = self.children_left[node]
+            else:
+                node = self.children_right[node]
 
-        numpy_format = []
-        for label in labels:
-            numpy_format.append((label, numpy.float64))
-        
-        converted_features = numpy.zeros(1, dtype=numpy_format)
-        for name in converted_features.dtype.names:
-            converted_features[name] = feature_vector[name]
+        return self.classes[self.leaf_class[node]]
 
-        samples = converted_features.view(numpy.float64).reshape(
-            converted_features.shape + (-1,))
 
-        results = self.classifier.predict(samples)
+## ======================= ##
+##
+def export(classifier_file, tree_file):
+    """
+    Compiles a classifier pickled with joblib as [classifier, labels, ...]
+    to a file read by DecisionTree.load(). It is run when the classifier
+    changes, as it needs scikit-learn in the version the classifier was
+    pickled with, which is not needed at runtime.
+    """
+    from sklearn.externals import joblib
+    data = joblib.load(classifier_file)
+    DecisionTree.from_classifier(data[0]).save(tree_file, data[1])
+
+
+## ======================= ##
+##
+def run():
+    export(sys.argv[1], sys.argv[2])
+
 
-        return numpy.array(results)
+if __name__ == "__main__":
+    run()
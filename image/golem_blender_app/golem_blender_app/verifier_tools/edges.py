@@ -1,31 +1,24 @@
-from PIL import Image, ImageFilter
-import numpy
-from .skimage import compare_mse
+from PIL import Image
+from .image_pair import ImagePair, PairMetric
 
 import sys
 
 
 ## ======================= ##
 ##
-class MetricEdgeFactor:
+class MetricEdgeFactor(PairMetric):
 
     ## ======================= ##
     ##
     @staticmethod
-    def compute_metrics(image1, image2):
-        image1 = image1.convert("RGB")
-        image2 = image2.convert("RGB")
+    def compute_pair_metrics(pair: ImagePair):
+        # Edges are found as by PIL.ImageFilter.FIND_EDGES
+        statistics = pair.statistics
 
-        edged_image1 = image1.filter(ImageFilter.FIND_EDGES)
-        edged_image2 = image2.filter(ImageFilter.FIND_EDGES)
+        reference_edge_factor = statistics.edge_means[0]
+        computed_edge_factor = statistics.edge_means[1]
 
-        np_image1 = numpy.array(edged_image1)
-        np_image2 = numpy.array(edged_image2)
-
-        reference_edge_factor = numpy.mean(np_image1)
-        computed_edge_factor = numpy.mean(np_image2)
-
-        edge_factor = compare_mse(np_image1, np_image2)
+        edge_factor = statistics.edge_mse
 
         result = dict()
         result["ref_edge_factor"] = reference_edge_factor
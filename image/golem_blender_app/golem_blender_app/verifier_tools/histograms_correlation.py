@@ -1,22 +1,36 @@
-import cv2
 import numpy
 from PIL import Image
 import sys
 
+from .image_pair import ImagePair, PairMetric
 
-class MetricHistogramsCorrelation:
+
+NUMBER_OF_BINS = 256
+TOTAL_BINS = NUMBER_OF_BINS ** 3
+DBL_EPSILON = numpy.finfo(numpy.float64).eps
+# Approximate memory used per pixel of a tile
+HISTOGRAMS_BYTES_PER_PIXEL = 96
+
+
+class MetricHistogramsCorrelation(PairMetric):
 
     @staticmethod
-    def compute_metrics(image1, image2):
-        if image1.size != image2.size:
-            raise Exception("Image sizes differ")
-        opencv_image_1 = cv2.cvtColor(numpy.array(image1), cv2.COLOR_RGB2BGR)
-        opencv_image_2 = cv2.cvtColor(numpy.array(image2), cv2.COLOR_RGB2BGR)
+    def compute_pair_metrics(pair: ImagePair):
+        # Channels order does not need to be changed to BGR, as it permutes
+        # axes of both histograms in the same way and correlation is
+        # computed over all bins.
+        bins, counts_a, counts_b = \
+            MetricHistogramsCorrelation.merge_bin_counts(
+                MetricHistogramsCorrelation.count_bins(*tile.images)
+                for tile in pair.row_tiles(HISTOGRAMS_BYTES_PER_PIXEL)
+            )
         return {
             "histograms_correlation":
-                MetricHistogramsCorrelation.compare_histograms(
-                    opencv_image_1,
-                    opencv_image_2
+                MetricHistogramsCorrelation.correlate_histograms(
+                    MetricHistogramsCorrelation.calculate_normalized_histogram(
+                        counts_a, len(bins)),
+                    MetricHistogramsCorrelation.calculate_normalized_histogram(
+                        counts_b, len(bins)),
                 )
         }
 
@@ -30,25 +44,136 @@ class MetricHistogramsCorrelation:
         return height * width
 
     @staticmethod
-    def calculate_normalized_histogram(image):
-        number_of_bins = 256
-        channels_number = 3  # because of conversion from PIL to opencv
-        histogram = cv2.calcHist([image],
-                                 range(channels_number),
-                                 None,
-                                 [number_of_bins] * channels_number,
-                                 [0, 256] * channels_number)
-        cv2.normalize(histogram, histogram, 0, 256, cv2.NORM_MINMAX)
-        return histogram
+    def calculate_bin_indices(image):
+        """
+        Maps each pixel to the index of its bin in a 3-channel histogram
+        with NUMBER_OF_BINS bins per channel.
+        """
+        pixels = image.reshape(-1, image.shape[-1]).astype(numpy.uint32)
+        return (pixels[:, 0] * NUMBER_OF_BINS + pixels[:, 1]) \
+            * NUMBER_OF_BINS + pixels[:, 2]
+
+    @staticmethod
+    def count_bins(image_a, image_b):
+        """
+        Counts pixels of both images in bins occupied by any of them.
+        :return: (bins, counts_a, counts_b) with sorted indices of occupied
+        bins and numbers of pixels of each image in them
+        """
+        bin_indices_a = MetricHistogramsCorrelation.calculate_bin_indices(
+            image_a)
+        bin_indices_b = MetricHistogramsCorrelation.calculate_bin_indices(
+            image_b)
+        bins, inverse = numpy.unique(
+            numpy.concatenate([bin_indices_a, bin_indices_b]),
+            return_inverse=True
+        )
+        inverse = inverse.reshape(-1)
+        counts_a = numpy.bincount(
+            inverse[:len(bin_indices_a)],
+            minlength=len(bins)
+        )
+        counts_b = numpy.bincount(
+            inverse[len(bin_indices_a):],
+            minlength=len(bins)
+        )
+        return bins, counts_a, counts_b
+
+    @staticmethod
+    def merge_bin_counts(bin_counts):
+        """
+        Merges results of count_bins() for tiles of images into counts
+        for whole images.
+        """
+        bin_counts = iter(bin_counts)
+        bins, counts_a, counts_b = next(bin_counts)
+        for tile_bins, tile_counts_a, tile_counts_b in bin_counts:
+            merged_bins = numpy.concatenate([bins, tile_bins])
+            # Both parts are sorted, so a stable sort only merges them
+            order = numpy.argsort(merged_bins, kind='mergesort')
+            merged_bins = merged_bins[order]
+            is_first = numpy.ones(len(merged_bins), dtype=bool)
+            is_first[1:] = merged_bins[1:] != merged_bins[:-1]
+            starts = numpy.flatnonzero(is_first)
+            bins = merged_bins[starts]
+            counts_a = numpy.add.reduceat(
+                numpy.concatenate([counts_a, tile_counts_a])[order],
+                starts
+            )
+            counts_b = numpy.add.reduceat(
+                numpy.concatenate([counts_b, tile_counts_b])[order],
+                starts
+            )
+        return bins, counts_a, counts_b
+
+    @staticmethod
+    def calculate_sparse_histograms(image_a, image_b):
+        """
+        Calculates histograms of both images only over bins occupied by
+        any of their pixels, so memory is proportional to the number of
+        pixels instead of NUMBER_OF_BINS ** 3.
+        :return: (histogram_a, histogram_b) float32 arrays with counts of
+        pixels in the same bins, normalized as calculate_normalized_histogram()
+        """
+        bins, counts_a, counts_b = MetricHistogramsCorrelation.count_bins(
+            image_a, image_b)
+        return (
+            MetricHistogramsCorrelation.calculate_normalized_histogram(
+                counts_a, len(bins)),
+            MetricHistogramsCorrelation.calculate_normalized_histogram(
+                counts_b, len(bins)),
+        )
+
+    @staticmethod
+    def calculate_normalized_histogram(counts, occupied_bins):
+        """
+        Scales occupied bins of a histogram to range [0, 256], the same as
+        cv2.normalize() with NORM_MINMAX does for the dense histogram.
+        Bins not present in counts are empty, so they are the minimum unless
+        all bins are occupied.
+        """
+        minimum = 0
+        if occupied_bins == TOTAL_BINS:
+            minimum = counts.min()
+        difference = counts.max() - minimum
+        scale = 256.0 / difference if difference > DBL_EPSILON else 0.0
+        shift = -minimum * scale
+        return (
+            counts.astype(numpy.float32) * numpy.float32(scale)
+            + numpy.float32(shift)
+        )
 
     @staticmethod
     def compare_histograms(image_a, image_b):
-        histogram_a = MetricHistogramsCorrelation\
-            .calculate_normalized_histogram(image_a)
-        histogram_b = MetricHistogramsCorrelation\
-            .calculate_normalized_histogram(image_b)
-        result = cv2.compareHist(histogram_a, histogram_b, cv2.HISTCMP_CORREL)
-        return result
+        """
+        Computes the same value as cv2.compareHist() with HISTCMP_CORREL for
+        dense normalized histograms of both images.
+        """
+        return MetricHistogramsCorrelation.correlate_histograms(
+            *MetricHistogramsCorrelation.calculate_sparse_histograms(
+                image_a, image_b)
+        )
+
+    @staticmethod
+    def correlate_histograms(histogram_a, histogram_b):
+        """
+        Computes HISTCMP_CORREL of histograms over the same occupied bins.
+        Empty bins do not change any of the sums, only the total number
+        of bins.
+        """
+        histogram_a = histogram_a.astype(numpy.float64)
+        histogram_b = histogram_b.astype(numpy.float64)
+        sum_a = histogram_a.sum()
+        sum_b = histogram_b.sum()
+        square_sum_a = numpy.dot(histogram_a, histogram_a)
+        square_sum_b = numpy.dot(histogram_b, histogram_b)
+        numerator = numpy.dot(histogram_a, histogram_b) \
+            - sum_a * sum_b / TOTAL_BINS
+        denominator = (square_sum_a - sum_a * sum_a / TOTAL_BINS) \
+            * (square_sum_b - sum_b * sum_b / TOTAL_BINS)
+        if abs(denominator) <= DBL_EPSILON:
+            return 1.0
+        return float(numerator / numpy.sqrt(denominator))
 
 
 def run():
@@ -1,26 +1,175 @@
 import numpy as np
+import PIL
 from PIL import Image
 import OpenEXR
 
 import Imath
 
 
-# converting .exr file to .png if user gave .exr file as a rendered scene
-def convert_exr_to_png(exr_file, png_file):
+SRGB_LINEAR_THRESHOLD = 0.0031308
+
+
+def encode_srgb(linear):
+    """
+    Encodes linear values to 8-bit sRGB, the same as converting them to
+    a PIL "F" image with values scaled to [0, 255] and then to "L",
+    which clips values and truncates them to integers.
+    All operations are done on float32 arrays in the same order as
+    the scalar formula, so results do not depend on the implementation.
+    NaN values are encoded as 0.
+    :param linear: float32 array of any shape, modified in place
+    :return: uint8 array of the same shape
+    """
+    low = linear <= SRGB_LINEAR_THRESHOLD
+    with np.errstate(invalid='ignore'):
+        encoded = np.power(linear, np.float32(1.0 / 2.4))
+    encoded *= np.float32(1.055)
+    encoded -= np.float32(0.055)
+    np.multiply(linear, np.float32(12.92), out=encoded, where=low)
+    encoded *= np.float32(255.0)
+    np.fmax(encoded, 0, out=encoded)
+    np.minimum(encoded, 255, out=encoded)
+    return encoded.astype(np.uint8)
+
+
+def read_exr(exr_file, rows=None):
+    """
+    Reads RGB channels of an .exr file.
+    :param rows: (top, bottom) range of rows to read, relative to the data
+    window. By default, all rows are read.
+    :return: float32 array of shape (height, width, 3) with linear values
+    """
     file = OpenEXR.InputFile(str(exr_file))
     pixel_type = Imath.PixelType(Imath.PixelType.FLOAT)
     data_window = file.header()['dataWindow']
-    size = (data_window.max.x - data_window.min.x + 1,
-            data_window.max.y - data_window.min.y + 1)
-    rgb = [np.frombuffer(file.channel(color, pixel_type), dtype=np.float32) for
-           color in 'RGB']
-    for i in range(3):
-        rgb[i] = np.where(rgb[i] <= 0.0031308,
-                          (rgb[i] * 12.92) * 255.0,
-                          (1.055 * (rgb[i] ** (1.0 / 2.4)) - 0.055) * 255.0)
-    rgb_8 = [Image.frombytes("F", size, color.tostring()).convert("L") for color
-             in rgb]
-    Image.merge("RGB", rgb_8).save(png_file, "PNG")
+    width = data_window.max.x - data_window.min.x + 1
+    height = data_window.max.y - data_window.min.y + 1
+    top, bottom = rows if rows is not None else (0, height)
+    top, bottom = max(top, 0), min(bottom, height)
+    if top >= bottom:
+        return np.empty((0, width, 3), dtype=np.float32)
+    rgb = np.empty((bottom - top, width, 3), dtype=np.float32)
+    channels = file.channels(
+        'RGB',
+        pixel_type,
+        data_window.min.y + top,
+        data_window.min.y + bottom - 1
+    )
+    for i, channel in enumerate(channels):
+        rgb[..., i] = np.frombuffer(channel, dtype=np.float32) \
+            .reshape(bottom - top, width)
+    return rgb
+
+
+def read_exr_as_srgb_image(exr_file, rows=None):
+    """
+    Reads an .exr file as an 8-bit RGB image, without writing it to disk.
+    """
+    return Image.fromarray(encode_srgb(read_exr(exr_file, rows)), "RGB")
+
+
+# Partial decoding relies on layouts of tiles of decoders and on the size
+# of an image being writable, which are not a part of Pillow's API. They are
+# known for these major versions, images are decoded whole with others.
+PARTIAL_DECODING_PILLOW_VERSIONS = range(6, 13)
+
+
+def _get_pillow_major_version():
+    try:
+        return int(PIL.__version__.split('.')[0])
+    except (AttributeError, ValueError):
+        return None
+
+
+PARTIAL_DECODING = \
+    _get_pillow_major_version() in PARTIAL_DECODING_PILLOW_VERSIONS
+
+# Bytes per pixel of raw modes of TGA images, which can be seeked to a row
+_RAW_BYTES_PER_PIXEL = {
+    'L': 1,
+    'P': 1,
+    'BGR': 3,
+    'BGRA': 4,
+}
+
+
+def _get_rows_tile(image, top, bottom):
+    """
+    Finds a tile decoding at least rows [top, bottom) of an image, for
+    decoders which stream rows: non-interlaced PNG and TGA.
+    :return: (tile, size of decoded image, its rows in [top, bottom)),
+    or None if the whole image needs to be decoded
+    """
+    width, height = image.size
+    if len(image.tile) != 1:
+        return None
+    name, extents, offset, args = image.tile[0]
+    if tuple(extents) != (0, 0, width, height):
+        return None
+    if image.format == 'PNG' and name == 'zip' \
+            and not image.info.get('interlace'):
+        # Rows are compressed as a single stream, decoding stops after
+        # the last needed one
+        return (
+            (name, (0, 0, width, bottom), offset, args),
+            (width, bottom),
+            slice(top, bottom),
+        )
+    if image.format != 'TGA':
+        return None
+    if name == 'raw' and len(args) == 3 \
+            and args[0] in _RAW_BYTES_PER_PIXEL:
+        # Rows are of the same size, so the first needed one is seeked to
+        rawmode, stride, orientation = args
+        stride = stride or width * _RAW_BYTES_PER_PIXEL[rawmode]
+        first_row = top if orientation > 0 else height - bottom
+        return (
+            (name, (0, 0, width, bottom - top), offset + first_row * stride,
+             args),
+            (width, bottom - top),
+            slice(0, bottom - top),
+        )
+    if name == 'tga_rle':
+        # Run-length encoded rows are decoded from the first one in the file
+        if args[1] > 0:
+            return (
+                (name, (0, 0, width, bottom), offset, args),
+                (width, bottom),
+                slice(top, bottom),
+            )
+        return (
+            (name, (0, 0, width, height - top), offset, args),
+            (width, height - top),
+            slice(0, bottom - top),
+        )
+    return None
+
+
+def read_rows(image, top, bottom):
+    """
+    Decodes rows [top, bottom) of an image opened by PIL.Image.open().
+    Decoding of non-interlaced PNG and TGA images stops after the last
+    needed row, if PARTIAL_DECODING is supported by the installed Pillow,
+    other images are decoded whole. The image can not be used afterwards.
+    :return: image of the rows, of the same width
+    """
+    width, height = image.size
+    top, bottom = max(top, 0), min(bottom, height)
+    region = None
+    if PARTIAL_DECODING and top < bottom:
+        region = _get_rows_tile(image, top, bottom)
+    if region is None:
+        return image.crop((0, top, width, max(top, bottom)))
+    tile, size, rows = region
+    image.tile = [tile]
+    image._size = size  # pylint: disable=protected-access
+    image.load()
+    return image.crop((0, rows.start, width, rows.stop))
+
+
+# converting .exr file to .png if user gave .exr file as a rendered scene
+def convert_exr_to_png(exr_file, png_file):
+    read_exr_as_srgb_image(exr_file).save(png_file, "PNG")
 
 
 # converting .tga file to .png if user gave .tga file as a rendered scene
@@ -1,60 +1,59 @@
 import io
-import os
 import json
 import numpy as np
-import sys
 
+# Files written by write_verdict() to the output directory of a verification
+VERDICT_FILENAME = 'verdict.json'
+METRICS_FILENAME = 'metrics.json'
+USAGE_FILENAME = 'usage.json'
 
-class MyEncoder(json.JSONEncoder):
-    def default(self, obj):
-        print("There were obj %r" % obj, file=sys.stderr)
-
-        if isinstance(obj, np.integer):
-            return int(obj)
-        elif isinstance(obj, np.float32):
-            return float(obj)
-        elif isinstance(obj, np.float64):
-            return float(obj)
-        elif isinstance(obj, np.ndarray):
-            return obj.tolist()
-        else:
-            return obj.__dict__
+def _to_builtin(value):
+    # Metrics are often numpy scalars, which json can not serialize
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
 
 
 class ImgageMetrics:
     """
-    ImgageMetrics is a structure for storing img comparison metric.
-    methods write/load are to facilitate file movement to/from docker.
+    ImgageMetrics is a record of img comparison metrics and the label
+    assigned to them by the classifier. It is returned by calculate_metrics()
+    and is cheap to pass between processes. Methods write/load are to
+    facilitate file movement to/from docker.
     """
 
-    def __init__(self, dictionary=None):
-        self.ssim = None
-        self.reference_variance = None
-        self.image_variance = None
-        self.ref_edge_factor = None
-        self.comp_edge_factor = None
-        self.edge_difference = None
-        self.wavelet_sym2_base = None
-        self.wavelet_sym2_low = None
-        self.wavelet_sym2_mid = None
-        self.wavelet_sym2_high = None
-        self.wavelet_db4_base = None
-        self.wavelet_db4_low = None
-        self.wavelet_db4_mid = None
-        self.wavelet_db4_high = None
-        self.wavelet_haar_base = None
-        self.wavelet_haar_low = None
-        self.wavelet_haar_mid = None
-        self.wavelet_haar_high = None
-        self.wavelet_haar_freq_x1 = None
-        self.wavelet_haar_freq_x2 = None
-        self.wavelet_haar_freq_x3 = None
-        self.histograms_correlation = None
-        self.max_x_mass_center_distance = None
-        self.max_y_mass_center_distance = None
-        self.crop_resolution = None
-        self.variance_difference = None
-
+    __slots__ = (
+        'ssim',
+        'psnr',
+        'reference_variance',
+        'image_variance',
+        'ref_edge_factor',
+        'comp_edge_factor',
+        'edge_difference',
+        'wavelet_sym2_base',
+        'wavelet_sym2_low',
+        'wavelet_sym2_mid',
+        'wavelet_sym2_high',
+        'wavelet_db4_base',
+        'wavelet_db4_low',
+        'wavelet_db4_mid',
+        'wavelet_db4_high',
+        'wavelet_haar_base',
+        'wavelet_haar_low',
+        'wavelet_haar_mid',
+        'wavelet_haar_high',
+        'wavelet_haar_freq_x1',
+        'wavelet_haar_freq_x2',
+        'wavelet_haar_freq_x3',
+        'histograms_correlation',
+        'max_x_mass_center_distance',
+        'max_y_mass_center_distance',
+        'crop_resolution',
+        'variance_difference',
+        'Label',
+    )
+
+    def __init__(self, dictionary):
         # ensure that the keys are correct
         keys = ImgageMetrics.get_metric_names()
         keys.append('Label')
@@ -63,9 +62,8 @@ class ImgageMetrics:
             if key not in dictionary:
                 raise KeyError("missing metric:" + key)
 
-        # read into ImgMetrics object
-        for key in dictionary:
-            setattr(self, key, dictionary[key])
+        for key in self.__slots__:
+            setattr(self, key, _to_builtin(dictionary.get(key)))
 
     @staticmethod
     def get_metric_classes():
@@ -97,24 +95,24 @@ class ImgageMetrics:
             metric_names = metric_names + metric_class.get_labels()
         return metric_names
 
-    def to_json(self):
-        str_ = json.dumps(self,
-                          cls=MyEncoder,
-                          indent=4,
-                          sort_keys=True,
-                          separators=(',', ': '),
-                          ensure_ascii=False)
-        return str_
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__}
 
-    def write_to_file(self, file_name='img_metrics.txt'):
-        dir_path = os.path.dirname(os.path.realpath(__file__))
-        file_path = os.path.join(dir_path, file_name)
+    def to_json(self, indent=4):
+        return json.dumps(
+            self.to_dict(),
+            indent=indent,
+            sort_keys=True,
+            separators=(',', ': ') if indent is not None else (',', ':'),
+            ensure_ascii=False
+        )
 
+    def write_to_file(self, file_name='img_metrics.txt'):
         data = self.to_json()
-        with io.open(file_path, 'w', encoding='utf-8') as f:
+        with io.open(file_name, 'w', encoding='utf-8') as f:
             f.write(data)
 
-        return file_path
+        return file_name
 
     @classmethod
     def load_from_file(cls, file_path=None):
@@ -1,21 +1,35 @@
+import dataclasses
+import functools
+import json
 import os
 import sys
+import threading
 from pathlib import Path
-from typing import Dict
+from typing import Any, Dict, List, Optional, Tuple
 
+import numpy
 import OpenEXR
 from PIL import Image
 
+from ..process_tools import Usage, measure_usage
 from . import decision_tree
-from .image_format_converter import convert_tga_to_png, convert_exr_to_png
+from .image_format_converter import (
+    convert_tga_to_png,
+    encode_srgb,
+    read_exr,
+    read_exr_as_srgb_image,
+    read_rows,
+)
 from .image_metrics import ImgageMetrics
+from .image_pair import ImagePair
+from .scratch_space import get_default_scratch_space, ScratchSpace
 
 
 PROVIDER_RESULT_CROP_NAME_PREFIX = "fragment_corresponding_to_"
 VERIFICATION_SUCCESS = "TRUE"
 VERIFICATION_FAIL = "FALSE"
-PKT_FILENAME = "tree35_[crr=87.71][frr=0.92].pkl"
-TREE_PATH = Path(os.path.dirname(os.path.realpath(__file__))) / PKT_FILENAME
+TREE_FILENAME = "tree35_[crr=87.71][frr=0.92].npz"
+TREE_PATH = Path(os.path.dirname(os.path.realpath(__file__))) / TREE_FILENAME
 
 
 def calculate_metrics(
@@ -23,8 +37,11 @@ def calculate_metrics(
         providers_result_image_path,
         top_left_corner_x,
         top_left_corner_y,
-        metrics_output_filename='metrics.txt'
-):
+        metrics_output_filename=None,
+        lazy=True,
+        monitor_usage=False,
+        memory_budget=None
+) -> ImgageMetrics:
     """
     This is the entry point for calculation of metrics between the
     rendered_scene and the sample(cropped_image) generated for comparison.
@@ -32,41 +49,106 @@ def calculate_metrics(
     :param providers_result_image_path:
     :param top_left_corner_x: x position of crop (left, top)
     :param top_left_corner_y: y position of crop (left, top)
-    :param metrics_output_filename:
-    :return:
+    :param metrics_output_filename: if given, metrics are also written to
+    this file, and usage next to it, to a file named as returned by
+    get_usage_path().
+    :param lazy: compute only metrics on the path of the sample through
+    the decision tree, other metrics are stored as None. Otherwise all metrics
+    used by the classifier are computed.
+    :param monitor_usage: measure time and memory used by each metric and
+    the whole comparison.
+    :param memory_budget: approximate memory in bytes for intermediate arrays
+    of metrics which can be computed in tiles, see ImagePair.row_tiles().
+    By default, whole images are processed at once.
+    :return: metrics with the label assigned by the classifier
+    """
+    image_metrics, usage = calculate_metrics_and_usage(
+        reference_crop_path,
+        providers_result_image_path,
+        top_left_corner_x,
+        top_left_corner_y,
+        lazy,
+        monitor_usage,
+        memory_budget
+    )
+    if metrics_output_filename is not None:
+        image_metrics.write_to_file(metrics_output_filename)
+        if usage is not None:
+            with open(get_usage_path(metrics_output_filename), 'w') as f:
+                json.dump(usage, f, indent=4, sort_keys=True)
+    return image_metrics
+
+
+def calculate_metrics_and_usage(
+        reference_crop_path,
+        providers_result_image_path,
+        top_left_corner_x,
+        top_left_corner_y,
+        lazy=True,
+        monitor_usage=False,
+        memory_budget=None,
+        classify=True,
+        providers_result_crop=None,
+        scratch_space=None
+) -> Tuple[ImgageMetrics, Optional[Dict[str, Any]]]:
+    """
+    Same as calculate_metrics(), but nothing is written to files.
+    :param providers_result_crop: (height, width, 3) uint8 array with
+    the crop of the provider's result, e.g. taken by ProviderFrames.crop(),
+    so that the result image is not decoded again.
+    :param scratch_space: ScratchSpace for converted images, by default
+    the one of the current process.
+    :param classify: if False, all metrics are computed and Label is None,
+    so that metrics of many crops can be classified at once with
+    classify_metrics().
+    :return: metrics and usage, if monitored, as written by
+    calculate_metrics()
     """
     (cropped_image, providers_result_crop) = \
         _load_and_prepare_images_for_comparison(
             reference_crop_path,
             providers_result_image_path,
             top_left_corner_x,
-            top_left_corner_y
+            top_left_corner_y,
+            providers_result_crop,
+            scratch_space
         )
-    image_metrics = dict()
-    image_metrics['Label'] = VERIFICATION_FAIL
 
-    (classifier, labels, available_metrics) = get_metrics()
+    (classifier, labels, effective_metrics) = get_metrics()
 
     print(f"providers_result_crop: {providers_result_crop.getbbox()}")
-    compare_metrics = compare_images(
-        cropped_image,
-        providers_result_crop,
-        available_metrics
-    )
-    try:
-        label = classify_with_tree(compare_metrics, classifier, labels)
-        compare_metrics['Label'] = label
-    except Exception as e:
-        print("There were errors %r" % e, file=sys.stderr)
-        compare_metrics['Label'] = VERIFICATION_FAIL
+    metrics_usage = dict() if monitor_usage else None
+    total_usage = Usage()
+    with measure_usage(total_usage, trace_memory=False):
+        lazy_metrics = LazyMetrics(
+            ImagePair.from_images(
+                cropped_image,
+                providers_result_crop,
+                memory_budget
+            ),
+            effective_metrics,
+            metrics_usage
+        )
+        if not lazy or not classify:
+            lazy_metrics.compute_all()
+        label = None
+        if classify:
+            try:
+                label = classify_with_tree(lazy_metrics, classifier, labels)
+            except Exception as e:
+                print("There were errors %r" % e, file=sys.stderr)
+                label = VERIFICATION_FAIL
+    usage = None
+    if monitor_usage:
+        usage = _summarize_usage(metrics_usage, total_usage)
+    compare_metrics = lazy_metrics.to_dict()
+    compare_metrics['Label'] = label
     providers_result_crop.save(
         os.path.join(
             os.path.dirname(reference_crop_path),
             _generate_path_for_providers_result_crop(reference_crop_path))
     )
-    return ImgageMetrics(compare_metrics).write_to_file(
-        metrics_output_filename
-    )
+    return ImgageMetrics(compare_metrics), usage
 
 
 def _generate_path_for_providers_result_crop(reference_crop_path):
@@ -76,28 +158,102 @@ def _generate_path_for_providers_result_crop(reference_crop_path):
     )
 
 
+def get_usage_path(metrics_output_filename):
+    """
+    Usage is stored as JSON next to metrics, e.g. crop0_usage.json
+    for crop0_metrics.txt.
+    """
+    root, _ = os.path.splitext(metrics_output_filename)
+    if root.endswith('metrics'):
+        root = root[:-len('metrics')]
+    else:
+        root += '_'
+    return root + 'usage.json'
+
+
+def _summarize_usage(
+        metrics_usage: Dict[str, Usage],
+        total: Usage
+) -> Dict[str, Any]:
+    # Metrics may be computed while walking the tree, so time spent on
+    # decoding images and classification is what remains of the total.
+    # Memory is traced for metrics only.
+    other = Usage(
+        real_time=total.real_time - sum(
+            usage.real_time for usage in metrics_usage.values()),
+        cpu_time=total.cpu_time - sum(
+            usage.cpu_time for usage in metrics_usage.values()),
+    )
+    total.mem_peak = max(
+        (usage.mem_peak for usage in metrics_usage.values()),
+        default=0.
+    )
+    return {
+        'metrics': {
+            name: dataclasses.asdict(usage)
+            for name, usage in metrics_usage.items()
+        },
+        'other': dataclasses.asdict(other),
+        'total': dataclasses.asdict(total),
+    }
+
+
+@functools.lru_cache(maxsize=None)
 def load_classifier():
+    """
+    Loads the classifier compiled by decision_tree.export(). It is loaded
+    once per process and shared by all verified crops, so it must not be
+    modified.
+    """
     classifier, feature_labels = decision_tree.DecisionTree.load(TREE_PATH)
     return classifier, feature_labels
 
 
 def classify_with_tree(metrics, classifier, feature_labels):
-    features = dict()
-    for label in feature_labels:
-        features[label] = metrics[label]
-    results = classifier.classify_with_feature_vector(features, feature_labels)
-    return results[0].decode('utf-8')
+    """
+    :param metrics: dictionary or LazyMetrics, only features on the path of
+    the sample through the tree are read from it.
+    """
+    return str(
+        classifier.classify_lazily(metrics.__getitem__, feature_labels))
+
+
+def classify_metrics(metrics: List[ImgageMetrics]) -> List[str]:
+    """
+    Classifies metrics of many crops in a single call, and stores labels
+    in them. Metrics with any feature missing or not finite are labeled
+    as VERIFICATION_FAIL.
+    """
+    classifier, feature_labels = load_classifier()
+    samples = numpy.full(
+        (len(metrics), len(feature_labels)), numpy.nan, dtype=numpy.float64)
+    for row, crop_metrics in enumerate(metrics):
+        for column, label in enumerate(feature_labels):
+            value = getattr(crop_metrics, label)
+            if value is not None:
+                samples[row, column] = value
+    labels = [
+        str(label) for label in
+        classifier.classify(samples, invalid_label=VERIFICATION_FAIL)
+    ]
+    for crop_metrics, label in zip(metrics, labels):
+        crop_metrics.Label = label
+    return labels
 
 
 def _load_and_prepare_images_for_comparison(
         reference_crop_path,
         result_image_path,
         top_left_corner_x,
-        top_left_corner_y
+        top_left_corner_y,
+        providers_result_crop=None,
+        scratch_space=None
 ):
     """
     This function prepares (i.e. crops) the providers_result_image so that it
     will fit the sample(cropped_image) generated for comparison.
+    If providers_result_crop is given, it is used instead. Images are
+    converted if needed in the scratch_space.
 
     :param reference_crop_path:
     :param result_image_path:
@@ -107,14 +263,18 @@ def _load_and_prepare_images_for_comparison(
     """
     print(f"result_image_path = {result_image_path}")
     print(f"reference_crop_path = {reference_crop_path}")
-    providers_result_image = convert_to_png_if_needed(result_image_path)
-    reference_crop = convert_to_png_if_needed(reference_crop_path)
+    reference_crop = convert_to_png_if_needed(
+        reference_crop_path, scratch_space)
     (crop_width, crop_height) = reference_crop.size
     print(
         f"top_left_corner_x={top_left_corner_x}, "
         f"top_left_corner_y={top_left_corner_y}, "
         f"width={crop_width}, height={crop_height}"
     )
+    if providers_result_crop is not None:
+        return reference_crop, Image.fromarray(providers_result_crop, "RGB")
+    providers_result_image = convert_to_png_if_needed(
+        result_image_path, scratch_space)
     provider_crop = get_providers_result_crop(
         providers_result_image,
         top_left_corner_x,
@@ -143,38 +303,160 @@ def check_exr_multilayer(image_path):
         raise RuntimeError("There is no support for OpenEXR multilayer")
 
 
-def convert_to_png_if_needed(image_path):
+def convert_to_png_if_needed(
+        image_path,
+        scratch_space: Optional[ScratchSpace] = None
+):
+    """
+    Opens an image as PIL image. EXR images are read and encoded to 8-bit
+    sRGB in memory, TGA images are converted to PNG files in the scratch
+    space, by default the one of the current process.
+    """
     print(f'convert_to_png_if_needed({image_path})')
     extension = get_file_extension_lowercase(image_path)
-    name = os.path.basename(image_path)
-    file_name = os.path.join("/tmp/", name)
     if extension == "exr":
         check_exr_multilayer(image_path)
-        convert_exr_to_png(image_path, file_name)
-    elif extension == "tga":
-        convert_tga_to_png(image_path, file_name)
-    else:
-        file_name = image_path
-    return Image.open(file_name)
+        return read_exr_as_srgb_image(image_path)
+    if extension != "tga":
+        return Image.open(image_path)
+    if scratch_space is None:
+        scratch_space = get_default_scratch_space()
+    file_name = scratch_space.get_converted(
+        image_path, "png", convert_tga_to_png)
+    image = Image.open(file_name)
+    # The file may be evicted by other comparisons once it is read
+    image.load()
+    return image
+
+
+def read_image_rows(image_path, top, bottom) -> numpy.ndarray:
+    """
+    Decodes rows [top, bottom) of an image, without decoding the rows below
+    them (and above them, if the format allows it), see read_rows().
+    :return: (rows, width, 3) uint8 array, EXR images are encoded to sRGB
+    the same as by convert_to_png_if_needed()
+    """
+    if get_file_extension_lowercase(image_path) == "exr":
+        check_exr_multilayer(image_path)
+        return encode_srgb(read_exr(image_path, (top, bottom)))
+    with Image.open(image_path) as image:
+        return numpy.array(read_rows(image, top, bottom).convert("RGB"))
 
 
 def get_providers_result_crop(providers_result_image, x, y, width, height):
     return providers_result_image.crop((x, y, x + width, y + height))
 
 
+def get_image_size(image_path) -> Tuple[int, int]:
+    """
+    Reads (width, height) of an image from its header.
+    """
+    if get_file_extension_lowercase(image_path) == "exr":
+        data_window = OpenEXR.InputFile(str(image_path)).header()['dataWindow']
+        return (
+            data_window.max.x - data_window.min.x + 1,
+            data_window.max.y - data_window.min.y + 1,
+        )
+    with Image.open(image_path) as image:
+        return image.size
+
+
+class ProviderFrames:
+    """
+    ProviderFrames decodes each of the provider's result frames once per
+    verification, as RGB arrays, and takes crops of them as views, instead
+    of decoding the whole frame again for every compared crop.
+    If rows covered by crops are given, only these rows are decoded,
+    see read_image_rows(). Frames may be decoded in a background thread,
+    see preload().
+    """
+
+    def __init__(self, rows: Optional[Tuple[int, int]] = None) -> None:
+        self._rows = rows
+        # Decoded rows of each frame, as (top, array)
+        self._bands: Dict[str, Tuple[int, numpy.ndarray]] = dict()
+        self._sizes: Dict[str, Tuple[int, int]] = dict()
+        self._locks: Dict[str, threading.Lock] = dict()
+        self._lock = threading.Lock()
+
+    def get_rows(
+            self,
+            image_path,
+            top: int,
+            bottom: int
+    ) -> Tuple[int, numpy.ndarray]:
+        """
+        Decodes rows of the frame, unless they are already decoded, together
+        with other rows covered by crops.
+        :return: (band_top, band) with read-only uint8 array of rows from
+        band_top, covering rows [top, bottom) clipped to the frame
+        """
+        image_path = str(image_path)
+        with self._lock:
+            lock = self._locks.setdefault(image_path, threading.Lock())
+        with lock:
+            height = self.get_size(image_path)[1]
+            top, bottom = max(top, 0), min(bottom, height)
+            band = self._bands.get(image_path)
+            if band is None or band[0] > top \
+                    or band[0] + len(band[1]) < bottom:
+                if self._rows is not None:
+                    top = min(top, self._rows[0])
+                    bottom = max(bottom, self._rows[1])
+                if band is not None:
+                    top = min(top, band[0])
+                    bottom = max(bottom, band[0] + len(band[1]))
+                top, bottom = max(top, 0), min(bottom, height)
+                rows = read_image_rows(image_path, top, bottom)
+                rows.setflags(write=False)
+                self._bands[image_path] = (top, rows)
+            return self._bands[image_path]
+
+    def get_size(self, image_path) -> Tuple[int, int]:
+        image_path = str(image_path)
+        if image_path not in self._sizes:
+            self._sizes[image_path] = get_image_size(image_path)
+        return self._sizes[image_path]
+
+    def preload(self, image_paths) -> None:
+        for image_path in image_paths:
+            try:
+                top, bottom = self._rows or (0, self.get_size(image_path)[1])
+                self.get_rows(image_path, top, bottom)
+            except Exception as e:  # pylint: disable=broad-except
+                # Errors are raised again when the frame is needed
+                print(f"Could not decode {image_path}: {e!r}", file=sys.stderr)
+
+    def crop(self, image_path, x, y, width, height) -> numpy.ndarray:
+        """
+        Same as get_providers_result_crop(), as an array. It is a view of
+        the frame, unless the crop reaches outside of it, where it is black.
+        """
+        frame_width, frame_height = self.get_size(image_path)
+        left, top = max(x, 0), max(y, 0)
+        right = min(x + width, frame_width)
+        bottom = min(y + height, frame_height)
+        if left >= right or top >= bottom:
+            return numpy.zeros((height, width, 3), dtype=numpy.uint8)
+        band_top, band = self.get_rows(image_path, top, bottom)
+        region = band[top - band_top:bottom - band_top, left:right]
+        if (left, top, right, bottom) == (x, y, x + width, y + height):
+            return region
+        crop = numpy.zeros((height, width, 3), dtype=numpy.uint8)
+        crop[top - y:bottom - y, left - x:right - x] = region
+        return crop
+
+
 def get_metrics():
     classifier, feature_labels = load_classifier()
     available_metrics = ImgageMetrics.get_metric_classes()
-    # todo review: DONE IN DOCS
-    #  effective_metrics isn't used after filling it with values
-    #  in the loops below
     effective_metrics = []
     for metric in available_metrics:
         for label in feature_labels:
             for label_part in metric.get_labels():
                 if label_part == label and metric not in effective_metrics:
                     effective_metrics.append(metric)
-    return (classifier, feature_labels, available_metrics)
+    return (classifier, feature_labels, effective_metrics)
 
 
 def get_labels_from_metrics(metrics):
@@ -184,21 +466,70 @@ def get_labels_from_metrics(metrics):
     return labels
 
 
-def compare_images(image_a, image_b, metrics) -> Dict:
+def get_crop_resolution(pair: ImagePair) -> str:
+    (crop_height, crop_width) = pair.size
+    return str(crop_height) + "x" + str(crop_width)
+
+
+class LazyMetrics:
     """
-    This the entry point for calculating metrics between image_a, image_b
-    once they are cropped to the same size.
+    LazyMetrics is a dictionary-like view of metrics between images of
+    a pair. A metric is computed on first access to any of its labels, so
+    classification only pays for the features it actually reads.
+    If usage is given, usage of each computed metric is stored in it
+    under the name of the metric class.
     """
 
-    # imageA/B are images read by: PIL.Image.open(image.png)
-    (crop_height, crop_width) = image_a.size
-    crop_resolution = str(crop_height) + "x" + str(crop_width)
+    def __init__(
+            self,
+            pair: ImagePair,
+            metrics,
+            usage: Optional[Dict[str, Usage]] = None
+    ) -> None:
+        self._pair = pair
+        self._usage = usage
+        self._metrics_by_label = {
+            label: metric_class
+            for metric_class in metrics
+            for label in metric_class.get_labels()
+        }
+        self._computed = {"crop_resolution": get_crop_resolution(pair)}
+
+    def __getitem__(self, label):
+        if label not in self._computed:
+            metric_class = self._metrics_by_label[label]
+            if self._usage is None:
+                self._computed.update(
+                    metric_class.compute_pair_metrics(self._pair))
+            else:
+                usage = Usage()
+                with measure_usage(usage):
+                    self._computed.update(
+                        metric_class.compute_pair_metrics(self._pair))
+                self._usage[metric_class.__name__] = usage
+        return self._computed[label]
+
+    def compute_all(self) -> Dict:
+        for label in self._metrics_by_label:
+            self[label]  # pylint: disable=pointless-statement
+        return dict(self._computed)
+
+    def to_dict(self) -> Dict:
+        """
+        Returns values of all metrics, those that were not computed are None.
+        """
+        data = dict.fromkeys(ImgageMetrics.get_metric_names())
+        data.update(self._computed)
+        return data
 
-    data = {"crop_resolution": crop_resolution}
 
-    for metric_class in metrics:
-        result = metric_class.compute_metrics(image_a, image_b)
-        for key, value in result.items():
-            data[key] = value
+def compare_images(image_a, image_b, metrics) -> Dict:
+    """
+    This the entry point for calculating metrics between image_a, image_b
+    once they are cropped to the same size. Images are decoded only once
+    and shared by all metrics as an ImagePair.
+    """
 
-    return data
+    # imageA/B are images read by: PIL.Image.open(image.png)
+    pair = ImagePair.from_images(image_a, image_b)
+    return LazyMetrics(pair, metrics).compute_all()
@@ -0,0 +1,195 @@
+import abc
+from typing import Dict, Iterator, NamedTuple, Optional, Tuple
+
+import numpy
+
+from .image_statistics import (
+    compute_pair_statistics,
+    EDGES_HALO,
+    PairStatistics,
+    STATISTICS_BYTES_PER_PIXEL,
+)
+
+
+def _read_only(array: numpy.ndarray) -> numpy.ndarray:
+    array = numpy.ascontiguousarray(array)
+    array.setflags(write=False)
+    return array
+
+
+class RowTile(NamedTuple):
+    """
+    Horizontal strip of both images, made of rows [start, stop) and up to
+    halo rows on each side of them, which are there only for filters
+    reaching outside of the tile.
+    """
+    images: Tuple[numpy.ndarray, numpy.ndarray]
+    start: int
+    stop: int
+    halo_start: int
+
+    @property
+    def rows(self) -> slice:
+        """
+        Rows of images belonging to the tile, without its halo.
+        """
+        return slice(self.start - self.halo_start, self.stop - self.halo_start)
+
+
+class ImagePair:
+    """
+    ImagePair is a read-only representation of the two compared images
+    (reference crop and provider's result crop) shared by all metrics.
+    Images are decoded and converted to RGB once, float32 views,
+    per-channel planes and statistics are derived on first use and cached,
+    so metrics must not modify any of the returned arrays.
+    With memory_budget (in bytes), metrics which can be accumulated over
+    parts of images process them in row tiles, see row_tiles().
+    """
+
+    def __init__(
+            self,
+            array1: numpy.ndarray,
+            array2: numpy.ndarray,
+            memory_budget: Optional[int] = None
+    ) -> None:
+        if array1.shape != array2.shape:
+            raise ValueError("Image sizes differ")
+        if array1.ndim != 3 or array1.shape[2] != 3:
+            raise ValueError("Images must be (height, width, 3) RGB arrays")
+        self._uint8 = (
+            _read_only(array1.astype(numpy.uint8, copy=False)),
+            _read_only(array2.astype(numpy.uint8, copy=False)),
+        )
+        self.memory_budget = memory_budget
+        self._float32 = None
+        self._planes = None
+        self._statistics = None
+
+    @classmethod
+    def from_images(
+            cls,
+            image1,
+            image2,
+            memory_budget: Optional[int] = None
+    ) -> 'ImagePair':
+        """
+        Creates pair from images read by PIL.Image.open().
+        """
+        if image1.size != image2.size:
+            raise ValueError("Image sizes differ")
+        return cls(
+            numpy.array(image1.convert("RGB")),
+            numpy.array(image2.convert("RGB")),
+            memory_budget
+        )
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        """
+        Size of both images as (width, height), the same as PIL.Image.size.
+        """
+        height, width = self._uint8[0].shape[:2]
+        return width, height
+
+    @property
+    def uint8(self) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        Both images as contiguous (height, width, 3) uint8 arrays.
+        """
+        return self._uint8
+
+    @property
+    def float32(self) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        Both images as contiguous (height, width, 3) float32 arrays
+        with values in range [0, 255].
+        """
+        if self._float32 is None:
+            self._float32 = tuple(
+                _read_only(image.astype(numpy.float32))
+                for image in self._uint8
+            )
+        return self._float32
+
+    @property
+    def planes(self) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        Both images as contiguous (3, height, width) float32 arrays,
+        one plane per channel.
+        """
+        if self._planes is None:
+            self._planes = tuple(
+                _read_only(image.transpose(2, 0, 1))
+                for image in self.float32
+            )
+        return self._planes
+
+    @property
+    def statistics(self) -> PairStatistics:
+        """
+        Variances, MSE and edge statistics of both images, computed together
+        on first use by any of the metrics that need them.
+        """
+        if self._statistics is None:
+            self._statistics = compute_pair_statistics(
+                (numpy.stack(tile.images).astype(numpy.float32), tile.rows)
+                for tile in self.row_tiles(
+                    STATISTICS_BYTES_PER_PIXEL,
+                    halo=EDGES_HALO
+                )
+            )
+        return self._statistics
+
+    def row_tiles(
+            self,
+            bytes_per_pixel: int,
+            halo: int = 0,
+            min_rows: int = 1
+    ) -> Iterator[RowTile]:
+        """
+        Splits images into row tiles of similar height, so that a metric
+        using bytes_per_pixel of memory for each pixel of a tile, including
+        its halo, stays within memory_budget. Tiles have at least min_rows
+        rows, even if that exceeds the budget. Without memory_budget, whole
+        images are a single tile.
+        """
+        width, height = self.size
+        count = 1
+        if self.memory_budget is not None:
+            rows = self.memory_budget // (bytes_per_pixel * width) - 2 * halo
+            rows = max(rows, min_rows, 1)
+            count = min(-(-height // rows), max(height // min_rows, 1))
+        for i in range(count):
+            start = height * i // count
+            stop = height * (i + 1) // count
+            halo_start = max(start - halo, 0)
+            halo_stop = min(stop + halo, height)
+            yield RowTile(
+                tuple(image[halo_start:halo_stop] for image in self._uint8),
+                start,
+                stop,
+                halo_start
+            )
+
+
+class PairMetric(abc.ABC):
+    """
+    Base class for metrics computed on an ImagePair. Metrics are stateless,
+    compute_pair_metrics() receives a pair shared with other metrics and
+    returns a dictionary with values for each of get_labels().
+    """
+
+    @classmethod
+    def compute_metrics(cls, image1, image2) -> Dict:
+        return cls.compute_pair_metrics(ImagePair.from_images(image1, image2))
+
+    @staticmethod
+    @abc.abstractmethod
+    def compute_pair_metrics(pair: ImagePair) -> Dict:
+        pass
+
+    @staticmethod
+    @abc.abstractmethod
+    def get_labels():
+        pass
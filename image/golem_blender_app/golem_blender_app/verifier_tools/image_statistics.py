@@ -0,0 +1,103 @@
+from typing import Iterable, NamedTuple, Tuple
+
+import numpy
+
+
+# Rows needed around a tile to find edges in it
+EDGES_HALO = 1
+# Approximate memory used by compute_pair_statistics() per pixel of a tile
+STATISTICS_BYTES_PER_PIXEL = 128
+
+
+class PairStatistics(NamedTuple):
+    """
+    Statistics of both images of a pair, each computed once and shared by
+    the variance, PSNR and edge metrics.
+    """
+    variances: numpy.ndarray
+    mse: float
+    edge_means: numpy.ndarray
+    edge_mse: float
+
+
+def find_edges(images: numpy.ndarray) -> numpy.ndarray:
+    """
+    Applies the same filter as PIL.ImageFilter.FIND_EDGES to each channel:
+    a 3x3 kernel with 8 in the center and -1 around it, clipped to
+    [0, 255]. Border pixels, or whole images smaller than the kernel, are
+    copied unchanged, as PIL does.
+    :param images: float32 array of shape (..., height, width, channels)
+    with integer values in range [0, 255]
+    :return: float32 array of the same shape with integer values
+    """
+    height, width = images.shape[-3:-1]
+    edges = images.copy()
+    if height < 3 or width < 3:
+        return edges
+
+    # All values are small integers, so float32 sums are exact.
+    inner = 9 * images[..., 1:-1, 1:-1, :]
+    for y in range(3):
+        for x in range(3):
+            inner -= images[..., y:height - 2 + y, x:width - 2 + x, :]
+    numpy.clip(inner, 0, 255, out=edges[..., 1:-1, 1:-1, :])
+    return edges
+
+
+def compute_variances(
+        sums: numpy.ndarray,
+        square_sums: numpy.ndarray,
+        count: int
+) -> numpy.ndarray:
+    """
+    Computes population variances from sums of values and of their squares.
+    Sums of integers below 2 ** 53 are exact in float64, so they can be
+    converted to integers and each variance is rounded only once.
+    :param sums: float64 array of sums of integer values
+    :param square_sums: float64 array of sums of their squares
+    :param count: number of summed values
+    :return: float64 array of the same shape as sums
+    """
+    variances = [
+        (count * int(square_sum) - int(total) ** 2) / count ** 2
+        for total, square_sum in zip(sums.flat, square_sums.flat)
+    ]
+    return numpy.array(variances, dtype=numpy.float64).reshape(sums.shape)
+
+
+def compute_pair_statistics(
+        tiles: Iterable[Tuple[numpy.ndarray, slice]]
+) -> PairStatistics:
+    """
+    Computes statistics of a pair of images, accumulating them over tiles.
+    All sums are of integers, so they are exact and do not depend on tiling.
+    :param tiles: (images, rows) for each tile, where images is float32
+    array of shape (2, height, width, channels) with integer values
+    in range [0, 255], holding a strip of full rows of both images, and rows
+    are rows of the strip belonging to the tile. Other rows are a halo of
+    EDGES_HALO rows for finding edges, except at borders of images.
+    """
+    count = 0
+    sums = square_sums = edge_sums = 0.
+    square_difference_sum = square_edge_difference_sum = 0.
+    for images, rows in tiles:
+        edges = find_edges(images)[:, rows]
+        images = images[:, rows]
+        count += images.shape[1] * images.shape[2]
+        sums = sums + images.sum(axis=(1, 2), dtype=numpy.float64)
+        square_sums = square_sums + numpy.square(images).sum(
+            axis=(1, 2), dtype=numpy.float64)
+        square_difference_sum += numpy.square(images[0] - images[1]).sum(
+            dtype=numpy.float64)
+        edge_sums = edge_sums + edges.sum(
+            axis=(1, 2, 3), dtype=numpy.float64)
+        square_edge_difference_sum += numpy.square(edges[0] - edges[1]).sum(
+            dtype=numpy.float64)
+
+    values_count = count * sums.shape[-1]
+    return PairStatistics(
+        variances=compute_variances(sums, square_sums, count),
+        mse=float(square_difference_sum / values_count),
+        edge_means=edge_sums / values_count,
+        edge_mse=float(square_edge_difference_sum / values_count),
+    )
@@ -1,65 +1,121 @@
+import numpy
 from PIL import Image
 import sys
 
+from .image_pair import ImagePair, PairMetric
 
-class MetricMassCenterDistance:
+
+# Approximate memory used per pixel of a tile
+MASS_CENTER_BYTES_PER_PIXEL = 16
+
+
+class MetricMassCenterDistance(PairMetric):
 
     @staticmethod
-    def compute_metrics(image1, image2):
-        if image1.size != image2.size:
-            raise Exception("Image sizes differ")
-        mass_centers_1 = MetricMassCenterDistance.compute_mass_centers(image1)
-        mass_centers_2 = MetricMassCenterDistance.compute_mass_centers(image2)
-        max_x_distance = 0
-        max_y_distance = 0
-        for channel_index in mass_centers_1.keys():
-            x1, y1 = mass_centers_1[channel_index]
-            x2, y2 = mass_centers_2[channel_index]
-            x_distance = abs(x1 - x2)
-            y_distance = abs(y1 - y2)
-            max_x_distance = max(max_x_distance, x_distance)
-            max_y_distance = max(max_y_distance, y_distance)
-        return {
-            "max_x_mass_center_distance": max_x_distance,
-            "max_y_mass_center_distance": max_y_distance
-                }
+    def compute_pair_metrics(pair: ImagePair):
+        width, height = pair.size
+        moments = sum(
+            MetricMassCenterDistance.compute_mass_moments(
+                numpy.stack(tile.images),
+                row_offset=tile.start
+            )
+            for tile in pair.row_tiles(MASS_CENTER_BYTES_PER_PIXEL)
+        )
+        mass_centers = MetricMassCenterDistance.get_mass_centers(
+            moments,
+            width,
+            height
+        )
+        return MetricMassCenterDistance.get_distances(
+            mass_centers[0],
+            mass_centers[1]
+        )
 
     @staticmethod
     def get_labels():
         return ["max_x_mass_center_distance", "max_y_mass_center_distance"]
 
     @staticmethod
-    def compute_mass_centers(image):
-        image = image.convert('RGB')
-        pixels = image.load()
-        width, height = image.size
-        results = dict()
-        for channel_index in range(len(pixels[0, 0])):
-            mass_center_x = 0
-            mass_center_y = 0
-            total_mass = 0
-            for x in range(width):
-                for y in range(height):
-                    mass = pixels[x, y][channel_index]
-                    mass_center_x += mass * x
-                    mass_center_y += mass * y
-                    total_mass += mass
-                    
-            divisor_x = (float(total_mass) * width)
-            divisor_y = (float(total_mass) * height)
-               
-            if divisor_x == 0:
-                mass_center_x = 0.5
-            else:
-                mass_center_x = mass_center_x / divisor_x
-                
-            if divisor_y == 0:
-                mass_center_y = 0.5
-            else:
-                mass_center_y = mass_center_y / divisor_y
-            
-            results[channel_index] = mass_center_x, mass_center_y        
-        return results
+    def get_distances(mass_centers_1, mass_centers_2):
+        """
+        Computes metrics from mass centers of two images, as returned by
+        compute_mass_centers() for a single image.
+        """
+        distances = numpy.absolute(mass_centers_1 - mass_centers_2)
+        max_x_distance, max_y_distance = distances.max(axis=0)
+        return {
+            "max_x_mass_center_distance": float(max_x_distance),
+            "max_y_mass_center_distance": float(max_y_distance)
+        }
+
+    @staticmethod
+    def compute_mass_centers(images):
+        """
+        Computes relative (x, y) mass center of each channel.
+        :param images: uint8 array of shape (height, width, channels) or
+        a stack of equally sized images (count, height, width, channels)
+        :return: float64 array of shape (channels, 2), or
+        (count, channels, 2) for a stack of images. Channels without any
+        mass have their center at (0.5, 0.5).
+        """
+        images = numpy.asarray(images)
+        height, width = images.shape[-3:-1]
+        return MetricMassCenterDistance.get_mass_centers(
+            MetricMassCenterDistance.compute_mass_moments(images),
+            width,
+            height
+        )
+
+    @staticmethod
+    def compute_mass_moments(images, row_offset=0):
+        """
+        Computes total mass and its x and y moments for each channel.
+        Moments are integers, so moments of images split into row tiles
+        can be summed exactly.
+        :param images: uint8 array of shape (..., height, width, channels)
+        :param row_offset: index of the first row of images, when they are
+        a tile of larger images
+        :return: int64 array of shape (3, ..., channels) with total mass,
+        x moment and y moment
+        """
+        height, width = images.shape[-3:-1]
+        column_masses = images.sum(axis=-3, dtype=numpy.int64)
+        row_masses = images.sum(axis=-2, dtype=numpy.int64)
+        total_mass = column_masses.sum(axis=-2)
+        moment_x = numpy.einsum(
+            '...xc,x->...c',
+            column_masses,
+            numpy.arange(width, dtype=numpy.int64)
+        )
+        moment_y = numpy.einsum(
+            '...yc,y->...c',
+            row_masses,
+            numpy.arange(row_offset, row_offset + height, dtype=numpy.int64)
+        )
+        return numpy.stack([total_mass, moment_x, moment_y])
+
+    @staticmethod
+    def get_mass_centers(moments, width, height):
+        """
+        Computes relative mass centers from moments returned by
+        compute_mass_moments() for whole images.
+        The result is bit-identical to accumulating pixel by pixel.
+        """
+        total_mass, moment_x, moment_y = moments.astype(numpy.float64)
+        divisor_x = total_mass * width
+        divisor_y = total_mass * height
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            mass_center_x = numpy.where(
+                divisor_x == 0,
+                0.5,
+                moment_x / divisor_x
+            )
+            mass_center_y = numpy.where(
+                divisor_y == 0,
+                0.5,
+                moment_y / divisor_y
+            )
+        return numpy.stack([mass_center_x, mass_center_y], axis=-1)
 
 
 def run():
@@ -1,28 +1,24 @@
 import numpy
-import math
-from .skimage import compare_psnr
+from .image_pair import ImagePair, PairMetric
+from .skimage import dtype_range
 
 import sys
 
 
 ## ======================= ##
 ##
-class MetricPSNR:
+class MetricPSNR(PairMetric):
 
     ## ======================= ##
     ##
     @staticmethod
-    def compute_metrics(image1, image2):
-        image1 = image1.convert("RGB")
-        image2 = image2.convert("RGB")
+    def compute_pair_metrics(pair: ImagePair):
+        mse = pair.statistics.mse
 
-        np_image1 = numpy.array(image1)
-        np_image2 = numpy.array(image2)
-
-        psnr = compare_psnr(np_image1, np_image2)
-
-        if math.isinf(psnr):
+        if mse == 0:
             psnr = numpy.finfo(numpy.float32).max
+        else:
+            psnr = compute_psnr(mse)
 
         result = dict()
         result["psnr"] = psnr
@@ -36,6 +32,16 @@ class MetricPSNR:
         return ["psnr"]
 
 
+## ======================= ##
+##
+def compute_psnr(mse, data_range=dtype_range[numpy.uint8][1]):
+    """
+    Computes PSNR from MSE between images, the same as
+    skimage.compare_psnr() does for uint8 images.
+    """
+    return 10 * numpy.log10((data_range ** 2) / mse)
+
+
 ## ======================= ##
 ##
 def run():
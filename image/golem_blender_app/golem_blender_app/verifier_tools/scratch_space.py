@@ -0,0 +1,219 @@
+import atexit
+import copy
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from typing import Callable, Dict, Optional, Tuple
+
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+RAM_DIRECTORY = '/dev/shm'
+CACHE_DIRECTORY = 'converted'
+
+
+def get_default_root(in_memory: bool = False) -> str:
+    """
+    Directory in which scratch spaces are created, RAM-backed if requested
+    and available.
+    """
+    if in_memory and os.path.isdir(RAM_DIRECTORY) \
+            and os.access(RAM_DIRECTORY, os.W_OK):
+        return RAM_DIRECTORY
+    return tempfile.gettempdir()
+
+
+class ScratchSpace:
+    """
+    ScratchSpace is a directory for images converted by the verifier, shared
+    by verifications of a process, see get_scratch_space(). A converted image
+    is cached as long as the source has the same path, size and modification
+    time, so it is reused by later verifications. Least recently used images
+    are evicted from the cache once they take more than max_bytes.
+    Each verification converts images in its own namespace(), which links
+    images it uses, so verifications of different subtasks never overwrite
+    them and eviction does not remove images still in use.
+    Worker processes of a verification convert images in its namespace by
+    scratch spaces of attach(), only the process which created the scratch
+    space evicts images and removes it.
+    """
+
+    def __init__(
+            self,
+            root: Optional[str] = None,
+            max_bytes: int = DEFAULT_MAX_BYTES,
+            in_memory: bool = False,
+    ) -> None:
+        if max_bytes < 0:
+            raise ValueError(f"max_bytes must not be negative: {max_bytes}")
+        root = root or get_default_root(in_memory)
+        os.makedirs(root, exist_ok=True)
+        self.directory = tempfile.mkdtemp(prefix='verification_', dir=root)
+        os.mkdir(self.cache_directory)
+        self.max_bytes: Optional[int] = max_bytes
+        self.namespace_directory: Optional[str] = None
+
+    @classmethod
+    def attach(
+            cls,
+            directory: str,
+            namespace_directory: Optional[str] = None,
+    ) -> 'ScratchSpace':
+        """
+        Returns a scratch space converting images in the directory of another
+        one, e.g. of the parent process, which never evicts images.
+        """
+        scratch_space = cls.__new__(cls)
+        scratch_space.directory = directory
+        scratch_space.max_bytes = None
+        scratch_space.namespace_directory = namespace_directory
+        return scratch_space
+
+    @property
+    def cache_directory(self) -> str:
+        return os.path.join(self.directory, CACHE_DIRECTORY)
+
+    def namespace(self) -> 'ScratchSpace':
+        """
+        Returns a scratch space of a single verification, which shares
+        the cache of this one. Its cleanup() removes only its own directory.
+        """
+        scratch_space = copy.copy(self)
+        scratch_space.namespace_directory = tempfile.mkdtemp(
+            prefix='namespace_', dir=self.directory)
+        return scratch_space
+
+    def get_converted(
+            self,
+            source_path,
+            extension: str,
+            convert: Callable[[str, str], None]
+    ) -> str:
+        """
+        Returns the path of the source converted by convert(source, target)
+        to an image with the extension, converting it only if it is not
+        cached. In a namespace, the path is of its link to the cached image.
+        """
+        stat = os.stat(source_path)
+        name = '{}.{}'.format(hashlib.sha256('{}:{}:{}'.format(
+            os.path.realpath(source_path),
+            stat.st_size,
+            stat.st_mtime_ns,
+        ).encode('utf-8')).hexdigest(), extension)
+        cached_path = os.path.join(self.cache_directory, name)
+        directory = self.namespace_directory or self.cache_directory
+        path = os.path.join(directory, name)
+        if directory != self.cache_directory and os.path.exists(path):
+            return path
+        try:
+            # The cached image may be evicted by other verifications until
+            # it is linked, other workers of this one may link it as well
+            if path != cached_path:
+                try:
+                    os.link(cached_path, path)
+                except FileExistsError:
+                    pass
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            pass
+        # Other processes may convert the same image at the same time,
+        # each of them writes its own file and links it into the cache
+        fd, tmp_path = tempfile.mkstemp(
+            dir=directory, suffix=f'.tmp.{extension}')
+        os.close(fd)
+        try:
+            convert(str(source_path), tmp_path)
+            if path != cached_path:
+                try:
+                    os.link(tmp_path, cached_path)
+                except FileExistsError:
+                    pass
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        self.evict(keep=cached_path)
+        return path
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        """
+        Removes least recently used cached images but keep, until the rest
+        takes at most max_bytes. Scratch spaces of attach() keep all of them.
+        """
+        if self.max_bytes is None:
+            return
+        entries = []
+        for entry in os.scandir(self.cache_directory):
+            if '.tmp.' in entry.name:
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    @property
+    def size(self) -> int:
+        """
+        Size of cached images.
+        """
+        total = 0
+        for entry in os.scandir(self.cache_directory):
+            try:
+                total += entry.stat().st_size
+            except FileNotFoundError:
+                pass
+        return total
+
+    def cleanup(self) -> None:
+        """
+        Removes the directory of the namespace, or of the whole scratch space,
+        if it is not one.
+        """
+        shutil.rmtree(
+            self.namespace_directory or self.directory, ignore_errors=True)
+
+
+_scratch_spaces: Dict[Tuple[bool, int], ScratchSpace] = {}
+_scratch_spaces_lock = threading.Lock()
+
+
+def get_scratch_space(
+        in_memory: bool = False,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+) -> ScratchSpace:
+    """
+    Scratch space shared by verifications of the current process with the
+    same settings. It is removed when the process exits.
+    """
+    key = (in_memory, max_bytes)
+    with _scratch_spaces_lock:
+        if key not in _scratch_spaces:
+            scratch_space = ScratchSpace(
+                max_bytes=max_bytes, in_memory=in_memory)
+            atexit.register(scratch_space.cleanup)
+            _scratch_spaces[key] = scratch_space
+        return _scratch_spaces[key]
+
+
+def get_default_scratch_space() -> ScratchSpace:
+    """
+    Scratch space of the current process with default settings, for images
+    converted outside of a verification.
+    """
+    return get_scratch_space()
@@ -76,44 +76,16 @@ def compare_psnr(im_true, im_test, data_range=None):
 
 def compare_ssim(X, Y, win_size=None, gradient=False,
                  data_range=None, multichannel=False, gaussian_weights=False,
-                 full=False, **kwargs):
-    
-    _assert_compatible(X, Y)
+                 full=False, dtype=np.float64, **kwargs):
+    """
+    Multichannel images are not split into channels, all of them are filtered
+    at once with a window spanning a single channel. Filtering along the last
+    axis is skipped, so results are the same as when comparing channels
+    separately and averaging. `dtype` selects the precision of computation,
+    np.float32 halves the memory of intermediate images.
+    """
 
-    if multichannel:
-        # loop over channels
-        args = dict(win_size=win_size,
-                    gradient=gradient,
-                    data_range=data_range,
-                    multichannel=False,
-                    gaussian_weights=gaussian_weights,
-                    full=full)
-        args.update(kwargs)
-        nch = X.shape[-1]
-        mssim = np.empty(nch)
-        if gradient:
-            G = np.empty(X.shape)
-        if full:
-            S = np.empty(X.shape)
-        for ch in range(nch):
-            ch_result = compare_ssim(X[..., ch], Y[..., ch], **args)
-            if gradient and full:
-                mssim[..., ch], G[..., ch], S[..., ch] = ch_result
-            elif gradient:
-                mssim[..., ch], G[..., ch] = ch_result
-            elif full:
-                mssim[..., ch], S[..., ch] = ch_result
-            else:
-                mssim[..., ch] = ch_result
-        mssim = mssim.mean()
-        if gradient and full:
-            return mssim, G, S
-        elif gradient:
-            return mssim, G
-        elif full:
-            return mssim, S
-        else:
-            return mssim
+    _assert_compatible(X, Y)
 
     K1 = kwargs.pop('K1', 0.01)
     K2 = kwargs.pop('K2', 0.03)
@@ -132,7 +104,11 @@ def compare_ssim(X, Y, win_size=None, gradient=False,
         else:
             win_size = 7   # backwards compatibility
 
-    if np.any((np.asarray(X.shape) - win_size) < 0):
+    ndim = X.ndim - 1 if multichannel else X.ndim
+    spatial_shape = np.asarray(X.shape[:ndim])
+    channel_axes = X.ndim - ndim
+
+    if np.any((spatial_shape - win_size) < 0):
         raise ValueError(
             "win_size exceeds image extent.  If the input is a multichannel "
             "(color) image, set multichannel=True.")
@@ -147,21 +123,19 @@ def compare_ssim(X, Y, win_size=None, gradient=False,
         dmin, dmax = dtype_range[X.dtype.type]
         data_range = dmax - dmin
 
-    ndim = X.ndim
-
     if gaussian_weights:
         # sigma = 1.5 to approximately match filter in Wang et. al. 2004
         # this ends up giving a 13-tap rather than 11-tap Gaussian
         filter_func = gaussian_filter
-        filter_args = {'sigma': sigma}
+        filter_args = {'sigma': (sigma,) * ndim + (0,) * channel_axes}
 
     else:
         filter_func = uniform_filter
-        filter_args = {'size': win_size}
+        filter_args = {'size': (win_size,) * ndim + (1,) * channel_axes}
 
     # ndimage filters need floating point data
-    X = X.astype(np.float64)
-    Y = Y.astype(np.float64)
+    X = X.astype(dtype)
+    Y = Y.astype(dtype)
 
     NP = win_size ** ndim
 
@@ -171,34 +145,72 @@ def compare_ssim(X, Y, win_size=None, gradient=False,
     else:
         cov_norm = 1.0  # population covariance to match Wang et. al. 2004
 
+    # Intermediate images are computed in place wherever possible, to keep
+    # the number of image sized temporaries low. Filtering in place is safe,
+    # ndimage filters every following axis in place themselves.
+
     # compute (weighted) means
     ux = filter_func(X, **filter_args)
     uy = filter_func(Y, **filter_args)
 
     # compute (weighted) variances and covariances
-    uxx = filter_func(X * X, **filter_args)
-    uyy = filter_func(Y * Y, **filter_args)
-    uxy = filter_func(X * Y, **filter_args)
-    vx = cov_norm * (uxx - ux * ux)
-    vy = cov_norm * (uyy - uy * uy)
-    vxy = cov_norm * (uxy - ux * uy)
+    vxy = X * Y
+    filter_func(vxy, output=vxy, **filter_args)
+    if gradient:
+        vx = X * X
+        vy = Y * Y
+    else:
+        vx = np.multiply(X, X, out=X)
+        vy = np.multiply(Y, Y, out=Y)
+        del X, Y
+    filter_func(vx, output=vx, **filter_args)
+    filter_func(vy, output=vy, **filter_args)
 
     R = data_range
     C1 = (K1 * R) ** 2
     C2 = (K2 * R) ** 2
 
-    A1, A2, B1, B2 = ((2 * ux * uy + C1,
-                       2 * vxy + C2,
-                       ux ** 2 + uy ** 2 + C1,
-                       vx + vy + C2))
-    D = B1 * B2
-    S = (A1 * A2) / D
+    A1 = ux * uy
+    if gradient:
+        B1 = ux * ux
+        uy_squared = uy * uy
+    else:
+        B1 = np.multiply(ux, ux, out=ux)
+        uy_squared = np.multiply(uy, uy, out=uy)
+        del ux, uy
+    vx -= B1
+    vx *= cov_norm
+    vy -= uy_squared
+    vy *= cov_norm
+    vxy -= A1
+    vxy *= cov_norm
+    B1 += uy_squared
+    B1 += C1
+    del uy_squared
+    A1 *= 2
+    A1 += C1
+
+    A2 = vxy
+    A2 *= 2
+    A2 += C2
+    B2 = vx
+    B2 += vy
+    B2 += C2
+    del vy
+    if gradient:
+        D = B1 * B2
+        S = A1 * A2
+    else:
+        D = np.multiply(B1, B2, out=B1)
+        S = np.multiply(A1, A2, out=A1)
+    S /= D
 
     # to avoid edge effects will ignore filter radius strip around edges
     pad = (win_size - 1) // 2
 
     # compute (weighted) mean of ssim
-    mssim = crop(S, pad).mean()
+    mssim = crop(S, ((pad, pad),) * ndim + ((0, 0),) * channel_axes).mean(
+        dtype=np.float64)
 
     if gradient:
         # The following is Eqs. 7-8 of Avanaki 2009.
@@ -206,7 +218,7 @@ def compare_ssim(X, Y, win_size=None, gradient=False,
         grad += filter_func(-S / B2, **filter_args) * Y
         grad += filter_func((ux * (A2 - A1) - uy * (B2 - B1) * S) / D,
                             **filter_args)
-        grad *= (2 / X.size)
+        grad *= (2 / spatial_shape.prod())
 
         if full:
             return mssim, grad, S
@@ -1,30 +1,79 @@
 import numpy
+from .image_pair import ImagePair, PairMetric
 from .skimage import compare_ssim
 
 import sys
 
 
+SSIM_WIN_SIZE = 7
+SSIM_PAD = (SSIM_WIN_SIZE - 1) // 2
+# Approximate number of image sized arrays used by compare_ssim()
+SSIM_ARRAYS_PER_PIXEL = 3 * 10
+
+
 ## ======================= ##
 ##
-class MetricSSIM:
+class MetricSSIM(PairMetric):
 
     ## ======================= ##
     ##
     @staticmethod
-    def compute_metrics(image1, image2):
-        image1 = image1.convert("RGB")
-        image2 = image2.convert("RGB")
+    def compute_pair_metrics(pair: ImagePair, dtype=numpy.float64):
+        tiles = list(pair.row_tiles(
+            SSIM_ARRAYS_PER_PIXEL * numpy.dtype(dtype).itemsize,
+            halo=SSIM_PAD,
+            min_rows=SSIM_WIN_SIZE
+        ))
+        if len(tiles) == 1:
+            np_image1, np_image2 = pair.uint8
 
-        np_image1 = numpy.array(image1)
-        np_image2 = numpy.array(image2)
-
-        structualSim = compare_ssim(np_image1, np_image2, multichannel=True)
+            structualSim = compare_ssim(
+                np_image1,
+                np_image2,
+                win_size=SSIM_WIN_SIZE,
+                multichannel=True,
+                dtype=dtype
+            )
+        else:
+            structualSim = MetricSSIM.compute_tiled_ssim(pair, tiles, dtype)
 
         result = dict()
         result["ssim"] = structualSim
 
         return result
 
+    ## ======================= ##
+    ##
+    @staticmethod
+    def compute_tiled_ssim(pair: ImagePair, tiles, dtype=numpy.float64):
+        """
+        Computes mean SSIM over row tiles with a halo of SSIM_PAD rows, so
+        every pixel of a tile is computed from the same neighbourhood as in
+        whole images. Results differ from compare_ssim() only by rounding
+        of sums.
+        """
+        width, height = pair.size
+        total = 0.
+        for tile in tiles:
+            _, ssim_map = compare_ssim(
+                tile.images[0],
+                tile.images[1],
+                win_size=SSIM_WIN_SIZE,
+                multichannel=True,
+                full=True,
+                dtype=dtype
+            )
+            # Pixels closer than SSIM_PAD to borders of whole images are
+            # not averaged, as in compare_ssim()
+            first_row = max(tile.start, SSIM_PAD) - tile.halo_start
+            last_row = min(tile.stop, height - SSIM_PAD) - tile.halo_start
+            total += ssim_map[
+                first_row:last_row,
+                SSIM_PAD:width - SSIM_PAD
+            ].sum(dtype=numpy.float64)
+        count = (height - 2 * SSIM_PAD) * (width - 2 * SSIM_PAD) * 3
+        return total / count
+
     ## ======================= ##
     ##
     @staticmethod
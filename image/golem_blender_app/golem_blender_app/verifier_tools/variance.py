@@ -1,27 +1,20 @@
-import numpy
+from .image_pair import ImagePair, PairMetric
 
 
 ## ======================= ##
 ##
-class ImageVariance:
+class ImageVariance(PairMetric):
 
     ## ======================= ##
     ##
     @staticmethod
-    def compute_metrics(image1, image2):
-        image1 = image1.convert("RGB")
-        image2 = image2.convert("RGB")
+    def compute_pair_metrics(pair: ImagePair):
+        variances = pair.statistics.variances
 
-        np_image1 = numpy.array(image1)
-        np_image2 = numpy.array(image2)
-
-        reference_variance = numpy.var(np_image1, axis=(0, 1))
-        image_variance = numpy.var(np_image2, axis=(0, 1))
-
-        reference_variance = reference_variance[0] + reference_variance[1] + \
-                             reference_variance[2]
-        image_variance = image_variance[0] + image_variance[1] + \
-                         image_variance[2]
+        reference_variance = variances[0][0] + variances[0][1] + \
+                             variances[0][2]
+        image_variance = variances[1][0] + variances[1][1] + \
+                         variances[1][2]
 
         result = dict()
         result["reference_variance"] = reference_variance
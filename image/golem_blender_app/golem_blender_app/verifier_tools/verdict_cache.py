@@ -0,0 +1,174 @@
+import functools
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+from .image_metrics import METRICS_FILENAME, USAGE_FILENAME, VERDICT_FILENAME
+
+
+DEFAULT_MAX_ENTRIES = 256
+# Files written by write_verdict() besides the verdict, with options they are
+# written with
+OUTPUT_FILES = {
+    METRICS_FILENAME: {'separators': (',', ':'), 'sort_keys': True},
+    USAGE_FILENAME: {'indent': 4, 'sort_keys': True},
+}
+SCENE_DIGESTS_CACHE_SIZE = 16
+_CHUNK_SIZE = 1 << 20
+
+
+def file_digest(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=SCENE_DIGESTS_CACHE_SIZE)
+def _versioned_file_digest(path: str, size: int, mtime_ns: int) -> str:
+    return file_digest(path)
+
+
+def scene_file_digest(path) -> str:
+    """
+    Digest of the scene file, computed once per its path, size and
+    modification time, as all subtasks of a task share the scene file.
+    """
+    stat = os.stat(str(path))
+    return _versioned_file_digest(str(path), stat.st_size, stat.st_mtime_ns)
+
+
+def get_cache_key(
+        scene_file_path,
+        render_parameters: Dict[str, Any],
+        subtask_file_paths: Iterable,
+        crops_borders: Optional[List[List[float]]] = None,
+) -> str:
+    """
+    Computes the key of a verification from contents of the scene file and
+    of the provider's result files, and from parameters of rendering.
+    Random crops are not part of the key, so any verification of the same
+    result bytes is answered with the first verdict. Explicit crops_borders
+    are part of the key.
+    """
+    key = {
+        'scene_file': scene_file_digest(scene_file_path),
+        'render_parameters': render_parameters,
+        'results': sorted(
+            (os.path.basename(str(path)), file_digest(path))
+            for path in subtask_file_paths
+        ),
+        'crops_borders': crops_borders,
+    }
+    return hashlib.sha256(
+        json.dumps(key, sort_keys=True).encode('utf-8')
+    ).hexdigest()
+
+
+def collect_outputs(output_dir) -> Dict[str, Any]:
+    """
+    Reads files written by write_verdict() to output_dir, other than
+    the verdict, keyed by their names.
+    """
+    outputs = dict()
+    for filename in OUTPUT_FILES:
+        try:
+            with open(os.path.join(output_dir, filename), 'r') as f:
+                outputs[filename] = json.load(f)
+        except FileNotFoundError:
+            pass
+    return outputs
+
+
+class VerdictCache:
+    """
+    VerdictCache stores verdicts and metrics of verifications in a directory,
+    one JSON file per key. Reading an entry marks it as recently used, by its
+    modification time, and least recently used entries are evicted once there
+    are more than max_entries of them.
+    """
+
+    def __init__(
+            self,
+            directory,
+            max_entries: int = DEFAULT_MAX_ENTRIES
+    ) -> None:
+        if max_entries < 1:
+            raise ValueError(f"max_entries must be positive: {max_entries}")
+        self._directory = Path(directory)
+        self._max_entries = max_entries
+        self._directory.mkdir(parents=True, exist_ok=True)
+
+    def _entry_path(self, key: str) -> Path:
+        return self._directory / f'{key}.json'
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        :return: {'verdict': bool, 'outputs': {filename: contents}} stored
+        under the key, or None if there is no such entry.
+        """
+        path = self._entry_path(key)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return entry
+
+    def put(
+            self,
+            key: str,
+            verdict: bool,
+            outputs: Optional[Dict[str, Any]] = None
+    ) -> None:
+        entry = {'verdict': verdict, 'outputs': outputs or {}}
+        # Entries are written atomically, as verifications of other subtasks
+        # may read the cache concurrently.
+        fd, tmp_path = tempfile.mkstemp(
+            dir=str(self._directory), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, str(self._entry_path(key)))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self._evict()
+
+    def _evict(self) -> None:
+        entries = []
+        for path in self._directory.glob('*.json'):
+            try:
+                entries.append((path.stat().st_mtime, path))
+            except FileNotFoundError:
+                pass
+        entries.sort()
+        for _, path in entries[:max(0, len(entries) - self._max_entries)]:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self._directory.glob('*.json'))
+
+
+def restore_outputs(
+        output_dir,
+        verdict: bool,
+        outputs: Dict[str, Any]
+) -> None:
+    """
+    Writes the cached verdict and files collected by collect_outputs()
+    to output_dir, as write_verdict() did.
+    """
+    with open(os.path.join(output_dir, VERDICT_FILENAME), 'w') as f:
+        json.dump({'verdict': verdict}, f)
+    for filename, contents in outputs.items():
+        with open(os.path.join(output_dir, filename), 'w') as f:
+            json.dump(contents, f, **OUTPUT_FILES[filename])
@@ -1,14 +1,40 @@
+import asyncio
+import dataclasses
+import functools
 import json
 import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 from pprint import pprint
-from typing import List, Optional, Tuple, Any, Dict
+from typing import List, NamedTuple, Optional, Tuple, Any, Dict
+
+import numpy
 
 from ..render_tools import blender_render as blender
+from ..render_tools.blender_worker import BlenderWorkerPool, get_default_pool
 from .crop_generator import FloatingPointBox, Crop, \
     Resolution
 from .file_extension.matcher import get_expected_extension
-from .image_metrics_calculator import calculate_metrics
+from .image_metrics import (
+    ImgageMetrics,
+    METRICS_FILENAME,
+    USAGE_FILENAME,
+    VERDICT_FILENAME,
+)
+from .scratch_space import (
+    DEFAULT_MAX_BYTES,
+    get_default_scratch_space,
+    get_scratch_space,
+    ScratchSpace,
+)
+from .image_metrics_calculator import (
+    calculate_metrics_and_usage,
+    classify_metrics,
+    get_image_size,
+    ProviderFrames,
+    VERIFICATION_SUCCESS,
+)
 
 
 def get_crop_with_id(id: int, crops: [List[Crop]]) -> Optional[Crop]:
@@ -105,44 +131,459 @@ def prepare_data_for_blender_verification(  # pylint: disable=too-many-locals, t
     return crops, blender_render_parameters
 
 
-def make_verdict(
+def get_crops_rows(crops: List[Crop]) -> Tuple[int, int]:
+    """
+    Range of rows of the provider's result covered by any of the crops.
+    """
+    return (
+        min(crop.y_pixels[0] for crop in crops),
+        # Reference crops may be a row taller due to rounding
+        max(crop.y_pixels[1] for crop in crops) + 1,
+    )
+
+
+class CropComparison(NamedTuple):
+    """
+    Comparison of a reference crop with the corresponding fragment of
+    a frame rendered by the provider.
+    """
+    crop_path: str
+    providers_result_image_path: str
+    left: int
+    top: int
+    name: str
+    monitor_usage: bool
+    memory_budget: Optional[int] = None
+    # If False, all metrics are computed and left to classify_metrics()
+    classify: bool = True
+    # Crop taken by ProviderFrames, the result image is not read if given
+    providers_result_crop: Optional[numpy.ndarray] = None
+    # Directories of the ScratchSpace and of the namespace of
+    # the verification, see attach()
+    scratch_dir: Optional[str] = None
+    scratch_namespace_dir: Optional[str] = None
+
+
+class CropResult(NamedTuple):
+    """
+    Metrics of a CropComparison, with the label assigned by the classifier,
+    and usage, if monitored.
+    """
+    name: str
+    metrics: ImgageMetrics
+    usage: Optional[Dict[str, Any]] = None
+
+
+def compare_crop(comparison: CropComparison) -> CropResult:
+    """
+    Runs calculate_metrics() for the comparison, possibly in a worker process.
+    Metrics are returned in memory, they are written once for all crops by
+    write_verdict().
+    """
+    scratch_space = None
+    if comparison.scratch_dir is not None:
+        scratch_space = ScratchSpace.attach(
+            comparison.scratch_dir, comparison.scratch_namespace_dir)
+    metrics, usage = calculate_metrics_and_usage(
+        comparison.crop_path,
+        comparison.providers_result_image_path,
+        comparison.left,
+        comparison.top,
+        monitor_usage=comparison.monitor_usage,
+        memory_budget=comparison.memory_budget,
+        classify=comparison.classify,
+        providers_result_crop=comparison.providers_result_crop,
+        scratch_space=scratch_space
+    )
+    print(f"{comparison.name}: {metrics.Label}")
+    return CropResult(comparison.name, metrics, usage)
+
+
+def is_success(result: CropResult) -> bool:
+    return result.metrics.Label == VERIFICATION_SUCCESS
+
+
+def compare_crops(
+        comparisons: List[CropComparison],
+        max_workers: Optional[int] = None,
+        fail_fast: bool = False,
+) -> List[CropResult]:
+    """
+    Runs compare_crop() for all comparisons on a pool of at most max_workers
+    processes (by default, the number of CPUs). With a single worker, or
+    a single comparison, they are run in the current process.
+    With fail_fast, comparisons that did not start yet are cancelled as soon
+    as any of them fails, and the function returns once those already running
+    are done, so that images they convert can be removed afterwards.
+    :return: results of completed comparisons, in order of comparisons
+    """
+    max_workers = min(max_workers or os.cpu_count() or 1, len(comparisons))
+    if max_workers <= 1:
+        results = []
+        for comparison in comparisons:
+            results.append(compare_crop(comparison))
+            if fail_fast and not is_success(results[-1]):
+                break
+        return results
+
+    executor = ProcessPoolExecutor(max_workers=max_workers)
+    futures = [
+        executor.submit(compare_crop, comparison)
+        for comparison in comparisons
+    ]
+    try:
+        if not fail_fast:
+            return [future.result() for future in futures]
+        for future in as_completed(futures):
+            if not is_success(future.result()):
+                break
+        return [
+            future.result() for future in futures
+            if future.done() and not future.cancelled()
+        ]
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def get_crop_comparisons(  # pylint: disable=too-many-arguments
+        providers_result_images_paths: List[str],
+        crop: Crop,
+        crop_data: Dict[str, Any],
+        output_dir: Path,
+        monitor_usage: bool = False,
+        memory_budget: Optional[int] = None,
+        frames: Optional[ProviderFrames] = None,
+        scratch_space: Optional[ScratchSpace] = None,
+) -> List[CropComparison]:
+    """
+    Lists comparisons of a rendered reference crop, one for each frame.
+    With frames, crops of the provider's results are taken from frames
+    decoded once for all crops. Comparisons convert images if needed
+    in the scratch_space.
+    """
+    comparisons = []
+    left, top = crop.x_pixels[0], crop.y_pixels[0]
+    print('borders_x: ', crop_data['crop']['borders_x'])
+    print('borders_y: ', crop_data['crop']['borders_y'])
+    print("left: " + str(left))
+    print("top: " + str(top))
+
+    for crop_result, providers_result_image_path in zip(
+            crop_data['results'], providers_result_images_paths):
+        crop_path = get_crop_path(output_dir, crop_result)
+        providers_result_crop = None
+        if frames is not None:
+            try:
+                providers_result_crop = frames.crop(
+                    providers_result_image_path,
+                    left, top,
+                    *get_image_size(crop_path)
+                )
+            except Exception as e:  # pylint: disable=broad-except
+                # The comparison reads images itself and reports the error
+                print("There were errors %r" % e, file=sys.stderr)
+        # Metrics of each frame are stored under the name of its crop,
+        # e.g. crop0_0001
+        comparisons.append(CropComparison(
+            crop_path,
+            providers_result_image_path,
+            left, top,
+            os.path.splitext(crop_result)[0],
+            monitor_usage,
+            memory_budget,
+            providers_result_crop=providers_result_crop,
+            scratch_dir=(
+                scratch_space.directory if scratch_space is not None
+                else None
+            ),
+            scratch_namespace_dir=(
+                scratch_space.namespace_directory
+                if scratch_space is not None else None
+            )
+        ))
+    return comparisons
+
+
+def make_verdict(  # pylint: disable=too-many-arguments
         providers_result_images_paths: List[str],
         crops: List[Crop],
         reference_results: List[Dict[str, Any]],
         output_dir: Path,
-) -> None:
-    verdict = True
+        monitor_usage: bool = False,
+        max_workers: Optional[int] = None,
+        fail_fast: bool = False,
+        memory_budget: Optional[int] = None,
+        save_metrics: bool = True,
+        lazy: bool = True,
+        scratch_space: Optional[ScratchSpace] = None,
+) -> bool:
+    """
+    Compares rendered reference crops with the provider's results and
+    classifies them. If lazy, each crop is classified by its comparison,
+    computing only metrics on its path through the decision tree. Otherwise
+    all metrics are computed and crops of all frames are classified in
+    a single call once all comparisons are done, so fail_fast does not apply.
+    Images are converted if needed in the scratch_space, by default in
+    a namespace of the one of the current process removed afterwards,
+    least recently used ones are evicted from the given one once all
+    comparisons are done.
+    """
+    own_scratch_space = scratch_space is None
+    if own_scratch_space:
+        scratch_space = get_default_scratch_space().namespace()
+    try:
+        comparisons = []
+        frames = ProviderFrames(get_crops_rows(crops))
+        for crop_data in reference_results:
+            comparisons.extend(get_crop_comparisons(
+                providers_result_images_paths,
+                get_crop_with_id(crop_data['crop']['id'], crops),
+                crop_data,
+                output_dir,
+                monitor_usage,
+                memory_budget,
+                frames,
+                scratch_space
+            ))
+
+        if lazy:
+            results = compare_crops(comparisons, max_workers, fail_fast)
+        else:
+            results = compare_crops(
+                [
+                    comparison._replace(classify=False)
+                    for comparison in comparisons
+                ],
+                max_workers
+            )
+            classify_metrics([result.metrics for result in results])
+    finally:
+        if own_scratch_space:
+            scratch_space.cleanup()
+        else:
+            scratch_space.evict()
+    verdict = all(is_success(result) for result in results)
+    write_verdict(output_dir, verdict, results, reference_results,
+                  monitor_usage, save_metrics)
+    return verdict
 
-    for crop_data in reference_results:
-        crop = get_crop_with_id(crop_data['crop']['id'], crops)
-
-        left, top = crop.x_pixels[0], crop.y_pixels[0]
-        print('borders_x: ', crop_data['crop']['borders_x'])
-        print('borders_y: ', crop_data['crop']['borders_y'])
-        print("left: " + str(left))
-        print("top: " + str(top))
-
-        for crop, providers_result_image_path in zip(
-                crop_data['results'], providers_result_images_paths):
-            crop_path = get_crop_path(output_dir, crop)
-            results_path = calculate_metrics(
-                crop_path,
-                providers_result_image_path,
-                left, top,
-                metrics_output_filename=os.path.join(
-                    output_dir,
-                    crop_data['crop']['outfilebasename'] + "metrics.txt")
+
+async def render_and_make_verdict(  # pylint: disable=too-many-arguments
+        providers_result_images_paths: List[str],
+        crops: List[Crop],
+        blender_render_parameters: Dict[str, Any],
+        mounted_paths: Dict[str, str],
+        monitor_usage: bool = False,
+        max_workers: Optional[int] = None,
+        fail_fast: bool = False,
+        memory_budget: Optional[int] = None,
+        save_metrics: bool = True,
+        scratch_space: Optional[ScratchSpace] = None,
+        single_render_session: bool = False,
+        max_concurrent_renders: Optional[int] = None,
+        worker_pool: Optional[BlenderWorkerPool] = None,
+) -> bool:
+    """
+    Renders reference crops and makes the verdict as make_verdict() with
+    lazy metrics. Each frame of a crop is compared as soon as Blender saves
+    it, while later frames and crops are still rendered. With fail_fast,
+    once any comparison fails, rendering and comparisons still pending are
+    cancelled and the verdict is made once those already running are done.
+    Images are converted as by make_verdict().
+    With single_render_session, all crops are rendered by a single Blender
+    process, see blender_render.render_in_single_session().
+    With a worker_pool, crops are rendered by a Blender process which keeps
+    the scene loaded, see blender_render.render().
+    """
+    own_scratch_space = scratch_space is None
+    if own_scratch_space:
+        scratch_space = get_default_scratch_space().namespace()
+    loop = asyncio.get_event_loop()
+    output_dir = mounted_paths['OUTPUT_DIR']
+    executor = ProcessPoolExecutor(max_workers=max_workers or os.cpu_count())
+    # Comparisons of each rendered frame are listed by a task, as crops of
+    # results are taken from frames which may still be decoded.
+    preparing: List[asyncio.Future] = []
+    futures: List[asyncio.Future] = []
+    failed = asyncio.Event()
+    # Frames are decoded while Blender renders the reference crops
+    frames = ProviderFrames(get_crops_rows(crops))
+    loop.run_in_executor(
+        None, frames.preload, providers_result_images_paths)
+
+    def on_compared(future):
+        if future.cancelled() or future.exception() is not None \
+                or not is_success(future.result()):
+            failed.set()
+
+    def on_prepared(task):
+        if task.cancelled() or task.exception() is not None:
+            failed.set()
+
+    async def compare_frame(crop_data, frame_index):
+        comparisons = await loop.run_in_executor(None, functools.partial(
+            get_crop_comparisons,
+            [providers_result_images_paths[frame_index]],
+            get_crop_with_id(crop_data['crop']['id'], crops),
+            {
+                'crop': crop_data['crop'],
+                'results': [crop_data['results'][frame_index]],
+            },
+            output_dir,
+            monitor_usage,
+            memory_budget,
+            frames,
+            scratch_space
+        ))
+        for comparison in comparisons:
+            future = loop.run_in_executor(executor, compare_crop, comparison)
+            future.add_done_callback(on_compared)
+            futures.append(future)
+
+    def on_frame_rendered(crop_data, frame_index):
+        if frame_index >= len(providers_result_images_paths):
+            return
+        task = asyncio.ensure_future(compare_frame(crop_data, frame_index))
+        task.add_done_callback(on_prepared)
+        preparing.append(task)
+
+    async def wait_for_comparisons():
+        if preparing:
+            await asyncio.wait(preparing)
+        if futures:
+            await asyncio.wait(futures)
+
+    render = asyncio.ensure_future(blender.render(
+        blender_render_parameters,
+        mounted_paths,
+        monitor_usage=monitor_usage,
+        on_frame_rendered=on_frame_rendered,
+        single_session=single_render_session,
+        max_concurrency=max_concurrent_renders,
+        worker_pool=worker_pool,
+    ))
+    # Without fail_fast, a failed comparison never stops the others
+    failure = asyncio.ensure_future(failed.wait()) if fail_fast \
+        else loop.create_future()
+    reference_results: List[Dict[str, Any]] = []
+    try:
+        await asyncio.wait(
+            [render, failure],
+            return_when=asyncio.FIRST_COMPLETED
+        )
+        if not failure.done():
+            reference_results = render.result()
+            print("results:")
+            pprint(reference_results)
+            compared = asyncio.ensure_future(wait_for_comparisons())
+            await asyncio.wait(
+                [compared, failure],
+                return_when=asyncio.FIRST_COMPLETED
             )
-            print("results_path: ", results_path)
-            with open(results_path, 'r') as f:
-                data = json.load(f)
-            if data['Label'] != "TRUE":
-                verdict = False
+            compared.cancel()
+    finally:
+        # Cancelling the render terminates Blender
+        render.cancel()
+        failure.cancel()
+        for future in preparing + futures:
+            future.cancel()
+        # Workers convert images in the scratch space until they are done
+        await loop.run_in_executor(None, executor.shutdown)
+        if own_scratch_space:
+            scratch_space.cleanup()
+        else:
+            scratch_space.evict()
+
+    results = []
+    for future in futures:
+        if not future.done() or future.cancelled():
+            continue
+        if future.exception() is not None:
+            # The verdict is negative already, see on_compared()
+            print("There were errors %r" % future.exception(),
+                  file=sys.stderr)
+            continue
+        results.append(future.result())
+    verdict = not failed.is_set() \
+        and all(is_success(result) for result in results)
+    await loop.run_in_executor(None, functools.partial(
+        write_verdict,
+        output_dir, verdict, results, reference_results,
+        monitor_usage, save_metrics
+    ))
+    return verdict
+
 
-    with open(os.path.join(output_dir, 'verdict.json'), 'w') as f:
+def write_verdict(  # pylint: disable=too-many-arguments
+        output_dir: Path,
+        verdict: bool,
+        results: List[CropResult],
+        reference_results: List[Dict[str, Any]],
+        monitor_usage: bool = False,
+        save_metrics: bool = True,
+) -> None:
+    """
+    Writes the verdict and, if save_metrics, metrics of all compared crops
+    to a single compact METRICS_FILENAME, keyed by names of crops.
+    """
+    with open(os.path.join(output_dir, VERDICT_FILENAME), 'w') as f:
         json.dump({'verdict': verdict}, f)
 
-    return verdict
+    if save_metrics:
+        with open(os.path.join(output_dir, METRICS_FILENAME), 'w') as f:
+            json.dump(
+                {result.name: result.metrics.to_dict() for result in results},
+                f,
+                separators=(',', ':'),
+                sort_keys=True
+            )
+
+    if monitor_usage:
+        with open(os.path.join(output_dir, USAGE_FILENAME), 'w') as f:
+            json.dump(
+                summarize_usage(
+                    [result.usage for result in results],
+                    reference_results
+                ),
+                f,
+                indent=4,
+                sort_keys=True
+            )
+
+
+def summarize_usage(
+        crops_usage: List[Dict[str, Any]],
+        reference_results: List[Dict[str, Any]],
+) -> Dict[str, Any]:
+    """
+    Aggregates usage of all compared crops, as written by calculate_metrics(),
+    and of rendering the reference crops, if it was monitored. Times are
+    summed, mem_peak is the maximum.
+    """
+    def add(summary, usage):
+        summary['count'] = summary.get('count', 0) + 1
+        summary['real_time'] = summary.get('real_time', 0.) \
+            + usage['real_time']
+        summary['cpu_time'] = summary.get('cpu_time', 0.) + usage['cpu_time']
+        summary['mem_peak'] = max(
+            summary.get('mem_peak', 0.), usage['mem_peak'])
+
+    summary: Dict[str, Any] = {'metrics': {}, 'other': {}, 'total': {}}
+    for crop_usage in crops_usage:
+        for name, usage in crop_usage['metrics'].items():
+            add(summary['metrics'].setdefault(name, {}), usage)
+        add(summary['other'], crop_usage['other'])
+        add(summary['total'], crop_usage['total'])
+
+    for crop_data in reference_results:
+        if 'usage' in crop_data:
+            add(
+                summary.setdefault('render', {}),
+                dataclasses.asdict(crop_data['usage'])
+            )
+    return summary
 
 
 def get_crop_path(parent: str, filename: str) -> str:
@@ -183,7 +624,18 @@ async def verify(  # pylint: disable=too-many-arguments
         mounted_paths: Dict[str, str],
         crops_count: int = 3,
         crops_borders: Optional[List[List[float]]] = None,
-) -> None:
+        monitor_usage: bool = False,
+        max_workers: Optional[int] = None,
+        fail_fast: bool = False,
+        memory_budget: Optional[int] = None,
+        save_metrics: bool = True,
+        lazy: bool = True,
+        scratch_in_memory: bool = False,
+        scratch_max_bytes: int = DEFAULT_MAX_BYTES,
+        single_render_session: bool = False,
+        max_concurrent_renders: Optional[int] = None,
+        use_blender_worker: bool = False,
+) -> bool:
     """
     Function will verify image with crops rendered from given blender
     scene file.
@@ -202,6 +654,34 @@ async def verify(  # pylint: disable=too-many-arguments
     crops_borders - list of [left, top, right, bottom] float decimal
                     values lists, representing crops borders
                     those will be used instead of random crops, if present.
+    monitor_usage - measure time and memory used to render crops and by
+                    each metric, see make_verdict()
+    max_workers - maximal number of processes computing metrics of crops,
+                  by default the number of CPUs
+    fail_fast - stop rendering and comparing crops once any of them fails,
+                see render_and_make_verdict()
+    memory_budget - approximate memory in bytes for metrics of a crop,
+                    they are computed in tiles if needed
+    save_metrics - write metrics of all crops to METRICS_FILENAME in
+                   the output directory, see write_verdict()
+    lazy - compute only metrics needed to classify each crop, comparing
+           crops while others are rendered, see render_and_make_verdict(),
+           otherwise all metrics of all crops are computed after they are
+           rendered and classified at once, without fail_fast,
+           see make_verdict()
+    scratch_in_memory - keep images converted during verification in
+                        a RAM-backed directory, if available
+    scratch_max_bytes - size of converted images kept for reuse by later
+                        verifications of the process
+    single_render_session - render all crops in a single Blender process
+    max_concurrent_renders - maximal number of Blender processes rendering
+                             crops at the same time, if not rendered in
+                             a single process, by default as many as CPUs
+                             are split between, see
+                             blender_render.partition_threads()
+    use_blender_worker - render crops by a Blender process which keeps
+                         the scene loaded for later verifications,
+                         see blender_worker.BlenderWorker
     """
 
     (crops,
@@ -217,14 +697,58 @@ async def verify(  # pylint: disable=too-many-arguments
     )
     print("blender_render_params:")
     pprint(blender_render_parameters)
-    results = await blender.render(blender_render_parameters, mounted_paths)
-
-    print("results:")
-    pprint(results)
+    # Images converted by earlier verifications of the process are reused
+    scratch_space = get_scratch_space(
+        in_memory=scratch_in_memory,
+        max_bytes=scratch_max_bytes,
+    ).namespace()
+    worker_pool = get_default_pool() if use_blender_worker else None
+    try:
+        if lazy:
+            return await render_and_make_verdict(
+                subtask_file_paths,
+                crops,
+                blender_render_parameters,
+                mounted_paths,
+                monitor_usage,
+                max_workers,
+                fail_fast,
+                memory_budget,
+                save_metrics,
+                scratch_space,
+                single_render_session,
+                max_concurrent_renders,
+                worker_pool,
+            )
 
-    return make_verdict(
-        subtask_file_paths,
-        crops,
-        results,
-        mounted_paths['OUTPUT_DIR'],
-    )
+        results = await blender.render(
+            blender_render_parameters,
+            mounted_paths,
+            monitor_usage=monitor_usage,
+            single_session=single_render_session,
+            max_concurrency=max_concurrent_renders,
+            worker_pool=worker_pool,
+        )
+
+        print("results:")
+        pprint(results)
+
+        # Comparisons and writing of metrics do not block the event loop
+        return await asyncio.get_event_loop().run_in_executor(
+            None,
+            functools.partial(
+                make_verdict,
+                subtask_file_paths,
+                crops,
+                results,
+                mounted_paths['OUTPUT_DIR'],
+                monitor_usage,
+                max_workers,
+                memory_budget=memory_budget,
+                save_metrics=save_metrics,
+                lazy=False,
+                scratch_space=scratch_space,
+            )
+        )
+    finally:
+        scratch_space.cleanup()
@@ -2,6 +2,8 @@ import pywt
 import numpy
 from PIL import Image
 
+from .image_pair import ImagePair, PairMetric
+
 import sys
 
 
@@ -9,11 +11,6 @@ def calculate_sum(coefficient):
     return sum(sum(coefficient ** 2))
 
 
-def calculate_size(coefficient):
-    shape = coefficient.shape
-    return shape[0] * shape[1]
-
-
 def calculate_mse(coefficient1, coefficient2, low, high):
     if low == high:
         if low == 0:
@@ -39,169 +36,140 @@ def calculate_mse(coefficient1, coefficient2, low, high):
 
 ## ======================= ##
 ##
-def calculate_frequencies(coefficient1, coefficient2):
-    num_of_levels = len(coefficient1)
-    start_level = num_of_levels - 3
+def get_band_ranges(total_length):
+    one_third_of_length = int(total_length / 3)
+    two_thirds_of_length = int(total_length * 2 / 3)
+    return {
+        "base": (0, 1),
+        "low": (1, 1 + one_third_of_length),
+        "mid": (1 + one_third_of_length, 1 + two_thirds_of_length),
+        "high": (1 + two_thirds_of_length, 1 + total_length),
+    }
 
-    frequencies = list()
 
-    for i in range(start_level, num_of_levels):
-        abs_coeff1 = numpy.absolute(coefficient1[i])
-        abs_coeff2 = numpy.absolute(coefficient2[i])
+## ======================= ##
+##
+def calculate_level_errors(coefficients):
+    """
+    Reduces coefficients of a difference between two images, which thanks
+    to linearity of the transform equal differences of their coefficients.
+    For each level returns the sum of squared coefficients over all channels
+    and the number of coefficients in a single channel.
+    """
+    channels = coefficients[0].shape[0]
+    sums = []
+    counts = []
+    for level in coefficients:
+        if not isinstance(level, tuple):
+            level = (level,)
+        sums.append(sum(
+            numpy.sum(numpy.square(band), dtype=numpy.float64)
+            for band in level
+        ))
+        counts.append(len(level) * (level[0].size // channels))
+    return sums, counts
 
-        sum_coeffs1 = sum(sum(sum(abs_coeff1)))
-        sum_coeffs2 = sum(sum(sum(abs_coeff2)))
 
-        diff = numpy.absolute(sum_coeffs2 - sum_coeffs1) / (
-                    3 * coefficient1[i][0].size)
+## ======================= ##
+##
+def calculate_band_mses(sums, counts):
+    """
+    Batched counterpart of calculate_mse(), returns MSE of each band summed
+    over channels, as all channels have the same number of coefficients.
+    """
+    result = dict()
+    for band, (low, high) in get_band_ranges(len(sums) - 1).items():
+        if low == high:
+            if low == 0:
+                high = low + 1
+            else:
+                low = high - 1
+        count = sum(counts[low:high])
+        result[band] = sum(sums[low:high]) / count if count else 0
+    return result
 
-        frequencies = [diff] + frequencies
+
+## ======================= ##
+##
+def calculate_batched_frequencies(coefficients, channels):
+    """
+    Returns frequency metrics of the three finest levels, summed over
+    channels, from coefficients of both images stacked along channels.
+    """
+    frequencies = list()
+
+    for level in coefficients[-3:]:
+        abs_sums = sum(
+            numpy.absolute(band).sum(axis=(-2, -1), dtype=numpy.float64)
+            for band in level
+        )
+        diff = numpy.absolute(abs_sums[channels:] - abs_sums[:channels]) / (
+            len(level) * (level[0].size // (2 * channels)))
+
+        frequencies = [diff.sum()] + frequencies
 
     return frequencies
 
 
 ## ======================= ##
 ##
-class MetricWavelet:
+def compute_legacy_band_mses(np_image1, np_image2):
+    """
+    Crop is too small for a single decomposition level, so wavedec2() returns
+    input images as approximation coefficients. They are compared per channel
+    in their original dtype, exactly as they always were.
+    """
+    result = dict.fromkeys(get_band_ranges(0), 0)
+    for i in range(np_image1.shape[2]):
+        mse = calculate_mse([np_image1[..., i]], [np_image2[..., i]], 0, 1)
+        for band in result:
+            result[band] += mse
+    return result
+
+
+## ======================= ##
+##
+class MetricWavelet(PairMetric):
+
+    WAVELETS = ["db4", "sym2", "haar"]
+    FREQUENCY_WAVELET = "haar"
 
     ## ======================= ##
     ##
     @staticmethod
-    def compute_metrics(image1, image2):
-
-        image1 = image1.convert("RGB")
-        image2 = image2.convert("RGB")
-
-        np_image1 = numpy.array(image1)
-        np_image2 = numpy.array(image2)
+    def compute_pair_metrics(pair: ImagePair, dtype=numpy.float64):
+        """
+        Band errors are computed from a single decomposition of the
+        difference between images per wavelet, all channels at once.
+        Frequency metrics need coefficients of both images, so those are
+        decomposed together, with channels of the second image stacked
+        after channels of the first one. Decompositions are float64 by
+        default, frequency metrics subtract sums of both images and lose
+        precision in float32.
+        """
+        np_image1, np_image2 = pair.uint8
+        planes1, planes2 = pair.planes
+        channels = planes1.shape[0]
+        difference = numpy.subtract(planes1, planes2, dtype=dtype)
 
         result = dict()
-        result["wavelet_db4_base"] = 0
-        result["wavelet_db4_low"] = 0
-        result["wavelet_db4_mid"] = 0
-        result["wavelet_db4_high"] = 0
-
-        for i in range(0, 3):
-            coefficient1 = pywt.wavedec2(np_image1[..., i], "db4")
-            coefficient2 = pywt.wavedec2(np_image2[..., i], "db4")
-
-            total_length = len(coefficient1) - 1
-            one_third_of_length = int(total_length / 3)
-            two_thirds_of_length = int(total_length * 2 / 3)
-
-            result["wavelet_db4_base"] += calculate_mse(
-                coefficient1,
-                coefficient2,
-                0,
-                1
-            )
-            result["wavelet_db4_low"] = result[
-                "wavelet_db4_low"
-            ] + calculate_mse(
-                coefficient1, coefficient2, 1, 1 + one_third_of_length
-            )
-            result["wavelet_db4_mid"] = result[
-                "wavelet_db4_mid"
-            ] + calculate_mse(
-                coefficient1, coefficient2, 1 + one_third_of_length,
-                1 + two_thirds_of_length
-            )
-            result["wavelet_db4_high"] = result[
-                "wavelet_db4_high"
-            ] + calculate_mse(
-                coefficient1, coefficient2, 1 + two_thirds_of_length,
-                1 + total_length
-            )
-
-        #
-        result["wavelet_sym2_base"] = 0
-        result["wavelet_sym2_low"] = 0
-        result["wavelet_sym2_mid"] = 0
-        result["wavelet_sym2_high"] = 0
-
-        for i in range(0, 3):
-            coefficient1 = pywt.wavedec2(np_image1[..., i], "sym2")
-            coefficient2 = pywt.wavedec2(np_image2[..., i], "sym2")
-
-            total_length = len(coefficient1) - 1
-            one_third_of_length = int(total_length / 3)
-            two_thirds_of_length = int(total_length * 2 / 3)
-
-            result["wavelet_sym2_base"] += calculate_mse(
-                coefficient1,
-                coefficient2,
-                0,
-                1
-            )
-            result["wavelet_sym2_low"] = result[
-                "wavelet_sym2_low"
-             ] + calculate_mse(
-                coefficient1, coefficient2, 1, 1 + one_third_of_length
-            )
-            result["wavelet_sym2_mid"] = result[
-                "wavelet_sym2_mid"
-             ] + calculate_mse(
-                coefficient1, coefficient2, 1 + one_third_of_length,
-                1 + two_thirds_of_length
-            )
-            result["wavelet_sym2_high"] = result[
-                "wavelet_sym2_high"
-            ] + calculate_mse(
-                coefficient1, coefficient2, 1 + two_thirds_of_length,
-                1 + total_length
-            )
-
-        # Frequency metrics based on haar wavlets
-        result["wavelet_haar_freq_x1"] = 0
-        result["wavelet_haar_freq_x2"] = 0
-        result["wavelet_haar_freq_x3"] = 0
-
-        result["wavelet_haar_base"] = 0
-        result["wavelet_haar_low"] = 0
-        result["wavelet_haar_mid"] = 0
-        result["wavelet_haar_high"] = 0
-
-        for i in range(0, 3):
-            coefficient1 = pywt.wavedec2(np_image1[..., i], "haar")
-            coefficient2 = pywt.wavedec2(np_image2[..., i], "haar")
-
-            frequencies = calculate_frequencies(coefficient1, coefficient2)
-
-            result["wavelet_haar_freq_x1"] = result["wavelet_haar_freq_x1"] + \
-                                             frequencies[0]
-            result["wavelet_haar_freq_x2"] = result["wavelet_haar_freq_x2"] + \
-                                             frequencies[1]
-            result["wavelet_haar_freq_x3"] = result["wavelet_haar_freq_x3"] + \
-                                             frequencies[2]
-
-            total_length = len(coefficient1) - 1
-            one_third_of_length = int(total_length / 3)
-            two_thirds_of_length = int(total_length * 2 / 3)
-
-            result["wavelet_haar_base"] += calculate_mse(
-                coefficient1,
-                coefficient2,
-                0,
-                1
-            )
-            result["wavelet_haar_low"] += calculate_mse(
-                coefficient1,
-                coefficient2,
-                1,
-                1 + one_third_of_length
-            )
-            result["wavelet_haar_mid"] += calculate_mse(
-                coefficient1,
-                coefficient2,
-                1 + one_third_of_length,
-                1 + two_thirds_of_length
-            )
-            result["wavelet_haar_high"] += calculate_mse(
-                coefficient1,
-                coefficient2,
-                1 + two_thirds_of_length,
-                1 + total_length
-            )
+        for wavelet in MetricWavelet.WAVELETS:
+            coefficients = pywt.wavedec2(difference, wavelet)
+            if len(coefficients) == 1:
+                band_mses = compute_legacy_band_mses(np_image1, np_image2)
+            else:
+                band_mses = calculate_band_mses(
+                    *calculate_level_errors(coefficients))
+            for band, mse in band_mses.items():
+                result["wavelet_{}_{}".format(wavelet, band)] = mse
+
+        # Frequency metrics based on haar wavelets
+        planes = numpy.concatenate(pair.planes).astype(dtype, copy=False)
+        coefficients = pywt.wavedec2(
+            planes, MetricWavelet.FREQUENCY_WAVELET)
+        frequencies = calculate_batched_frequencies(coefficients, channels)
+        for i, frequency in enumerate(frequencies, start=1):
+            result["wavelet_haar_freq_x{}".format(i)] = frequency
 
         return result
 
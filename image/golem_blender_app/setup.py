@@ -59,9 +59,16 @@ setup(
     include_package_data=True,
     data_files=[
         ('render_tools/templates',
-         ['golem_blender_app/render_tools/templates/blendercrop.py.template']),
+         [
+             'golem_blender_app/render_tools/templates/'
+             'blendercrop.py.template',
+             'golem_blender_app/render_tools/templates/'
+             'blendercrops.py.template',
+             'golem_blender_app/render_tools/templates/'
+             'blenderworker.py.template',
+         ]),
         ('verifier_tools',
-         ['golem_blender_app/verifier_tools/tree35_[crr=87.71][frr=0.92].pkl']),
+         ['golem_blender_app/verifier_tools/tree35_[crr=87.71][frr=0.92].npz']),
     ],
     python_requires='>=3.6',
     install_requires=install_requires,
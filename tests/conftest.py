@@ -5,6 +5,11 @@ import pytest
 from golem_task_api.testutils import TaskLifecycleUtil
 
 
+@pytest.fixture
+def tmp_dir(tmpdir):
+    return Path(str(tmpdir))
+
+
 @pytest.fixture
 def task_lifecycle_util(tmpdir):
     print('workdir:', tmpdir)
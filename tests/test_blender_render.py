@@ -0,0 +1,323 @@
+import asyncio
+import sys
+from subprocess import SubprocessError
+from types import ModuleType, SimpleNamespace
+from unittest import mock
+
+import pytest
+
+from golem_blender_app import process_tools
+from golem_blender_app.process_tools import Usage
+from golem_blender_app.render_tools import blender_render, scenefileeditor
+
+
+CROPS = [
+    {
+        'id': i,
+        'outfilebasename': 'crop{}_'.format(i),
+        'borders_x': [0.1 * i, 0.1 * i + 0.1],
+        'borders_y': [0.2, 0.3 + 0.1 * i],
+    }
+    for i in range(3)
+]
+
+
+def _parameters(**kwargs):
+    parameters = {
+        'scene_file': '/resources/scene.blend',
+        'resolution': [320, 240],
+        'use_compositing': False,
+        'samples': 10,
+        'frames': [1, 3],
+        'output_format': 'PNG',
+        'crops': CROPS,
+    }
+    parameters.update(kwargs)
+    return parameters
+
+
+def _fake_bpy():
+    """
+    Module standing in for bpy, which records files written by renders.
+    """
+    bpy = ModuleType('bpy')
+    bpy.types = mock.MagicMock(Operator=object)
+    bpy.utils = mock.MagicMock()
+    bpy.ops = mock.MagicMock()
+    bpy.context = mock.MagicMock()
+    scene = bpy.context.scene
+    scene.render.engine = 'CYCLES'
+    rendered = []
+
+    def frame_set(frame):
+        scene.frame_current = frame
+
+    def render(write_still):
+        assert write_still
+        rendered.append((
+            scene.render.filepath.replace(
+                '####', '{:04d}'.format(scene.frame_current)),
+            scene.render.border_min_x,
+            scene.render.border_max_x,
+            scene.render.border_min_y,
+            scene.render.border_max_y,
+        ))
+
+    scene.frame_set.side_effect = frame_set
+    bpy.ops.render.render.side_effect = render
+    return bpy, rendered
+
+
+class TestSingleSession:
+
+    def test_script_renders_all_crops_and_frames(self, tmp_dir):
+        mounted_paths = {
+            'WORK_DIR': str(tmp_dir),
+            'OUTPUT_DIR': str(tmp_dir / 'output'),
+        }
+        script_file = scenefileeditor.generate_blender_crops_file(
+            'script.py', [320, 240], CROPS, [1, 3], False, 10, mounted_paths)
+        bpy, rendered = _fake_bpy()
+
+        with open(script_file) as f:
+            code = compile(f.read(), script_file, 'exec')
+        with mock.patch.dict(sys.modules, bpy=bpy):
+            exec(code, {})  # pylint: disable=exec-used
+
+        assert rendered == [
+            (
+                '{}/{}{:04d}'.format(
+                    mounted_paths['OUTPUT_DIR'], crop['outfilebasename'],
+                    frame),
+                crop['borders_x'][0],
+                crop['borders_x'][1],
+                crop['borders_y'][0],
+                crop['borders_y'][1],
+            )
+            for crop in CROPS
+            for frame in [1, 3]
+        ]
+
+    @pytest.mark.asyncio
+    async def test_render_runs_single_process(self, tmp_dir, monkeypatch):
+        commands = []
+
+        async def exec_cmd(cmd, on_line=None):
+            commands.append(cmd)
+            return 0
+
+        monkeypatch.setattr(blender_render, 'exec_cmd', exec_cmd)
+        rendered = []
+        mounted_paths = {
+            'WORK_DIR': str(tmp_dir),
+            'OUTPUT_DIR': str(tmp_dir / 'output'),
+        }
+
+        output_info = await blender_render.render(
+            _parameters(),
+            mounted_paths,
+            on_crop_rendered=rendered.append,
+            single_session=True,
+        )
+
+        assert len(commands) == 1
+        cmd = commands[0]
+        # Options after -P would be applied after the script renders crops
+        assert cmd.index('-F') < cmd.index('-P')
+        assert cmd.index('-t') < cmd.index('-P')
+        assert '-f' not in cmd and '-o' not in cmd
+        assert [info['results'] for info in output_info] == [
+            ['crop{}_0001.png'.format(i), 'crop{}_0003.png'.format(i)]
+            for i in range(3)
+        ]
+        assert rendered == output_info
+        assert output_info[0]['usage'] == Usage()
+        assert all('usage' not in info for info in output_info[1:])
+
+    @pytest.mark.asyncio
+    async def test_frames_are_reported_as_saved(self, tmp_dir, monkeypatch):
+        output_dir = tmp_dir / 'output'
+
+        async def exec_cmd(cmd, on_line=None):
+            on_line('Fra:1 Mem:12.00M | Rendering 1 / 64 samples\n')
+            for filename in ['crop1_0001.png', 'crop1_0003.png',
+                             'crop0_0001.png']:
+                on_line("Saved: '{}'\n".format(output_dir / filename))
+                on_line(' Time: 00:01.00 (Saving: 00:00.01)\n')
+            return 0
+
+        monkeypatch.setattr(blender_render, 'exec_cmd', exec_cmd)
+        events = []
+
+        await blender_render.render(
+            _parameters(),
+            {'WORK_DIR': str(tmp_dir), 'OUTPUT_DIR': str(output_dir)},
+            on_crop_rendered=lambda info: events.append(
+                ('crop', info['crop']['id'])),
+            on_frame_rendered=lambda info, index: events.append(
+                ('frame', info['crop']['id'], index)),
+            single_session=True,
+        )
+
+        # Frames which Blender did not report are reported once it exits
+        assert events == [
+            ('frame', 1, 0),
+            ('frame', 1, 1),
+            ('crop', 1),
+            ('frame', 0, 0),
+            ('frame', 0, 1),
+            ('crop', 0),
+            ('frame', 2, 0),
+            ('frame', 2, 1),
+            ('crop', 2),
+        ]
+
+    @pytest.mark.asyncio
+    async def test_render_runs_process_per_crop_by_default(
+            self, tmp_dir, monkeypatch):
+        commands = []
+
+        async def exec_cmd(cmd, on_line=None):
+            commands.append(cmd)
+            return 0
+
+        monkeypatch.setattr(blender_render, 'exec_cmd', exec_cmd)
+
+        output_info = await blender_render.render(
+            _parameters(),
+            {'WORK_DIR': str(tmp_dir), 'OUTPUT_DIR': str(tmp_dir)},
+        )
+
+        assert len(commands) == len(CROPS)
+        assert [info['crop'] for info in output_info] == CROPS
+
+
+class TestPartitionThreads:
+
+    @staticmethod
+    def _crop(width, height):
+        return {'borders_x': [0.0, width], 'borders_y': [0.0, height]}
+
+    def test_small_crops_are_rendered_concurrently(self):
+        # 64x64 pixels, two threads each
+        crops = [self._crop(0.2, 128 / 240)] * 3
+        assert blender_render.partition_threads(
+            _parameters(), crops, num_cpus=32) == (3, 10)
+
+    def test_large_crop_takes_all_cpus(self):
+        crops = [self._crop(1.0, 1.0)] * 3
+        assert blender_render.partition_threads(
+            _parameters(), crops, num_cpus=8) == (1, 8)
+
+    def test_single_crop_takes_all_cpus(self):
+        crops = [self._crop(0.01, 0.01)]
+        assert blender_render.partition_threads(
+            _parameters(), crops, num_cpus=8) == (1, 8)
+
+    def test_concurrency_is_limited(self):
+        crops = [self._crop(0.01, 0.01)] * 4
+        assert blender_render.partition_threads(
+            _parameters(), crops, num_cpus=8, max_concurrency=2) == (2, 4)
+
+
+class TestConcurrentRender:
+
+    @pytest.mark.asyncio
+    async def test_crops_are_rendered_concurrently_in_order(
+            self, tmp_dir, monkeypatch):
+        running = SimpleNamespace(now=0, peak=0)
+        commands = []
+
+        async def exec_cmd(cmd, on_line=None):
+            commands.append(cmd)
+            running.now += 1
+            running.peak = max(running.peak, running.now)
+            # Crops finish in reverse order
+            await asyncio.sleep(0.01 * (len(CROPS) - len(commands)))
+            running.now -= 1
+            return 0
+
+        monkeypatch.setattr(blender_render, 'exec_cmd', exec_cmd)
+        monkeypatch.setattr(
+            blender_render, 'partition_threads', lambda *_, **__: (2, 3))
+        rendered = []
+
+        output_info = await blender_render.render(
+            _parameters(),
+            {'WORK_DIR': str(tmp_dir), 'OUTPUT_DIR': str(tmp_dir)},
+            on_crop_rendered=rendered.append,
+        )
+
+        assert running.peak == 2
+        assert all(cmd[cmd.index('-t') + 1] == '3' for cmd in commands)
+        assert [info['crop'] for info in output_info] == CROPS
+        assert sorted(rendered, key=lambda info: info['crop']['id']) \
+            == output_info
+
+    @pytest.mark.asyncio
+    async def test_failure_cancels_other_renders(self, tmp_dir, monkeypatch):
+        cancelled = []
+
+        async def exec_cmd(cmd, on_line=None):
+            if 'crop0_' in ' '.join(cmd):
+                return 1
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.append(cmd)
+                raise
+            return 0
+
+        monkeypatch.setattr(blender_render, 'exec_cmd', exec_cmd)
+        monkeypatch.setattr(
+            blender_render, 'partition_threads', lambda *_, **__: (3, 1))
+
+        with pytest.raises(SubprocessError):
+            await blender_render.render(
+                _parameters(),
+                {'WORK_DIR': str(tmp_dir), 'OUTPUT_DIR': str(tmp_dir)},
+            )
+        assert len(cancelled) == 2
+
+
+class TestExecCmd:
+
+    @staticmethod
+    def _python(code):
+        return [sys.executable, '-c', code]
+
+    @pytest.mark.asyncio
+    async def test_error_of_callback_does_not_stop_reading(self):
+        lines = []
+
+        def on_line(line):
+            lines.append(line)
+            raise ValueError(line)
+
+        return_code = await process_tools.exec_cmd(
+            self._python('print(1); print(2)'), on_line)
+
+        assert return_code == 0
+        assert lines == ['1\n', '2\n']
+
+    @pytest.mark.asyncio
+    async def test_read_error_terminates_process(self, monkeypatch):
+        processes = []
+        # pylint: disable=protected-access
+        start_process = process_tools._start_process
+
+        async def _start_process(cmd, on_line):
+            processes.append(await start_process(cmd, on_line))
+            return processes[-1]
+
+        monkeypatch.setattr(process_tools, '_start_process', _start_process)
+
+        # The line is longer than the limit of the stream
+        with pytest.raises(ValueError):
+            await process_tools.exec_cmd(
+                self._python(
+                    'import time; print("x" * 2 ** 17, flush=True); '
+                    'time.sleep(60)'),
+                lambda line: None,
+            )
+        assert processes[0].returncode is not None
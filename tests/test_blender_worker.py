@@ -0,0 +1,252 @@
+import asyncio
+import json
+import os
+import stat
+import sys
+from subprocess import SubprocessError
+
+import pytest
+
+from golem_blender_app.render_tools import blender_render, blender_worker
+
+# Stand-in for Blender, which runs the script given by -P with a fake bpy.
+# Renders write parameters of the scene to the output file instead of
+# an image. They fail for outputs named fail_* and exit Blender for outputs
+# named exit_*. Each start is logged.
+FAKE_BLENDER = '''#!{python}
+import json
+import os
+import sys
+from types import ModuleType
+from unittest import mock
+
+with open({log!r}, 'a') as log:
+    log.write(json.dumps(sys.argv[1:]) + '\\n')
+
+bpy = ModuleType('bpy')
+bpy.types = mock.MagicMock(Operator=object)
+bpy.utils = mock.MagicMock()
+bpy.ops = mock.MagicMock()
+bpy.context = mock.MagicMock()
+scene = bpy.context.scene
+scene.render.engine = 'CYCLES'
+scene.cycles.samples = 128
+
+
+def frame_set(frame):
+    scene.frame_current = frame
+
+
+def render(write_still):
+    path = scene.render.filepath.replace(
+        '####', '{{:04d}}'.format(scene.frame_current)) + '.png'
+    if os.path.basename(path).startswith('fail_'):
+        raise RuntimeError('Render failed')
+    if os.path.basename(path).startswith('exit_'):
+        os._exit(3)
+    print("Saved: '{{}}'".format(path), flush=True)
+    with open(path, 'w') as f:
+        json.dump({{
+            'resolution': [
+                scene.render.resolution_x, scene.render.resolution_y],
+            'borders': [
+                scene.render.border_min_x, scene.render.border_max_x,
+                scene.render.border_min_y, scene.render.border_max_y],
+            'samples': scene.cycles.samples,
+        }}, f)
+
+
+scene.frame_set.side_effect = frame_set
+bpy.ops.render.render.side_effect = render
+sys.modules['bpy'] = bpy
+
+script = sys.argv[sys.argv.index('-P') + 1]
+with open(script) as f:
+    exec(compile(f.read(), script, 'exec'), {{'__name__': '__main__'}})
+'''
+
+
+@pytest.fixture
+def fake_blender(tmp_dir, monkeypatch):
+    log = tmp_dir / 'starts.log'
+    log.touch()
+    path = tmp_dir / 'blender'
+    path.write_text(FAKE_BLENDER.format(python=sys.executable, log=str(log)))
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setattr(blender_render, 'BLENDER_COMMAND', str(path))
+
+    def get_starts():
+        with open(str(log)) as f:
+            return [json.loads(line) for line in f]
+    return get_starts
+
+
+def _parameters(scene_file, crops, **kwargs):
+    parameters = {
+        'scene_file': str(scene_file),
+        'resolution': [320, 240],
+        'use_compositing': False,
+        'samples': 0,
+        'frames': [1, 2],
+        'output_format': 'PNG',
+        'crops': [
+            {
+                'id': i,
+                'outfilebasename': name,
+                'borders_x': [0.0, 0.5],
+                'borders_y': [0.25, 1.0],
+            }
+            for i, name in enumerate(crops)
+        ],
+    }
+    parameters.update(kwargs)
+    return parameters
+
+
+def _read_output(output_dir, filename):
+    with open(os.path.join(str(output_dir), filename)) as f:
+        return json.load(f)
+
+
+class TestBlenderWorker:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, tmp_dir):
+        # pylint: disable=attribute-defined-outside-init
+        self.scene_file = tmp_dir / 'scene.blend'
+        self.scene_file.write_bytes(b'scene')
+        self.mounted_paths = {
+            'WORK_DIR': str(tmp_dir),
+            'OUTPUT_DIR': str(tmp_dir),
+        }
+
+    @pytest.mark.asyncio
+    async def test_scene_is_loaded_once(self, tmp_dir, fake_blender):
+        pool = blender_worker.BlenderWorkerPool()
+        rendered = []
+        frames = []
+
+        try:
+            first = await blender_render.render(
+                _parameters(self.scene_file, ['a_', 'b_']),
+                self.mounted_paths,
+                on_crop_rendered=rendered.append,
+                on_frame_rendered=lambda info, index: frames.append(
+                    info['results'][index]),
+                worker_pool=pool,
+            )
+            second = await blender_render.render(
+                _parameters(
+                    self.scene_file, ['c_'],
+                    resolution=[100, 50], samples=16, frames=[3]),
+                self.mounted_paths,
+                monitor_usage=True,
+                worker_pool=pool,
+            )
+        finally:
+            await pool.close()
+
+        assert len(fake_blender()) == 1
+        assert [info['results'] for info in first] == [
+            ['a_0001.png', 'a_0002.png'],
+            ['b_0001.png', 'b_0002.png'],
+        ]
+        assert rendered == first
+        assert frames == ['a_0001.png', 'a_0002.png', 'b_0001.png',
+                          'b_0002.png']
+        assert second[0]['results'] == ['c_0003.png']
+        assert second[0]['usage'].real_time > 0
+        # Samples of the scene are used unless a job sets its own
+        assert _read_output(tmp_dir, 'a_0002.png') == {
+            'resolution': [320, 240],
+            'borders': [0.0, 0.5, 0.25, 1.0],
+            'samples': 128,
+        }
+        assert _read_output(tmp_dir, 'c_0003.png') == {
+            'resolution': [100, 50],
+            'borders': [0.0, 0.5, 0.25, 1.0],
+            'samples': 16,
+        }
+
+    @pytest.mark.asyncio
+    async def test_failed_render_restarts_worker(self, fake_blender):
+        pool = blender_worker.BlenderWorkerPool()
+
+        try:
+            with pytest.raises(SubprocessError, match='Render failed'):
+                await pool.render(
+                    _parameters(self.scene_file, ['fail_']),
+                    self.mounted_paths,
+                )
+            output_info = await pool.render(
+                _parameters(self.scene_file, ['ok_']),
+                self.mounted_paths,
+            )
+        finally:
+            await pool.close()
+
+        assert len(fake_blender()) == 2
+        assert output_info[0]['results'] == ['ok_0001.png', 'ok_0002.png']
+
+    @pytest.mark.asyncio
+    async def test_exited_worker_is_restarted(self, fake_blender):
+        worker = blender_worker.BlenderWorker(self.scene_file, 'png')
+        parameters = _parameters(self.scene_file, ['a_'])
+
+        try:
+            await worker.render(parameters, self.mounted_paths)
+            # pylint: disable=protected-access
+            worker._process.kill()
+            await worker._process.wait()
+            output_info = await worker.render(
+                parameters, self.mounted_paths)
+        finally:
+            await worker.close()
+
+        assert len(fake_blender()) == 2
+        assert output_info[0]['results'] == ['a_0001.png', 'a_0002.png']
+
+    @pytest.mark.asyncio
+    async def test_exit_while_rendering_fails_render(self, fake_blender):
+        worker = blender_worker.BlenderWorker(self.scene_file, 'png')
+
+        try:
+            with pytest.raises(SubprocessError, match='exited with code 3'):
+                await worker.render(
+                    _parameters(self.scene_file, ['exit_']),
+                    self.mounted_paths,
+                )
+            assert not worker.is_running
+        finally:
+            await worker.close()
+        assert len(fake_blender()) == 1
+
+    @pytest.mark.asyncio
+    async def test_pool_closes_least_recently_used_worker(
+            self, tmp_dir, fake_blender):
+        pool = blender_worker.BlenderWorkerPool(max_workers=1)
+        other_scene_file = tmp_dir / 'other.blend'
+        other_scene_file.write_bytes(b'other')
+
+        try:
+            for scene_file in [self.scene_file, other_scene_file,
+                               other_scene_file]:
+                await pool.render(
+                    _parameters(scene_file, ['a_']),
+                    self.mounted_paths,
+                )
+            assert len(pool) == 1
+            # A changed scene file is loaded again
+            os.utime(str(other_scene_file), ns=(0, 0))
+            await pool.render(
+                _parameters(other_scene_file, ['a_']),
+                self.mounted_paths,
+            )
+        finally:
+            await pool.close()
+
+        assert [start[1] for start in fake_blender()] == [
+            str(self.scene_file),
+            str(other_scene_file),
+            str(other_scene_file),
+        ]
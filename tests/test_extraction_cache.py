@@ -0,0 +1,217 @@
+import os
+import subprocess
+import sys
+import zipfile
+
+import pytest
+
+from golem_blender_app.commands import extraction_cache
+from golem_blender_app.commands.extraction_cache import (
+    ExtractionCache,
+    LOCKS_DIRECTORY,
+    MANIFEST_FILENAME,
+)
+
+
+def _make_zip(path, files):
+    with zipfile.ZipFile(str(path), 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for name, content in files.items():
+            zipf.writestr(name, content)
+    return path
+
+
+def _read_files(directory):
+    files = {}
+    for root, _, filenames in os.walk(str(directory)):
+        for filename in filenames:
+            if filename == MANIFEST_FILENAME:
+                continue
+            path = os.path.join(root, filename)
+            with open(path, 'rb') as f:
+                files[os.path.relpath(path, str(directory))] = f.read()
+    return files
+
+
+class TestExtractionCache:
+
+    FILES = {
+        'scene.blend': b'scene',
+        'textures/wood.png': b'wood' * 100,
+        'textures/metal/steel.png': b'steel' * 50,
+    }
+
+    @pytest.fixture
+    def extractions(self, monkeypatch):
+        extracted = []
+        extract_archive = ExtractionCache._extract_archive
+
+        def count(self, path, target):
+            extracted.append(path.name)
+            extract_archive(self, path, target)
+
+        monkeypatch.setattr(ExtractionCache, '_extract_archive', count)
+        return extracted
+
+    def test_archives_are_extracted_once(self, tmp_dir, extractions):
+        archive = _make_zip(tmp_dir / '0.zip', self.FILES)
+        cache = ExtractionCache(tmp_dir / 'cache')
+
+        first = cache.extract([archive])
+        second = ExtractionCache(tmp_dir / 'cache').extract([archive])
+
+        assert first == second
+        assert extractions == ['0.zip']
+        assert _read_files(first) == self.FILES
+
+    def test_changed_contents_are_extracted_again(
+            self, tmp_dir, extractions):
+        archive = _make_zip(tmp_dir / '0.zip', self.FILES)
+        cache = ExtractionCache(tmp_dir / 'cache')
+        entry = cache.extract([archive])
+
+        (entry / 'textures' / 'wood.png').write_bytes(b'')
+
+        assert cache.extract([archive]) == entry
+        assert extractions == ['0.zip', '0.zip']
+        assert _read_files(entry) == self.FILES
+
+    def test_contents_of_same_size_are_verified(self, tmp_dir, extractions):
+        archive = _make_zip(tmp_dir / '0.zip', self.FILES)
+        cache = ExtractionCache(tmp_dir / 'cache')
+        entry = cache.extract([archive])
+
+        (entry / 'scene.blend').write_bytes(b'SCENE')
+
+        assert cache.extract([archive]) == entry
+        assert extractions == ['0.zip', '0.zip']
+        assert _read_files(entry) == self.FILES
+
+    def test_later_archives_overwrite_files(self, tmp_dir):
+        archives = [
+            _make_zip(tmp_dir / '0.zip', self.FILES),
+            _make_zip(tmp_dir / '1.zip', {'scene.blend': b'new scene'}),
+        ]
+        cache = ExtractionCache(tmp_dir / 'cache')
+
+        entry = cache.extract(archives)
+
+        assert _read_files(entry) == dict(
+            self.FILES, **{'scene.blend': b'new scene'})
+        assert cache.extract(archives[::-1]) != entry
+
+    def test_parallel_extraction(self, tmp_dir, monkeypatch):
+        monkeypatch.setattr(
+            extraction_cache, 'PARALLEL_EXTRACTION_MIN_BYTES', 0)
+        files = {
+            'dir{}/sub{}/file{}.bin'.format(i % 3, i % 2, i): os.urandom(i)
+            for i in range(50)
+        }
+        archive = _make_zip(tmp_dir / '0.zip', files)
+
+        entry = ExtractionCache(tmp_dir / 'cache', max_workers=4) \
+            .extract([archive])
+
+        assert _read_files(entry) == files
+
+    def test_least_recently_used_entries_are_evicted(self, tmp_dir):
+        archives = [
+            _make_zip(
+                tmp_dir / '{}.zip'.format(i), {'file': bytes([i]) * 100})
+            for i in range(3)
+        ]
+        cache = ExtractionCache(tmp_dir / 'cache', max_bytes=250)
+        entries = [cache.extract([archive]) for archive in archives[:2]]
+        os.utime(str(entries[0] / MANIFEST_FILENAME), (0, 0))
+        os.utime(str(entries[1] / MANIFEST_FILENAME), (1, 1))
+        # Reusing the first entry makes the second one least recently used
+        cache.extract([archives[0]])
+        for entry in entries + [entries[0]]:
+            cache.release(entry)
+
+        third = cache.extract([archives[2]])
+
+        assert entries[0].exists()
+        assert not entries[1].exists()
+        assert third.exists()
+
+    def test_entry_over_budget_is_kept(self, tmp_dir):
+        archive = _make_zip(tmp_dir / '0.zip', {'file': bytes(100)})
+
+        entry = ExtractionCache(tmp_dir / 'cache', max_bytes=10) \
+            .extract([archive])
+
+        assert _read_files(entry) == {'file': bytes(100)}
+
+    def test_entries_in_use_are_not_evicted(self, tmp_dir):
+        archives = [
+            _make_zip(
+                tmp_dir / '{}.zip'.format(i), {'file': bytes([i]) * 100})
+            for i in range(3)
+        ]
+        cache = ExtractionCache(tmp_dir / 'cache', max_bytes=150)
+        in_use = cache.extract([archives[0]])
+        released = ExtractionCache(tmp_dir / 'cache').extract([archives[1]])
+        cache.release(released)
+
+        third = cache.extract([archives[2]])
+
+        assert in_use.exists()
+        assert not released.exists()
+        cache.release(in_use)
+        cache.release(third)
+        cache.extract([archives[1]])
+        assert not in_use.exists()
+
+    def test_archives_are_hashed_once_per_version(
+            self, tmp_dir, monkeypatch):
+        archive = _make_zip(tmp_dir / '0.zip', self.FILES)
+        hashed = []
+        file_digest = extraction_cache.file_digest
+
+        def count(path):
+            hashed.append(path)
+            return file_digest(path)
+
+        monkeypatch.setattr(extraction_cache, 'file_digest', count)
+        cache = ExtractionCache(tmp_dir / 'cache')
+
+        first = cache.extract([archive])
+        assert cache.extract([archive]) == first
+        _make_zip(archive, {'scene.blend': b'other scene'})
+
+        assert cache.extract([archive]) != first
+        assert hashed == [str(archive), str(archive)]
+
+    def test_entries_in_use_by_other_processes_are_not_evicted(
+            self, tmp_dir):
+        archives = [
+            _make_zip(
+                tmp_dir / '{}.zip'.format(i), {'file': bytes([i]) * 100})
+            for i in range(3)
+        ]
+        cache = ExtractionCache(tmp_dir / 'cache', max_bytes=150)
+        in_use = cache.extract([archives[0]])
+        cache.release(in_use)
+        lock_path = tmp_dir / 'cache' / LOCKS_DIRECTORY / in_use.name
+        # Another process shares the lock of the entry until it is killed
+        process = subprocess.Popen(
+            [
+                sys.executable, '-c',
+                'import fcntl, sys, time; f = open(sys.argv[1]); '
+                'fcntl.flock(f, fcntl.LOCK_SH); print(flush=True); '
+                'time.sleep(60)',
+                str(lock_path),
+            ],
+            stdout=subprocess.PIPE,
+        )
+        try:
+            process.stdout.readline()
+            cache.release(cache.extract([archives[1]]))
+
+            assert in_use.exists()
+        finally:
+            process.kill()
+            process.wait()
+        cache.release(cache.extract([archives[2]]))
+        assert not in_use.exists()
+        assert not lock_path.exists()
@@ -0,0 +1,65 @@
+import zipfile
+
+import pytest
+
+from golem_blender_app.commands.result_archive import ResultArchive
+
+
+class TestResultArchive:
+
+    @pytest.fixture
+    def result_dir(self, tmp_dir):
+        result_dir = tmp_dir / 'result'
+        result_dir.mkdir()
+        for name in ['result0001.png', 'result0002.exr', 'result0003.tga']:
+            (result_dir / name).write_bytes(name.encode() * 100)
+        return result_dir
+
+    def test_files_are_archived_and_removed(self, tmp_dir, result_dir):
+        with ResultArchive(tmp_dir / 'subtask.zip') as archive:
+            assert archive.add(result_dir / 'result0002.exr')
+            assert not (result_dir / 'result0002.exr').exists()
+            archive.add_directory(result_dir)
+
+        assert list(result_dir.iterdir()) == []
+        with zipfile.ZipFile(str(tmp_dir / 'subtask.zip')) as zipf:
+            assert [
+                (info.filename, info.compress_type)
+                for info in zipf.infolist()
+            ] == [
+                ('result0002.exr', zipfile.ZIP_STORED),
+                ('result0001.png', zipfile.ZIP_STORED),
+                ('result0003.tga', zipfile.ZIP_DEFLATED),
+            ]
+            for info in zipf.infolist():
+                assert zipf.read(info) == info.filename.encode() * 100
+
+    def test_missing_and_archived_files_are_skipped(
+            self, tmp_dir, result_dir):
+        with ResultArchive(tmp_dir / 'subtask.zip') as archive:
+            assert archive.add(result_dir / 'result0001.png')
+            assert not archive.add(result_dir / 'result0001.png')
+            assert not archive.add(result_dir / 'result0001.jpeg')
+
+        with zipfile.ZipFile(str(tmp_dir / 'subtask.zip')) as zipf:
+            assert zipf.namelist() == ['result0001.png']
+
+    def test_digest_depends_on_names_and_contents(
+            self, tmp_dir, result_dir):
+        digests = []
+        for i, content in enumerate([b'a', b'a', b'b']):
+            path = result_dir / 'result0001.png'
+            path.write_bytes(content)
+            with ResultArchive(tmp_dir / '{}.zip'.format(i)) as archive:
+                archive.add(path)
+            digests.append(archive.digest)
+
+        assert digests[0] == digests[1] != digests[2]
+
+    def test_archive_is_removed_on_failure(self, tmp_dir, result_dir):
+        with pytest.raises(RuntimeError):
+            with ResultArchive(tmp_dir / 'subtask.zip') as archive:
+                archive.add(result_dir / 'result0001.png')
+                raise RuntimeError('Render failed')
+
+        assert not (tmp_dir / 'subtask.zip').exists()
@@ -0,0 +1,1369 @@
+import asyncio
+import json
+import os
+import threading
+from types import SimpleNamespace
+
+import cv2
+import Imath
+import numpy
+import OpenEXR
+import pytest
+import pywt
+from PIL import Image, ImageFilter
+
+from golem_blender_app.verifier_tools import (
+    image_format_converter,
+    image_metrics_calculator,
+    image_pair,
+    scratch_space,
+    verdict_cache,
+    wavelet,
+)
+from golem_blender_app.verifier_tools.decision_tree import (
+    DecisionTree,
+    TREE_LEAF,
+)
+from golem_blender_app.verifier_tools.histograms_correlation import (
+    MetricHistogramsCorrelation,
+)
+from golem_blender_app.verifier_tools.image_format_converter import (
+    convert_tga_to_png,
+    read_exr,
+    read_exr_as_srgb_image,
+)
+from golem_blender_app.verifier_tools.image_metrics import ImgageMetrics
+from golem_blender_app.verifier_tools.image_metrics_calculator import (
+    calculate_metrics,
+    calculate_metrics_and_usage,
+    classify_metrics,
+    classify_with_tree,
+    convert_to_png_if_needed,
+    get_image_size,
+    get_metrics,
+    get_usage_path,
+    LazyMetrics,
+    load_classifier,
+    ProviderFrames,
+    read_image_rows,
+    VERIFICATION_FAIL,
+    VERIFICATION_SUCCESS,
+)
+from golem_blender_app.verifier_tools.edges import MetricEdgeFactor
+from golem_blender_app.verifier_tools.image_pair import ImagePair
+from golem_blender_app.verifier_tools.mass_center_distance import (
+    MetricMassCenterDistance,
+)
+from golem_blender_app.verifier_tools.psnr import MetricPSNR
+from golem_blender_app.verifier_tools.scratch_space import ScratchSpace
+from golem_blender_app.verifier_tools.ssim import MetricSSIM
+from golem_blender_app.verifier_tools.skimage import (
+    compare_mse,
+    compare_psnr,
+    compare_ssim,
+)
+from golem_blender_app.verifier_tools.variance import ImageVariance
+from golem_blender_app.verifier_tools import verifier
+from golem_blender_app.verifier_tools.verifier import (
+    compare_crops,
+    CropComparison,
+    render_and_make_verdict,
+    summarize_usage,
+)
+from golem_blender_app.verifier_tools.verdict_cache import (
+    collect_outputs,
+    get_cache_key,
+    restore_outputs,
+    VerdictCache,
+)
+
+
+def _random_pair(height, width, seed=0):
+    random = numpy.random.RandomState(seed)
+    image1 = random.randint(0, 256, (height, width, 3)).astype(numpy.uint8)
+    noise = random.randint(-16, 17, image1.shape)
+    image2 = numpy.clip(image1 + noise, 0, 255).astype(numpy.uint8)
+    return image1, image2
+
+
+def _mass_centers_per_pixel(image):
+    # Reference implementation, accumulates pixel by pixel
+    height, width, channels = image.shape
+    results = []
+    for channel_index in range(channels):
+        mass_center_x = 0
+        mass_center_y = 0
+        total_mass = 0
+        for x in range(width):
+            for y in range(height):
+                mass = int(image[y, x, channel_index])
+                mass_center_x += mass * x
+                mass_center_y += mass * y
+                total_mass += mass
+        divisor_x = float(total_mass) * width
+        divisor_y = float(total_mass) * height
+        results.append((
+            mass_center_x / divisor_x if divisor_x else 0.5,
+            mass_center_y / divisor_y if divisor_y else 0.5,
+        ))
+    return results
+
+
+class TestMassCenterDistance:
+
+    @pytest.mark.parametrize('height, width', [(8, 8), (13, 29), (40, 17)])
+    def test_matches_per_pixel_computation(self, height, width):
+        image1, image2 = _random_pair(height, width)
+        image2[..., 1] = 0
+
+        expected_1 = _mass_centers_per_pixel(image1)
+        expected_2 = _mass_centers_per_pixel(image2)
+        result = MetricMassCenterDistance.compute_pair_metrics(
+            ImagePair(image1, image2))
+
+        assert result["max_x_mass_center_distance"] == max(
+            abs(c1[0] - c2[0]) for c1, c2 in zip(expected_1, expected_2))
+        assert result["max_y_mass_center_distance"] == max(
+            abs(c1[1] - c2[1]) for c1, c2 in zip(expected_1, expected_2))
+
+    def test_stack_of_images(self):
+        images = numpy.stack(_random_pair(11, 7) + _random_pair(11, 7, 1))
+
+        mass_centers = MetricMassCenterDistance.compute_mass_centers(images)
+
+        assert mass_centers.shape == (4, 3, 2)
+        for image, centers in zip(images, mass_centers):
+            numpy.testing.assert_array_equal(
+                centers,
+                MetricMassCenterDistance.compute_mass_centers(image))
+
+
+class TestExrConversion:
+
+    @staticmethod
+    def _write_exr(path, rgb):
+        height, width, _ = rgb.shape
+        header = OpenEXR.Header(width, height)
+        channel = Imath.Channel(Imath.PixelType(Imath.PixelType.FLOAT))
+        header['channels'] = {'R': channel, 'G': channel, 'B': channel}
+        exr_file = OpenEXR.OutputFile(path, header)
+        exr_file.writePixels({
+            name: numpy.ascontiguousarray(rgb[..., i]).tobytes()
+            for i, name in enumerate('RGB')
+        })
+        exr_file.close()
+
+    @staticmethod
+    def _encode_with_pil(rgb):
+        # Reference implementation, the former conversion through PNG file
+        height, width, _ = rgb.shape
+        channels = []
+        for i in range(3):
+            linear = rgb[..., i]
+            with numpy.errstate(invalid='ignore'):
+                srgb = numpy.where(
+                    linear <= 0.0031308,
+                    (linear * 12.92) * 255.0,
+                    (1.055 * (linear ** (1.0 / 2.4)) - 0.055) * 255.0
+                ).astype(numpy.float32)
+            channels.append(
+                Image.frombytes("F", (width, height), srgb.tobytes())
+                .convert("L"))
+        return numpy.array(Image.merge("RGB", channels))
+
+    def test_matches_conversion_with_pil(self, tmp_dir):
+        random = numpy.random.RandomState(0)
+        rgb = random.uniform(-0.1, 1.2, (37, 53, 3)).astype(numpy.float32)
+        rgb[0, :4, 0] = [0.0031308, 0.0, 1.0, numpy.inf]
+        self._write_exr(str(tmp_dir / 'image.exr'), rgb)
+
+        image = read_exr_as_srgb_image(tmp_dir / 'image.exr')
+
+        assert image.mode == "RGB"
+        numpy.testing.assert_array_equal(
+            numpy.array(image), self._encode_with_pil(rgb))
+
+
+class TestReadRows:
+
+    @staticmethod
+    def _image(mode='RGB'):
+        random = numpy.random.RandomState(0)
+        array = random.randint(0, 256, (45, 31, 3)).astype(numpy.uint8)
+        # Runs of equal pixels for run-length encoding
+        array[::3, 5:20] = 17
+        return Image.fromarray(array).convert(mode)
+
+    @pytest.mark.parametrize('rows', [(0, 45), (0, 1), (13, 29), (44, 45)])
+    @pytest.mark.parametrize('extension, save_options', [
+        ('png', {}),
+        ('tga', {}),
+        ('tga', {'orientation': 1}),
+        ('tga', {'compression': 'tga_rle'}),
+        ('tga', {'compression': 'tga_rle', 'orientation': 1}),
+        ('bmp', {}),
+    ])
+    def test_rows_match_whole_image(
+            self, tmp_dir, extension, save_options, rows):
+        path = str(tmp_dir / 'image.{}'.format(extension))
+        image = self._image()
+        image.save(path, **save_options)
+        top, bottom = rows
+
+        result = read_image_rows(path, top, bottom)
+
+        numpy.testing.assert_array_equal(
+            result, numpy.array(image)[top:bottom])
+
+    @pytest.mark.parametrize('extension', ['png', 'tga'])
+    def test_whole_image_is_decoded_with_unknown_pillow(
+            self, tmp_dir, monkeypatch, extension):
+        monkeypatch.setattr(
+            image_format_converter, 'PARTIAL_DECODING', False)
+        path = str(tmp_dir / 'image.{}'.format(extension))
+        image = self._image()
+        image.save(path)
+        opened = Image.open(path)
+
+        result = image_format_converter.read_rows(opened, 13, 29)
+
+        assert opened.size == image.size
+        numpy.testing.assert_array_equal(
+            numpy.array(result), numpy.array(image)[13:29])
+
+    def test_partial_decoding_is_supported_by_installed_pillow(self):
+        assert image_format_converter.PARTIAL_DECODING
+
+    @pytest.mark.parametrize('mode', ['L', 'RGBA'])
+    def test_rows_of_other_modes(self, tmp_dir, mode):
+        path = str(tmp_dir / 'image.tga')
+        image = self._image(mode)
+        image.save(path)
+
+        result = read_image_rows(path, 7, 20)
+
+        numpy.testing.assert_array_equal(
+            result, numpy.array(image.convert('RGB'))[7:20])
+
+    def test_exr_rows(self, tmp_dir):
+        random = numpy.random.RandomState(0)
+        rgb = random.uniform(0, 1, (37, 53, 3)).astype(numpy.float32)
+        path = str(tmp_dir / 'image.exr')
+        TestExrConversion._write_exr(path, rgb)
+
+        result = read_image_rows(path, 11, 30)
+
+        numpy.testing.assert_array_equal(
+            result, numpy.array(read_exr_as_srgb_image(path))[11:30])
+        numpy.testing.assert_array_equal(
+            read_exr(path, (11, 30)), rgb[11:30])
+
+
+class TestImagePair:
+
+    def test_conversions_are_cached(self):
+        image1, image2 = _random_pair(9, 5)
+        pair = ImagePair(image1, image2)
+
+        assert pair.float32 is pair.float32
+        assert pair.planes is pair.planes
+        assert pair.size == (5, 9)
+        numpy.testing.assert_array_equal(pair.float32[1], image2)
+        numpy.testing.assert_array_equal(
+            pair.planes[0], image1.transpose(2, 0, 1))
+        for array in pair.uint8 + pair.float32 + pair.planes:
+            assert not array.flags.writeable
+        assert pair.planes[0].dtype == numpy.float32
+
+    def test_from_images_converts_to_rgb(self):
+        image1, image2 = _random_pair(6, 4)
+
+        pair = ImagePair.from_images(
+            Image.fromarray(image1).convert('RGBA'), Image.fromarray(image2))
+
+        numpy.testing.assert_array_equal(pair.uint8[0], image1)
+        numpy.testing.assert_array_equal(pair.uint8[1], image2)
+        with pytest.raises(ValueError):
+            ImagePair.from_images(
+                Image.fromarray(image1), Image.fromarray(image2[1:]))
+
+    def test_statistics_are_shared_by_metrics(self, monkeypatch):
+        image1, image2 = _random_pair(13, 29)
+        compute_pair_statistics = image_pair.compute_pair_statistics
+        calls = []
+
+        def count_calls(tiles):
+            calls.append(None)
+            return compute_pair_statistics(tiles)
+        monkeypatch.setattr(
+            image_pair, 'compute_pair_statistics', count_calls)
+        pair = ImagePair(image1, image2)
+
+        results = [
+            metric.compute_pair_metrics(pair)
+            for metric in (MetricEdgeFactor, ImageVariance, MetricPSNR)
+        ]
+
+        assert len(calls) == 1
+        assert results == [
+            metric.compute_pair_metrics(ImagePair(image1, image2))
+            for metric in (MetricEdgeFactor, ImageVariance, MetricPSNR)
+        ]
+
+
+class TestImageStatistics:
+
+    @pytest.mark.parametrize('height, width', [(1, 1), (2, 9), (13, 29)])
+    def test_edges_match_pil_filter(self, height, width):
+        image1, image2 = _random_pair(height, width)
+
+        result = MetricEdgeFactor.compute_pair_metrics(
+            ImagePair(image1, image2))
+
+        edges1, edges2 = (
+            numpy.array(Image.fromarray(image).filter(ImageFilter.FIND_EDGES))
+            for image in (image1, image2)
+        )
+        assert result == {
+            "ref_edge_factor": numpy.mean(edges1),
+            "comp_edge_factor": numpy.mean(edges2),
+            "edge_difference": compare_mse(edges1, edges2),
+        }
+
+    @pytest.mark.parametrize('height, width', [(1, 1), (8, 8), (40, 17)])
+    def test_variances_match_numpy(self, height, width):
+        image1, image2 = _random_pair(height, width)
+
+        result = ImageVariance.compute_pair_metrics(ImagePair(image1, image2))
+
+        expected1 = numpy.var(image1, axis=(0, 1)).sum()
+        expected2 = numpy.var(image2, axis=(0, 1)).sum()
+        assert result["reference_variance"] == pytest.approx(
+            expected1, rel=1e-12)
+        assert result["image_variance"] == pytest.approx(expected2, rel=1e-12)
+        assert result["variance_difference"] == pytest.approx(
+            expected2 - expected1, abs=1e-12 * expected1)
+
+    def test_psnr_matches_skimage(self):
+        image1, image2 = _random_pair(31, 17)
+
+        result = MetricPSNR.compute_pair_metrics(ImagePair(image1, image2))
+
+        assert result == {"psnr": compare_psnr(image1, image2)}
+
+    def test_psnr_of_equal_images(self):
+        image, _ = _random_pair(4, 4)
+
+        result = MetricPSNR.compute_pair_metrics(ImagePair(image, image))
+
+        assert result == {"psnr": numpy.finfo(numpy.float32).max}
+
+    def test_statistics_are_computed_once(self):
+        pair = ImagePair(*_random_pair(8, 8))
+
+        assert pair.statistics is pair.statistics
+
+
+class TestHistogramsCorrelation:
+
+    @staticmethod
+    def _dense_histogram(image):
+        histogram = cv2.calcHist(
+            [image], [0, 1, 2], None, [256] * 3, [0, 256] * 3)
+        cv2.normalize(histogram, histogram, 0, 256, cv2.NORM_MINMAX)
+        return histogram
+
+    def _compare_dense_histograms(self, image1, image2):
+        return cv2.compareHist(
+            self._dense_histogram(image1),
+            self._dense_histogram(image2),
+            cv2.HISTCMP_CORREL
+        )
+
+    @pytest.mark.parametrize('height, width, seed', [
+        (2, 3, 0),
+        (8, 8, 1),
+        (13, 29, 2),
+        (64, 50, 3),
+    ])
+    def test_matches_dense_histograms(self, height, width, seed):
+        image1, image2 = _random_pair(height, width, seed)
+        # Repeated colors, so bins hold more than one pixel
+        image2[::2] = image2[1::2].min()
+
+        result = MetricHistogramsCorrelation.compare_histograms(
+            image1, image2)
+
+        assert result == pytest.approx(
+            self._compare_dense_histograms(image1, image2), abs=1e-12)
+
+    @pytest.mark.parametrize('value1, value2', [(0, 0), (0, 7), (3, 3)])
+    def test_single_color_images(self, value1, value2):
+        image1 = numpy.full((4, 5, 3), value1, dtype=numpy.uint8)
+        image2 = numpy.full((4, 5, 3), value2, dtype=numpy.uint8)
+
+        result = MetricHistogramsCorrelation.compare_histograms(
+            image1, image2)
+
+        assert result == pytest.approx(
+            self._compare_dense_histograms(image1, image2), abs=1e-12)
+
+
+def _frequencies_per_channel(coefficient1, coefficient2):
+    # Reference implementation, sums over the three finest levels
+    num_of_levels = len(coefficient1)
+    frequencies = list()
+    for i in range(num_of_levels - 3, num_of_levels):
+        sum_coeffs1 = sum(sum(sum(numpy.absolute(coefficient1[i]))))
+        sum_coeffs2 = sum(sum(sum(numpy.absolute(coefficient2[i]))))
+        diff = numpy.absolute(sum_coeffs2 - sum_coeffs1) / (
+            3 * coefficient1[i][0].size)
+        frequencies = [diff] + frequencies
+    return frequencies
+
+
+def _wavelet_metrics_per_channel(image1, image2):
+    # Reference implementation, decomposes each channel separately
+    result = dict.fromkeys(wavelet.MetricWavelet.get_labels(), 0)
+    for name in ["db4", "sym2", "haar"]:
+        for i in range(3):
+            coefficient1 = pywt.wavedec2(image1[..., i], name)
+            coefficient2 = pywt.wavedec2(image2[..., i], name)
+            bands = wavelet.get_band_ranges(len(coefficient1) - 1)
+            for band, (low, high) in bands.items():
+                result["wavelet_{}_{}".format(name, band)] += \
+                    wavelet.calculate_mse(coefficient1, coefficient2, low, high)
+            if name == "haar":
+                frequencies = _frequencies_per_channel(
+                    coefficient1, coefficient2)
+                for j, frequency in enumerate(frequencies, start=1):
+                    result["wavelet_haar_freq_x{}".format(j)] += frequency
+    return result
+
+
+class TestWavelet:
+
+    @pytest.mark.parametrize('kwargs, rtol', [
+        ({}, 1e-9),
+        ({'dtype': numpy.float32}, 1e-4),
+    ])
+    @pytest.mark.parametrize('height, width', [(8, 8), (15, 31), (64, 50)])
+    def test_matches_per_channel_decomposition(
+            self, height, width, kwargs, rtol):
+        image1, image2 = _random_pair(height, width)
+
+        expected = _wavelet_metrics_per_channel(image1, image2)
+        result = wavelet.MetricWavelet.compute_pair_metrics(
+            ImagePair(image1, image2), **kwargs)
+
+        assert set(result) == set(expected)
+        for label, value in expected.items():
+            assert result[label] == pytest.approx(value, rel=rtol), label
+
+
+class TestSSIM:
+
+    @staticmethod
+    def _ssim_per_channel(image1, image2, **kwargs):
+        results = [
+            compare_ssim(image1[..., i], image2[..., i], full=True, **kwargs)
+            for i in range(image1.shape[2])
+        ]
+        return (
+            numpy.mean([mssim for mssim, _ in results]),
+            numpy.stack([s for _, s in results], axis=-1),
+        )
+
+    @pytest.mark.parametrize('gaussian_weights', [False, True])
+    @pytest.mark.parametrize('height, width', [(13, 13), (40, 67)])
+    def test_fused_multichannel_matches_per_channel(
+            self, height, width, gaussian_weights):
+        image1, image2 = _random_pair(height, width)
+
+        expected, expected_full = self._ssim_per_channel(
+            image1, image2, gaussian_weights=gaussian_weights)
+        result, result_full = compare_ssim(
+            image1, image2, multichannel=True, full=True,
+            gaussian_weights=gaussian_weights)
+
+        assert result == pytest.approx(expected, rel=1e-12)
+        numpy.testing.assert_allclose(result_full, expected_full, rtol=1e-12)
+
+    @pytest.mark.parametrize('height, width', [(8, 8), (40, 67), (300, 300)])
+    def test_float32_within_tolerance_of_float64(self, height, width):
+        image1, image2 = _random_pair(height, width)
+
+        expected = compare_ssim(image1, image2, multichannel=True)
+        result = compare_ssim(
+            image1, image2, multichannel=True, dtype=numpy.float32)
+
+        assert result == pytest.approx(expected, abs=1e-5)
+
+
+class TestDecisionTree:
+
+    @staticmethod
+    def _samples(tree, count, seed=0):
+        random = numpy.random.RandomState(seed)
+        samples = random.uniform(-1, 1, (count, tree.feature.max() + 1))
+        # Put features of some samples exactly on split thresholds
+        inner = numpy.flatnonzero(tree.children_left != TREE_LEAF)
+        for i, node in enumerate(inner):
+            samples[i::len(inner), tree.feature[node]] = tree.threshold[node]
+        return samples
+
+    def test_batch_classification_matches_lazy_classification(self):
+        tree, labels = load_classifier()
+        samples = self._samples(tree, 2000)
+
+        result = tree.classify(samples)
+
+        expected = [
+            tree.classify_lazily(
+                lambda label, sample=sample: sample[labels.index(label)],
+                labels)
+            for sample in samples
+        ]
+        assert result.tolist() == expected
+        assert set(expected) == {VERIFICATION_SUCCESS, VERIFICATION_FAIL}
+
+    def test_lazy_classification_reads_features_on_path_only(self):
+        tree, labels = load_classifier()
+        sample = dict(zip(labels, self._samples(tree, 1)[0]))
+        read = []
+
+        def get_feature(label):
+            read.append(label)
+            return sample[label]
+
+        tree.classify_lazily(get_feature, labels)
+
+        assert read[0] == labels[tree.feature[0]]
+        assert len(read) < len(labels)
+
+    def test_save_and_load(self, tmp_dir):
+        tree, labels = load_classifier()
+        tree.save(tmp_dir / 'tree.npz', labels)
+
+        loaded, loaded_labels = DecisionTree.load(tmp_dir / 'tree.npz')
+
+        samples = self._samples(tree, 500)
+        assert loaded_labels == labels
+        assert loaded.classify(samples).tolist() == \
+            tree.classify(samples).tolist()
+
+    def test_not_finite_features_are_rejected(self):
+        tree, labels = load_classifier()
+        samples = self._samples(tree, 3)
+        samples[1, 0] = numpy.nan
+
+        with pytest.raises(ValueError):
+            tree.classify(samples)
+
+    def test_not_finite_features_get_invalid_label(self):
+        tree, _ = load_classifier()
+        samples = self._samples(tree, 50)
+        samples[[3, 17], 0] = numpy.nan
+
+        result = tree.classify(samples, invalid_label='INVALID')
+
+        expected = tree.classify(samples[numpy.isfinite(samples[:, 0])])
+        assert result[[3, 17]].tolist() == ['INVALID', 'INVALID']
+        assert numpy.delete(result, [3, 17]).tolist() == expected.tolist()
+
+
+def _save_crop_images(directory, name, seed=0, valid=True):
+    """
+    Saves a reference crop and a provider's result with the crop
+    at (10, 5), as expected by calculate_metrics(). An invalid result
+    is black.
+    """
+    image, reference = _random_pair(20, 30, seed)
+    provider_image = numpy.zeros((40, 50, 3), dtype=numpy.uint8)
+    if valid:
+        provider_image[5:25, 10:40] = image
+    crop_path = str(directory / '{}.png'.format(name))
+    result_path = str(directory / '{}_result.png'.format(name))
+    Image.fromarray(reference).save(crop_path)
+    Image.fromarray(provider_image).save(result_path)
+    return crop_path, result_path
+
+
+class TestTiledMetrics:
+
+    METRICS = [
+        MetricEdgeFactor,
+        MetricHistogramsCorrelation,
+        MetricMassCenterDistance,
+        MetricPSNR,
+        MetricSSIM,
+        ImageVariance,
+    ]
+
+    @pytest.mark.parametrize('height, width', [(9, 11), (40, 23), (97, 64)])
+    def test_row_tiles_cover_images(self, height, width):
+        image1, image2 = _random_pair(height, width)
+        pair = ImagePair(image1, image2, memory_budget=width * 10)
+
+        tiles = list(pair.row_tiles(1, halo=2, min_rows=3))
+
+        assert len(tiles) > 1
+        assert tiles[0].start == 0
+        assert tiles[-1].stop == height
+        for tile, next_tile in zip(tiles, tiles[1:]):
+            assert tile.stop == next_tile.start
+        for tile in tiles:
+            assert tile.stop - tile.start >= 3
+            assert tile.images[0].shape[0] <= 10
+            numpy.testing.assert_array_equal(
+                tile.images[1][tile.rows], image2[tile.start:tile.stop])
+
+    def test_without_budget_images_are_single_tile(self):
+        pair = ImagePair(*_random_pair(40, 23))
+
+        tiles = list(pair.row_tiles(1000, halo=3))
+
+        assert [(tile.start, tile.stop) for tile in tiles] == [(0, 40)]
+
+    @pytest.mark.parametrize('memory_budget', [1, 20000, 100000])
+    @pytest.mark.parametrize('metric', METRICS)
+    def test_tiled_metrics_match_whole_images(self, metric, memory_budget):
+        image1, image2 = _random_pair(83, 61)
+
+        expected = metric.compute_pair_metrics(ImagePair(image1, image2))
+        result = metric.compute_pair_metrics(
+            ImagePair(image1, image2, memory_budget=memory_budget))
+
+        assert result.keys() == expected.keys()
+        for label, value in expected.items():
+            if metric is MetricSSIM:
+                assert result[label] == pytest.approx(value, rel=1e-12)
+            else:
+                assert result[label] == value, label
+
+
+class TestUsageMonitoring:
+
+    @staticmethod
+    def _calculate_metrics(directory, **kwargs):
+        crop_path, result_path = _save_crop_images(directory, 'crop0_0001')
+        return calculate_metrics(
+            crop_path,
+            result_path,
+            10, 5,
+            metrics_output_filename=str(directory / 'crop0_metrics.txt'),
+            **kwargs
+        )
+
+    @pytest.mark.parametrize('filename, expected', [
+        ('/out/crop0_metrics.txt', '/out/crop0_usage.json'),
+        ('/out/metrics.txt', '/out/usage.json'),
+        ('/out/crop0.txt', '/out/crop0_usage.json'),
+    ])
+    def test_usage_path(self, filename, expected):
+        assert get_usage_path(filename) == expected
+
+    def test_usage_is_written_next_to_metrics(self, tmp_dir):
+        self._calculate_metrics(tmp_dir, monitor_usage=True, lazy=False)
+
+        with open(str(tmp_dir / 'crop0_usage.json')) as f:
+            usage = json.load(f)
+        _, _, metrics = get_metrics()
+        assert set(usage['metrics']) == {metric.__name__ for metric in metrics}
+        for metric_usage in usage['metrics'].values():
+            assert metric_usage['real_time'] >= 0
+            assert metric_usage['mem_peak'] > 0
+        assert usage['total']['mem_peak'] == max(
+            metric_usage['mem_peak']
+            for metric_usage in usage['metrics'].values())
+
+        summary = summarize_usage([usage, usage], [])
+        assert summary['total']['count'] == 2
+        assert summary['total']['real_time'] == pytest.approx(
+            2 * usage['total']['real_time'])
+        assert 'render' not in summary
+
+    def test_usage_is_not_written_by_default(self, tmp_dir):
+        self._calculate_metrics(tmp_dir)
+
+        assert (tmp_dir / 'crop0_metrics.txt').exists()
+        assert not (tmp_dir / 'crop0_usage.json').exists()
+
+
+class TestImageMetrics:
+
+    def test_metrics_are_returned_in_memory(self, tmp_dir):
+        crop_path, result_path = _save_crop_images(tmp_dir, 'crop0_0001')
+
+        metrics = calculate_metrics(crop_path, result_path, 10, 5)
+
+        assert isinstance(metrics, ImgageMetrics)
+        assert metrics.Label == VERIFICATION_SUCCESS
+        assert not list(tmp_dir.glob('*.txt'))
+
+    def test_record_has_slots_for_all_metrics(self):
+        metrics = dict.fromkeys(ImgageMetrics.get_metric_names())
+        metrics.update(
+            Label=VERIFICATION_FAIL,
+            crop_resolution='20x30',
+            psnr=numpy.float32(2.5),
+        )
+
+        record = ImgageMetrics(metrics)
+
+        assert not hasattr(record, '__dict__')
+        assert record.to_dict() == dict(metrics, psnr=2.5)
+        assert type(record.psnr) is float
+        with pytest.raises(KeyError):
+            ImgageMetrics({'Label': VERIFICATION_FAIL})
+
+    def test_record_round_trips_through_file(self, tmp_dir):
+        metrics = dict.fromkeys(ImgageMetrics.get_metric_names())
+        metrics.update(
+            Label=VERIFICATION_SUCCESS, crop_resolution='20x30', ssim=0.5)
+        path = str(tmp_dir / 'metrics.txt')
+
+        ImgageMetrics(metrics).write_to_file(path)
+
+        assert ImgageMetrics.load_from_file(path).to_dict() == metrics
+
+
+class TestLazyMetrics:
+
+    @staticmethod
+    def _pairs():
+        for seed in range(4):
+            image, reference = _random_pair(20, 30, seed)
+            yield image, reference
+            yield numpy.zeros_like(image), reference
+            yield _random_pair(20, 30, seed + 100)[0], reference
+
+    def test_metrics_are_computed_on_first_access(self):
+        _, _, metrics = get_metrics()
+        usage = dict()
+        lazy_metrics = LazyMetrics(
+            ImagePair(*_random_pair(20, 30)), metrics, usage)
+
+        psnr = lazy_metrics['psnr']
+
+        assert list(usage) == ['MetricPSNR']
+        assert lazy_metrics['psnr'] == psnr
+        assert list(usage) == ['MetricPSNR']
+        data = lazy_metrics.to_dict()
+        assert data['psnr'] == psnr
+        assert data['crop_resolution'] == '30x20'
+        assert data['ssim'] is None
+
+    def test_lazy_labels_match_classification_of_all_metrics(self):
+        classifier, feature_labels, metrics = get_metrics()
+        lazy_labels = []
+        eager_metrics = []
+        for image1, image2 in self._pairs():
+            usage = dict()
+            lazy_labels.append(classify_with_tree(
+                LazyMetrics(ImagePair(image1, image2), metrics, usage),
+                classifier,
+                feature_labels))
+            assert len(usage) < len(metrics)
+            eager = LazyMetrics(ImagePair(image1, image2), metrics)
+            eager.compute_all()
+            eager_metrics.append(ImgageMetrics(
+                dict(eager.to_dict(), Label=None)))
+
+        assert classify_metrics(eager_metrics) == lazy_labels
+        assert set(lazy_labels) == {VERIFICATION_SUCCESS, VERIFICATION_FAIL}
+
+
+class TestCompareCrops:
+
+    @staticmethod
+    def _comparisons(directory, count, invalid=()):
+        comparisons = []
+        for i in range(count):
+            name = 'crop{}_0001'.format(i)
+            crop_path, result_path = _save_crop_images(
+                directory, name, i, valid=i not in invalid)
+            comparisons.append(CropComparison(
+                crop_path,
+                result_path,
+                10, 5,
+                name,
+                True
+            ))
+        return comparisons
+
+    def test_process_pool_matches_sequential_comparison(self, tmp_dir):
+        comparisons = self._comparisons(tmp_dir, 4)
+
+        sequential = compare_crops(comparisons, max_workers=1)
+        parallel = compare_crops(comparisons, max_workers=2)
+
+        assert [result.name for result in parallel] == \
+            [comparison.name for comparison in comparisons]
+        for result, expected in zip(parallel, sequential):
+            assert result.metrics.to_dict() == expected.metrics.to_dict()
+            assert set(result.usage['metrics']) == \
+                set(expected.usage['metrics'])
+
+    def test_sequential_fail_fast_stops_on_failure(self, tmp_dir):
+        comparisons = self._comparisons(tmp_dir, 3, invalid=(1,))
+
+        results = compare_crops(comparisons, max_workers=1)
+        fail_fast_results = compare_crops(
+            comparisons, max_workers=1, fail_fast=True)
+
+        assert [result.metrics.Label for result in results] == \
+            ["TRUE", "FALSE", "TRUE"]
+        assert [result.metrics.Label for result in fail_fast_results] == \
+            ["TRUE", "FALSE"]
+
+    def test_process_pool_fail_fast_returns_failure(self, tmp_dir):
+        comparisons = self._comparisons(tmp_dir, 6, invalid=(0,))
+
+        results = compare_crops(comparisons, max_workers=2, fail_fast=True)
+
+        assert "FALSE" in [result.metrics.Label for result in results]
+
+
+class TestProviderFrames:
+
+    @pytest.mark.parametrize('box', [
+        (10, 5, 30, 20),
+        (0, 0, 50, 40),
+        (-3, 30, 12, 15),
+        (45, -2, 10, 5),
+    ])
+    def test_crop_matches_pil_crop(self, tmp_dir, box):
+        _, result_path = _save_crop_images(tmp_dir, 'crop0_0001')
+        x, y, width, height = box
+
+        crop = ProviderFrames().crop(result_path, x, y, width, height)
+
+        expected = Image.open(result_path).crop(
+            (x, y, x + width, y + height))
+        numpy.testing.assert_array_equal(crop, numpy.array(expected))
+
+    def test_frame_rows_are_decoded_once(self, tmp_dir, monkeypatch):
+        _, result_path = _save_crop_images(tmp_dir, 'crop0_0001')
+        decoded = []
+        read_image_rows = image_metrics_calculator.read_image_rows
+
+        def read_rows(image_path, top, bottom):
+            decoded.append((image_path, top, bottom))
+            return read_image_rows(image_path, top, bottom)
+
+        monkeypatch.setattr(
+            image_metrics_calculator, 'read_image_rows', read_rows)
+        frames = ProviderFrames(rows=(5, 26))
+        frames.preload([result_path])
+
+        first = frames.crop(result_path, 10, 5, 30, 20)
+        second = frames.crop(result_path, 0, 10, 10, 10)
+
+        assert decoded == [(result_path, 5, 26)]
+        band_top, band = frames.get_rows(result_path, 5, 26)
+        assert band_top == 5
+        assert numpy.shares_memory(first, band)
+        assert numpy.shares_memory(second, band)
+
+    def test_rows_outside_of_expected_are_decoded(self, tmp_dir):
+        _, result_path = _save_crop_images(tmp_dir, 'crop0_0001')
+        frames = ProviderFrames(rows=(5, 26))
+
+        crop = frames.crop(result_path, 10, 30, 30, 10)
+
+        expected = Image.open(result_path).crop((10, 30, 40, 40))
+        numpy.testing.assert_array_equal(crop, numpy.array(expected))
+        band_top, band = frames.get_rows(result_path, 5, 40)
+        assert (band_top, len(band)) == (5, 35)
+
+    def test_metrics_of_frame_crop_match_decoded_result(self, tmp_dir):
+        crop_path, result_path = _save_crop_images(tmp_dir, 'crop0_0001')
+        providers_result_crop = ProviderFrames().crop(
+            result_path, 10, 5, *get_image_size(crop_path))
+
+        metrics, _ = calculate_metrics_and_usage(
+            crop_path, result_path, 10, 5, lazy=False,
+            providers_result_crop=providers_result_crop)
+
+        expected = calculate_metrics(crop_path, result_path, 10, 5, lazy=False)
+        assert metrics.to_dict() == expected.to_dict()
+
+
+class TestMakeVerdict:
+
+    @staticmethod
+    def _make_verdict(directory, lazy, invalid=()):
+        providers_paths = []
+        crops = []
+        reference_results = []
+        for i in range(3):
+            _, result_path = _save_crop_images(
+                directory, 'crop{}_0001'.format(i), i, valid=i not in invalid)
+            providers_paths.append(result_path)
+            crops.append(
+                SimpleNamespace(id=i, x_pixels=[10, 40], y_pixels=[5, 25]))
+            reference_results.append({
+                'crop': {'id': i, 'borders_x': [], 'borders_y': []},
+                'results': ['crop{}_0001.png'.format(i)],
+            })
+        verdicts = []
+        for i in range(3):
+            # Each crop is compared with its own result as a single frame
+            verdicts.append(verifier.make_verdict(
+                [providers_paths[i]],
+                crops[i:i + 1],
+                reference_results[i:i + 1],
+                str(directory),
+                max_workers=1,
+                lazy=lazy,
+            ))
+        return verdicts
+
+    def test_batch_classification_matches_lazy(self, tmp_dir):
+        lazy = self._make_verdict(tmp_dir, lazy=True, invalid=(1,))
+        batch = self._make_verdict(tmp_dir, lazy=False, invalid=(1,))
+
+        assert batch == lazy == [True, False, True]
+
+    def test_classify_metrics_labels_all_crops(self, tmp_dir):
+        comparisons = TestCompareCrops._comparisons(
+            tmp_dir, 3, invalid=(2,))
+        lazy = compare_crops(comparisons, max_workers=1)
+        eager = compare_crops(
+            [c._replace(classify=False) for c in comparisons],
+            max_workers=1)
+
+        assert [result.metrics.Label for result in eager] == [None] * 3
+        labels = classify_metrics([result.metrics for result in eager])
+
+        assert labels == [result.metrics.Label for result in lazy]
+        assert [result.metrics.Label for result in eager] == labels
+
+
+class TestRenderAndMakeVerdict:
+
+    @staticmethod
+    def _crop_data(crop_id):
+        return {
+            'crop': {'id': crop_id, 'borders_x': [], 'borders_y': []},
+            'results': ['crop{}_0001.png'.format(crop_id)],
+        }
+
+    @pytest.mark.asyncio
+    async def test_failure_cancels_rendering(self, tmp_dir, monkeypatch):
+        _save_crop_images(tmp_dir, 'crop0_0001', valid=False)
+        rendering = SimpleNamespace(cancelled=False)
+
+        async def render(parameters, mounted_paths, on_frame_rendered,
+                         **_kwargs):
+            on_frame_rendered(parameters['crops'][0], 0)
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                rendering.cancelled = True
+                raise
+
+        monkeypatch.setattr(verifier.blender, 'render', render)
+        crop_data = {
+            'crop': {'id': 0, 'borders_x': [], 'borders_y': []},
+            'results': ['crop0_0001.png'],
+        }
+
+        verdict = await render_and_make_verdict(
+            [str(tmp_dir / 'crop0_0001_result.png')],
+            [SimpleNamespace(id=0, x_pixels=[10, 40], y_pixels=[5, 25])],
+            {'crops': [crop_data]},
+            {'OUTPUT_DIR': str(tmp_dir)},
+            max_workers=1,
+            fail_fast=True,
+        )
+
+        assert verdict is False
+        assert rendering.cancelled
+        with open(str(tmp_dir / 'verdict.json')) as f:
+            assert json.load(f) == {'verdict': False}
+
+    @pytest.mark.asyncio
+    async def test_failure_does_not_stop_others_without_fail_fast(
+            self, tmp_dir, monkeypatch):
+        # Both crops are at the same position of the same result, which
+        # does not match the first one
+        _save_crop_images(tmp_dir, 'crop0_0001', seed=1)
+        _save_crop_images(tmp_dir, 'crop1_0001')
+        rendering = SimpleNamespace(cancelled=False)
+
+        async def render(parameters, mounted_paths, on_frame_rendered,
+                         **_kwargs):
+            try:
+                for crop_data in parameters['crops']:
+                    on_frame_rendered(crop_data, 0)
+                    await asyncio.sleep(0.5)
+            except asyncio.CancelledError:
+                rendering.cancelled = True
+                raise
+            return parameters['crops']
+
+        monkeypatch.setattr(verifier.blender, 'render', render)
+
+        verdict = await render_and_make_verdict(
+            [str(tmp_dir / 'crop1_0001_result.png')],
+            [
+                SimpleNamespace(id=i, x_pixels=[10, 40], y_pixels=[5, 25])
+                for i in range(2)
+            ],
+            {'crops': [self._crop_data(i) for i in range(2)]},
+            {'OUTPUT_DIR': str(tmp_dir)},
+            max_workers=1,
+        )
+
+        assert verdict is False
+        assert not rendering.cancelled
+        with open(str(tmp_dir / 'metrics.json')) as f:
+            metrics = json.load(f)
+        assert metrics['crop0_0001']['Label'] != VERIFICATION_SUCCESS
+        assert metrics['crop1_0001']['Label'] == VERIFICATION_SUCCESS
+
+    @pytest.mark.asyncio
+    async def test_success_waits_for_all_crops(self, tmp_dir, monkeypatch):
+        crops_data = []
+        for i in range(2):
+            # Both crops are at the same position of the same result
+            _save_crop_images(tmp_dir, 'crop{}_0001'.format(i))
+            crops_data.append({
+                'crop': {'id': i, 'borders_x': [], 'borders_y': []},
+                'results': ['crop{}_0001.png'.format(i)],
+            })
+
+        async def render(parameters, mounted_paths, on_frame_rendered,
+                         **_kwargs):
+            for crop_data in parameters['crops']:
+                await asyncio.sleep(0)
+                on_frame_rendered(crop_data, 0)
+            return parameters['crops']
+
+        monkeypatch.setattr(verifier.blender, 'render', render)
+
+        verdict = await render_and_make_verdict(
+            [str(tmp_dir / 'crop1_0001_result.png')],
+            [
+                SimpleNamespace(id=i, x_pixels=[10, 40], y_pixels=[5, 25])
+                for i in range(2)
+            ],
+            {'crops': crops_data},
+            {'OUTPUT_DIR': str(tmp_dir)},
+        )
+
+        assert verdict is True
+        with open(str(tmp_dir / 'metrics.json')) as f:
+            metrics = json.load(f)
+        assert set(metrics) == {'crop0_0001', 'crop1_0001'}
+        assert metrics['crop1_0001']['Label'] == VERIFICATION_SUCCESS
+
+    @pytest.mark.asyncio
+    async def test_comparisons_are_listed_outside_of_event_loop(
+            self, tmp_dir, monkeypatch):
+        _save_crop_images(tmp_dir, 'crop0_0001')
+        get_crop_comparisons = verifier.get_crop_comparisons
+        threads = []
+
+        def list_comparisons(*args):
+            threads.append(threading.current_thread())
+            return get_crop_comparisons(*args)
+
+        async def render(parameters, mounted_paths, on_frame_rendered,
+                         **_kwargs):
+            on_frame_rendered(parameters['crops'][0], 0)
+            return parameters['crops']
+
+        monkeypatch.setattr(
+            verifier, 'get_crop_comparisons', list_comparisons)
+        monkeypatch.setattr(verifier.blender, 'render', render)
+
+        verdict = await render_and_make_verdict(
+            [str(tmp_dir / 'crop0_0001_result.png')],
+            [SimpleNamespace(id=0, x_pixels=[10, 40], y_pixels=[5, 25])],
+            {'crops': [self._crop_data(0)]},
+            {'OUTPUT_DIR': str(tmp_dir)},
+            max_workers=1,
+        )
+
+        assert verdict is True
+        assert len(threads) == 1
+        assert threads[0] is not threading.main_thread()
+
+    @pytest.mark.asyncio
+    async def test_error_of_comparison_fails_verification(
+            self, tmp_dir, monkeypatch):
+        # The reference crop is missing, so its comparison raises
+        _, result_path = _save_crop_images(tmp_dir, 'crop0_0001')
+        os.remove(str(tmp_dir / 'crop0_0001.png'))
+
+        async def render(parameters, mounted_paths, on_frame_rendered,
+                         **_kwargs):
+            on_frame_rendered(parameters['crops'][0], 0)
+            return parameters['crops']
+
+        monkeypatch.setattr(verifier.blender, 'render', render)
+
+        verdict = await render_and_make_verdict(
+            [result_path],
+            [SimpleNamespace(id=0, x_pixels=[10, 40], y_pixels=[5, 25])],
+            {'crops': [self._crop_data(0)]},
+            {'OUTPUT_DIR': str(tmp_dir)},
+            max_workers=1,
+        )
+
+        assert verdict is False
+        with open(str(tmp_dir / 'verdict.json')) as f:
+            assert json.load(f) == {'verdict': False}
+
+
+class TestVerdictCache:
+
+    @staticmethod
+    def _write(path, data):
+        path.write_bytes(data)
+        return path
+
+    def test_key_depends_on_contents_and_parameters(self, tmp_dir):
+        scene = self._write(tmp_dir / 'scene.blend', b'scene')
+        result = self._write(tmp_dir / 'result0001.png', b'result')
+        parameters = {'samples': 10, 'resolution': [100, 100]}
+        key = get_cache_key(scene, parameters, [result])
+
+        assert get_cache_key(scene, dict(parameters), [str(result)]) == key
+        assert get_cache_key(
+            scene, dict(parameters, samples=11), [result]) != key
+        assert get_cache_key(
+            scene, parameters, [result], [[0., 0., .5, .5]]) != key
+        self._write(result, b'other result')
+        assert get_cache_key(scene, parameters, [result]) != key
+
+    def test_scene_digest_is_computed_once_per_version(
+            self, tmp_dir, monkeypatch):
+        scene = self._write(tmp_dir / 'scene.blend', b'scene')
+        digested = []
+
+        def file_digest(path):
+            digested.append(path)
+            return str(len(digested))
+        monkeypatch.setattr(verdict_cache, 'file_digest', file_digest)
+
+        first = verdict_cache.scene_file_digest(scene)
+        assert verdict_cache.scene_file_digest(str(scene)) == first
+        self._write(scene, b'other scene')
+
+        assert verdict_cache.scene_file_digest(scene) != first
+        assert digested == [str(scene), str(scene)]
+
+    def test_stores_verdict_and_outputs(self, tmp_dir):
+        cache = VerdictCache(tmp_dir / 'cache')
+        outputs = {'metrics.json': {'crop0': {'Label': 'TRUE', 'psnr': 40.}}}
+        assert cache.get('key') is None
+
+        cache.put('key', True, outputs)
+
+        assert cache.get('key') == {'verdict': True, 'outputs': outputs}
+        assert VerdictCache(tmp_dir / 'cache').get('key')['verdict']
+
+    def test_evicts_least_recently_used(self, tmp_dir):
+        cache = VerdictCache(tmp_dir / 'cache', max_entries=2)
+        cache.put('a', True)
+        cache.put('b', False)
+        entry_a = tmp_dir / 'cache' / 'a.json'
+        entry_b = tmp_dir / 'cache' / 'b.json'
+        os.utime(str(entry_a), (1, 1))
+        os.utime(str(entry_b), (2, 2))
+        # Reading marks the entry as recently used
+        assert cache.get('a') is not None
+
+        cache.put('c', True)
+
+        assert len(cache) == 2
+        assert cache.get('b') is None
+        assert cache.get('a') is not None
+        assert cache.get('c') is not None
+
+    def test_restored_outputs_match_written_ones(self, tmp_dir):
+        crop_path, result_path = _save_crop_images(tmp_dir, 'crop0_0001')
+        metrics, usage = calculate_metrics_and_usage(
+            crop_path, result_path, 10, 5, monitor_usage=True)
+        written_dir = tmp_dir / 'written'
+        restored_dir = tmp_dir / 'restored'
+        written_dir.mkdir()
+        restored_dir.mkdir()
+        verifier.write_verdict(
+            written_dir,
+            True,
+            [verifier.CropResult('crop0_0001', metrics, usage)],
+            [],
+            monitor_usage=True,
+        )
+
+        restore_outputs(restored_dir, True, collect_outputs(written_dir))
+
+        assert sorted(os.listdir(str(restored_dir))) == \
+            ['metrics.json', 'usage.json', 'verdict.json']
+        for filename in os.listdir(str(written_dir)):
+            assert (restored_dir / filename).read_bytes() == \
+                (written_dir / filename).read_bytes(), filename
+
+
+class TestScratchSpace:
+
+    @staticmethod
+    def _save_tga(directory, name, seed=0):
+        path = str(directory / name)
+        image, _ = _random_pair(20, 30, seed)
+        Image.fromarray(image).save(path)
+        return path, image
+
+    def test_converted_image_is_reused(self, tmp_dir):
+        source, image = self._save_tga(tmp_dir, 'result0001.tga')
+        scratch = ScratchSpace(root=str(tmp_dir / 'scratch'))
+        converted = []
+
+        def convert(source_path, target_path):
+            converted.append(source_path)
+            convert_tga_to_png(source_path, target_path)
+
+        first = scratch.get_converted(source, 'png', convert)
+        second = scratch.get_converted(source, 'png', convert)
+
+        assert first == second
+        assert converted == [source]
+        numpy.testing.assert_array_equal(numpy.array(Image.open(first)), image)
+        os.utime(source, (0, 0))
+        scratch.get_converted(source, 'png', convert)
+        assert len(converted) == 2
+
+    def test_verifications_are_isolated(self, tmp_dir):
+        root = str(tmp_dir / 'scratch')
+        sources = []
+        images = []
+        for i in range(2):
+            # Results of both subtasks have the same name
+            subtask_dir = tmp_dir / 'subtask{}'.format(i)
+            subtask_dir.mkdir()
+            source, image = self._save_tga(subtask_dir, 'result0001.tga', i)
+            sources.append(source)
+            images.append(image)
+        shared = ScratchSpace(root=root)
+        scratch_spaces = [shared.namespace() for _ in range(2)]
+
+        converted = [
+            convert_to_png_if_needed(source, scratch)
+            for source, scratch in zip(sources, scratch_spaces)
+        ]
+
+        assert scratch_spaces[0].namespace_directory \
+            != scratch_spaces[1].namespace_directory
+        for image, expected in zip(converted, images):
+            numpy.testing.assert_array_equal(numpy.array(image), expected)
+
+    def test_least_recently_used_are_evicted(self, tmp_dir):
+        sources = [
+            self._save_tga(tmp_dir, 'result{:04d}.tga'.format(i), i)[0]
+            for i in range(3)
+        ]
+        scratch = ScratchSpace(root=str(tmp_dir / 'scratch'))
+        paths = [
+            scratch.get_converted(source, 'png', convert_tga_to_png)
+            for source in sources[:2]
+        ]
+        os.utime(paths[0], (1, 1))
+        os.utime(paths[1], (2, 2))
+        # Reuse marks the image as recently used
+        scratch.get_converted(sources[0], 'png', convert_tga_to_png)
+        third_size = os.path.getsize(
+            ScratchSpace(root=str(tmp_dir / 'other')).get_converted(
+                sources[2], 'png', convert_tga_to_png))
+        # Only one image has to be evicted
+        scratch.max_bytes = os.path.getsize(paths[0]) \
+            + os.path.getsize(paths[1]) + third_size - 1
+
+        third = scratch.get_converted(sources[2], 'png', convert_tga_to_png)
+
+        assert os.path.exists(paths[0])
+        assert not os.path.exists(paths[1])
+        assert os.path.exists(third)
+        assert scratch.size <= scratch.max_bytes
+
+    def test_attached_scratch_space_leaves_eviction_to_owner(self, tmp_dir):
+        sources = [
+            self._save_tga(tmp_dir, 'result{:04d}.tga'.format(i), i)[0]
+            for i in range(2)
+        ]
+        scratch = ScratchSpace(root=str(tmp_dir / 'scratch'), max_bytes=0)
+        attached = ScratchSpace.attach(scratch.directory)
+
+        paths = [
+            attached.get_converted(source, 'png', convert_tga_to_png)
+            for source in sources
+        ]
+
+        assert all(os.path.exists(path) for path in paths)
+        assert os.path.dirname(paths[0]) == scratch.cache_directory
+        scratch.evict()
+        assert scratch.size == 0
+
+    def test_namespaces_reuse_converted_images(self, tmp_dir):
+        source, image = self._save_tga(tmp_dir, 'result0001.tga')
+        shared = ScratchSpace(root=str(tmp_dir / 'scratch'))
+        first, second = shared.namespace(), shared.namespace()
+        converted = []
+
+        def convert(source_path, target_path):
+            converted.append(source_path)
+            convert_tga_to_png(source_path, target_path)
+
+        first_path = first.get_converted(source, 'png', convert)
+        second_path = second.get_converted(source, 'png', convert)
+        first.cleanup()
+
+        assert converted == [source]
+        assert os.path.dirname(second_path) == second.namespace_directory
+        assert not os.path.exists(first_path)
+        assert len(os.listdir(shared.cache_directory)) == 1
+        numpy.testing.assert_array_equal(
+            numpy.array(Image.open(second_path)), image)
+
+    def test_images_in_use_are_not_removed_by_eviction(self, tmp_dir):
+        sources = [
+            self._save_tga(tmp_dir, 'result{:04d}.tga'.format(i), i)
+            for i in range(2)
+        ]
+        shared = ScratchSpace(root=str(tmp_dir / 'scratch'), max_bytes=0)
+        scratch = shared.namespace()
+
+        paths = [
+            scratch.get_converted(source, 'png', convert_tga_to_png)
+            for source, _ in sources
+        ]
+
+        assert len(os.listdir(shared.cache_directory)) == 1
+        for path, (_, image) in zip(paths, sources):
+            numpy.testing.assert_array_equal(
+                numpy.array(Image.open(path)), image)
+
+    def test_scratch_space_is_shared_by_verifications(self, monkeypatch):
+        monkeypatch.setattr(scratch_space, '_scratch_spaces', {})
+        shared = scratch_space.get_scratch_space(max_bytes=1024)
+        try:
+            assert scratch_space.get_scratch_space(max_bytes=1024) is shared
+            assert scratch_space.get_scratch_space(max_bytes=2048) \
+                is not shared
+        finally:
+            for space in scratch_space._scratch_spaces.values():
+                space.cleanup()
+
+    def test_cleanup_removes_directory(self, tmp_dir):
+        source, _ = self._save_tga(tmp_dir, 'result0001.tga')
+        scratch = ScratchSpace(root=str(tmp_dir / 'scratch'))
+        scratch.get_converted(source, 'png', convert_tga_to_png)
+
+        scratch.cleanup()
+
+        assert not os.path.exists(scratch.directory)
+        assert os.listdir(str(tmp_dir / 'scratch')) == []